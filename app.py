@@ -3,21 +3,193 @@
 Flask Application - CloudVault
 """
 
+import base64
+import contextlib
+import functools
+import json
+import math
+import multiprocessing
 import os
-import sqlite3
+import threading
+import time
 import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
-from flask import Flask, render_template, request, redirect, url_for, flash, send_from_directory, abort, jsonify
+from urllib.parse import quote
+import click
+from flask import Flask, Request, Response, render_template, request, redirect, url_for, flash, send_file, abort, jsonify, session, g
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
-from werkzeug.security import generate_password_hash, check_password_hash
+from markupsafe import Markup
+from werkzeug.middleware.proxy_fix import ProxyFix
 from werkzeug.utils import secure_filename
 
+import archive
+import cache
+import db
+import images
+import metrics
+import passwords
+import photometa
+import quotas
+import ratelimit
+import reaper
+import scrubber
+import search
+import storage
+import thumbnails
+from db import get_db
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+# Маршруты со своим лимитом размера тела: endpoint -> ключ настройки
+# (остальные ограничены MAX_CONTENT_LENGTH)
+BODY_LIMITS = {'add_photos': 'ALBUM_BATCH_MAX_SIZE'}
+
+
+class OblakoRequest(Request):
+    """Запрос с отдельным лимитом размера для пакетной загрузки фото"""
+
+    @property
+    def max_content_length(self):
+        if self.endpoint in BODY_LIMITS:
+            return app.config[BODY_LIMITS[self.endpoint]]
+        return super().max_content_length
+
+
 # Конфигурация приложения
 app = Flask(__name__)
+app.request_class = OblakoRequest
 app.config['SECRET_KEY'] = 'your-secret-key-change-in-production'
-app.config['UPLOAD_FOLDER'] = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads')
-app.config['ALBUMS_FOLDER'] = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'uploads', 'albums')
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16 MB максимальный размер файла
+app.config['DATABASE'] = os.path.join(BASE_DIR, 'oblako.db')
+app.config['UPLOAD_FOLDER'] = os.path.join(BASE_DIR, 'uploads')
+app.config['ALBUMS_FOLDER'] = os.path.join(BASE_DIR, 'static', 'uploads', 'albums')
+app.config['BLOBS_FOLDER'] = os.path.join(BASE_DIR, 'blobs')  # Содержимое файлов и фото (по SHA-256)
+app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16 MB максимальный размер одного запроса
+
+# Хранилище содержимого: 'local' - каталог BLOBS_FOLDER, 's3' - бакет
+# S3-совместимого хранилища (Amazon S3, MinIO). Без ключей доступа boto3 берёт
+# их из окружения (AWS_ACCESS_KEY_ID, профиль, роль инстанса)
+app.config['STORAGE_BACKEND'] = os.environ.get('OBLAKO_STORAGE', 'local')
+app.config['S3_BUCKET'] = os.environ.get('OBLAKO_S3_BUCKET')
+app.config['S3_PREFIX'] = os.environ.get('OBLAKO_S3_PREFIX', '')
+app.config['S3_ENDPOINT_URL'] = os.environ.get('OBLAKO_S3_ENDPOINT_URL') or None  # None - Amazon S3
+app.config['S3_REGION'] = os.environ.get('OBLAKO_S3_REGION') or None
+app.config['S3_ACCESS_KEY'] = os.environ.get('OBLAKO_S3_ACCESS_KEY') or None
+app.config['S3_SECRET_KEY'] = os.environ.get('OBLAKO_S3_SECRET_KEY') or None
+app.config['S3_PART_SIZE'] = storage.S3_PART_SIZE
+app.config['S3_URL_EXPIRES'] = 300  # Срок действия ссылок на скачивание (с)
+
+# Загрузка по частям (/api/uploads): размер части и предельный размер файла
+app.config['UPLOAD_CHUNK_SIZE'] = 8 * 1024 * 1024
+app.config['MAX_UPLOAD_SIZE'] = 20 * 1024 * 1024 * 1024  # 20 GB
+app.config['UPLOAD_SESSION_TTL'] = 24 * 60 * 60  # Незавершённые сессии удаляются через сутки
+app.config['UPLOAD_CHUNK_LEASE'] = 60 * 60  # Часть, принимаемая дольше (упал процесс), можно прислать заново
+
+# Квоты и ограничения загрузок: место на пользователя (байт, None - без квоты),
+# одновременных загрузок одного пользователя, скорость приёма на пользователя
+# (байт/с, None - без ограничения) и объём, принимаемый без задержки
+app.config['USER_QUOTA_BYTES'] = int(os.environ['OBLAKO_USER_QUOTA']) if os.environ.get('OBLAKO_USER_QUOTA') else None
+app.config['UPLOAD_CONCURRENCY'] = 4
+app.config['UPLOAD_RATE'] = int(os.environ['OBLAKO_UPLOAD_RATE']) if os.environ.get('OBLAKO_UPLOAD_RATE') else None
+app.config['UPLOAD_BURST'] = 16 * 1024 * 1024
+
+# Пакетная загрузка фото в альбом: файлов и байт в одном запросе, потоков записи
+app.config['ALBUM_BATCH_MAX_FILES'] = 50
+app.config['ALBUM_BATCH_MAX_SIZE'] = 256 * 1024 * 1024  # 256 MB
+app.config['ALBUM_BATCH_WORKERS'] = 4
+
+# Потоки фоновой генерации миниатюр
+app.config['THUMBNAIL_WORKERS'] = 2
+
+# Фоновое удаление файлов: файлов за пакет, пауза между пакетами и ожидание
+# при пустой очереди (с), наибольшая задержка повтора после ошибки (с)
+app.config['REAPER_BATCH_SIZE'] = 100
+app.config['REAPER_PAUSE'] = 0.5
+app.config['REAPER_IDLE_INTERVAL'] = 60
+app.config['REAPER_MAX_BACKOFF'] = 3600
+# Через сколько секунд записи, забранные упавшим процессом, снова берутся в работу
+app.config['REAPER_CLAIM_TIMEOUT'] = 600
+
+# Передача скачиваний фронтенд-серверу после проверки прав:
+# None - файл отдаёт Python, 'x-accel-redirect' - nginx, 'x-sendfile' - Apache/lighttpd
+app.config['DOWNLOAD_OFFLOAD'] = os.environ.get('OBLAKO_DOWNLOAD_OFFLOAD') or None
+# internal-локации nginx для каталогов хранилища (ключ - настройка с путём каталога)
+app.config['X_ACCEL_LOCATIONS'] = {
+    'BLOBS_FOLDER': '/_protected/blobs/',
+    'UPLOAD_FOLDER': '/_protected/uploads/',
+    'ALBUMS_FOLDER': '/_protected/albums/',
+}
+
+# Способ запуска процессов пулов (пароли, /img). Не fork: процесс к тому времени
+# многопоточный, и копия могла бы унаследовать чужую захваченную блокировку.
+# forkserver (spawn, где его нет) импортирует главный модуль заново -
+# запускающий скрипт должен быть защищён проверкой if __name__ == '__main__'
+app.config['PROCESS_START_METHOD'] = ('forkserver' if 'forkserver' in multiprocessing.get_all_start_methods()
+                                      else 'spawn')
+
+# Проверка паролей в пуле процессов: число процессов, заданий в очереди
+# (сверх - вход отклоняется с 503), ожидание результата (с). Хеши другим
+# методом или с другими параметрами пересчитываются при входе
+app.config['PASSWORD_WORKERS'] = 2
+app.config['PASSWORD_QUEUE_LIMIT'] = 32
+app.config['PASSWORD_TIMEOUT'] = 10
+app.config['PASSWORD_HASH_METHOD'] = os.environ.get('OBLAKO_PASSWORD_HASH', 'scrypt:32768:8:1')
+
+# Изображения по запросу (/img): допустимые размеры (запрошенный округляется
+# вверх до ближайшего), процессы обработки, заданий в очереди (сверх - 503),
+# ожидание результата (с), качество по умолчанию, дисковый кэш вариантов и
+# его объём (давно не запрошенные вытесняются), срок кэширования клиентом (с)
+app.config['IMG_SIZES'] = (64, 96, 128, 160, 240, 320, 480, 640, 800, 1024, 1280, 1600, 2048)
+app.config['IMG_WORKERS'] = 2
+app.config['IMG_QUEUE_LIMIT'] = 16
+app.config['IMG_TIMEOUT'] = 30
+app.config['IMG_DEFAULT_QUALITY'] = 80
+app.config['IMG_CACHE_FOLDER'] = os.environ.get('OBLAKO_IMG_CACHE') or os.path.join(BASE_DIR, 'img_cache')
+app.config['IMG_CACHE_MAX_BYTES'] = 1024 * 1024 * 1024  # 1 GB
+app.config['IMG_MAX_AGE'] = 24 * 60 * 60
+
+# Попытки входа с одного IP и под одним именем: в среднем в минуту и подряд
+app.config['LOGIN_RATE_PER_MINUTE'] = 10
+app.config['LOGIN_BURST'] = 10
+# Число обратных прокси перед приложением (за nginx - 1): адрес клиента
+# берётся из X-Forwarded-For, иначе все клиенты видны с адреса прокси
+app.config['PROXY_HOPS'] = int(os.environ.get('OBLAKO_PROXY_HOPS', 0))
+if app.config['PROXY_HOPS']:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_HOPS'])
+
+# Постраничный вывод файлов и фото
+app.config['PAGE_SIZE'] = 60
+app.config['MAX_PAGE_SIZE'] = 200
+
+# Срок кэширования неизменяемых адресов фото и миниатюр (с)
+app.config['IMMUTABLE_MAX_AGE'] = 365 * 24 * 60 * 60
+
+# Кэш пользователей для Flask-Login: записей и срок жизни в секундах
+app.config['USER_CACHE_SIZE'] = 1024
+app.config['USER_CACHE_TTL'] = 300
+# Хранить данные пользователя в подписанной сессии (запросы обходятся без базы)
+app.config['SESSION_USER_FIELDS'] = os.environ.get('OBLAKO_SESSION_USER_FIELDS', '') == '1'
+
+# Кэш отрисованных списков (файлы, альбомы, фото альбома): бэкенд ('memory',
+# 'null' или 'модуль:Класс'), число записей, бюджет памяти и срок жизни (с)
+app.config['FRAGMENT_CACHE_BACKEND'] = os.environ.get('OBLAKO_FRAGMENT_CACHE', 'memory')
+app.config['FRAGMENT_CACHE_SIZE'] = 2048
+app.config['FRAGMENT_CACHE_MAX_BYTES'] = 64 * 1024 * 1024
+app.config['FRAGMENT_CACHE_TTL'] = 60 * 60
+
+# Настройки SQLite (см. db.DEFAULT_CONFIG), переопределяются переменными окружения
+app.config['SQLITE_SYNCHRONOUS'] = os.environ.get('OBLAKO_SQLITE_SYNCHRONOUS', 'NORMAL')
+app.config['SQLITE_CACHE_SIZE'] = int(os.environ.get('OBLAKO_SQLITE_CACHE_SIZE', -16000))
+app.config['SQLITE_MMAP_SIZE'] = int(os.environ.get('OBLAKO_SQLITE_MMAP_SIZE', 64 * 1024 * 1024))
+app.config['SQLITE_BUSY_TIMEOUT'] = int(os.environ.get('OBLAKO_SQLITE_BUSY_TIMEOUT', 5000))
+db.init_app(app)
+
+# Метрики (см. metrics.DEFAULT_CONFIG): доступ к /metrics и порог журнала медленных запросов (с)
+app.config['METRICS_TOKEN'] = os.environ.get('OBLAKO_METRICS_TOKEN') or None
+app.config['METRICS_ALLOW_LOOPBACK'] = os.environ.get('OBLAKO_METRICS_ALLOW_LOOPBACK', '') == '1'
+app.config['SLOW_REQUEST_THRESHOLD'] = float(os.environ['OBLAKO_SLOW_REQUEST']) if os.environ.get('OBLAKO_SLOW_REQUEST') else None
+metrics.init_app(app)
 
 # Расширения файлов
 ALLOWED_EXTENSIONS = {
@@ -28,10 +200,278 @@ ALLOWED_EXTENSIONS = {
 
 ALLOWED_PHOTO_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
 
+IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp', 'webp'}
+DOC_EXTENSIONS = {'pdf', 'doc', 'docx', 'txt'}
+ARCHIVE_EXTENSIONS = {'zip', 'rar', '7z'}
+
+# Статистика хранилища пользователя
+USER_STATS_COLUMNS = '''
+    files_count, images_count, docs_count, archives_count, total_bytes, last_upload_at
+'''
+
+def _in_list(extensions):
+    """SQL-список расширений для IN (...)"""
+    return ', '.join("'{0}'".format(ext) for ext in sorted(extensions))
+
+def rebuild_user_stats(conn, user_id=None):
+    """Пересчёт user_stats по таблице files (для всех или одного пользователя)"""
+    where = '' if user_id is None else 'WHERE user_id = ?'
+    params = () if user_id is None else (user_id,)
+    conn.execute('DELETE FROM user_stats ' + where, params)
+    conn.execute('''
+        INSERT INTO user_stats (user_id, {columns})
+        SELECT user_id, COUNT(*),
+               SUM(file_type IN ({images})), SUM(file_type IN ({docs})), SUM(file_type IN ({archives})),
+               SUM(file_size), MAX(upload_date)
+        FROM files {where} GROUP BY user_id
+    '''.format(columns=USER_STATS_COLUMNS, images=_in_list(IMAGE_EXTENSIONS), docs=_in_list(DOC_EXTENSIONS),
+               archives=_in_list(ARCHIVE_EXTENSIONS), where=where), params)
+
+def update_user_stats(conn, user_id, file_type, file_size, delta=1):
+    """Изменение статистики при добавлении (delta=1) или удалении (delta=-1) файла
+
+    Выполняется в транзакции, которая добавляет или удаляет строку files.
+    """
+    conn.execute('''
+        INSERT INTO user_stats (user_id, {columns})
+        VALUES (?, ?, ?, ?, ?, ?, CASE WHEN ? > 0 THEN CURRENT_TIMESTAMP END)
+        ON CONFLICT (user_id) DO UPDATE SET
+            files_count = files_count + excluded.files_count,
+            images_count = images_count + excluded.images_count,
+            docs_count = docs_count + excluded.docs_count,
+            archives_count = archives_count + excluded.archives_count,
+            total_bytes = total_bytes + excluded.total_bytes,
+            last_upload_at = COALESCE(excluded.last_upload_at, last_upload_at)
+    '''.format(columns=USER_STATS_COLUMNS), (
+        user_id, delta,
+        delta if file_type in IMAGE_EXTENSIONS else 0,
+        delta if file_type in DOC_EXTENSIONS else 0,
+        delta if file_type in ARCHIVE_EXTENSIONS else 0,
+        delta * file_size, delta))
+
+def _create_user_stats(conn):
+    """Миграция 5: таблица статистики, заполненная по существующим файлам"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_stats (
+            user_id INTEGER PRIMARY KEY,
+            files_count INTEGER NOT NULL DEFAULT 0,
+            images_count INTEGER NOT NULL DEFAULT 0,
+            docs_count INTEGER NOT NULL DEFAULT 0,
+            archives_count INTEGER NOT NULL DEFAULT 0,
+            total_bytes INTEGER NOT NULL DEFAULT 0,
+            last_upload_at TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    rebuild_user_stats(conn)
+
+# Сводные данные альбомов (количество, обложка, объём, время изменения)
+# поддерживаются триггерами на photos в той же транзакции, что и изменение фото
+ALBUM_TRIGGERS = '''
+    CREATE TRIGGER IF NOT EXISTS photos_album_insert AFTER INSERT ON photos BEGIN
+        UPDATE albums SET
+            photo_count = photo_count + 1,
+            total_bytes = total_bytes + NEW.file_size,
+            cover_photo = COALESCE(cover_photo, NEW.filename),
+            updated_at = CURRENT_TIMESTAMP
+        WHERE id = NEW.album_id;
+    END;
+    CREATE TRIGGER IF NOT EXISTS photos_album_delete AFTER DELETE ON photos BEGIN
+        UPDATE albums SET
+            photo_count = photo_count - 1,
+            total_bytes = total_bytes - OLD.file_size,
+            cover_photo = CASE WHEN cover_photo = OLD.filename THEN (
+                SELECT filename FROM photos WHERE album_id = OLD.album_id ORDER BY created_at, id LIMIT 1
+            ) ELSE cover_photo END,
+            updated_at = CURRENT_TIMESTAMP
+        WHERE id = OLD.album_id;
+    END;
+'''
+
+def rebuild_album_stats(conn, album_id=None):
+    """Пересчёт сводных данных альбомов по таблице photos (всех или одного)
+
+    Обложка сохраняется, если такое фото есть в альбоме, иначе - самое раннее фото.
+    """
+    where = '' if album_id is None else 'WHERE id = ?'
+    params = () if album_id is None else (album_id,)
+    conn.execute('''
+        UPDATE albums SET
+            photo_count = (SELECT COUNT(*) FROM photos WHERE album_id = albums.id),
+            total_bytes = (SELECT COALESCE(SUM(file_size), 0) FROM photos WHERE album_id = albums.id),
+            cover_photo = COALESCE(
+                (SELECT filename FROM photos WHERE album_id = albums.id AND filename = albums.cover_photo),
+                (SELECT filename FROM photos WHERE album_id = albums.id ORDER BY created_at, id LIMIT 1)
+            ),
+            updated_at = COALESCE(updated_at,
+                (SELECT MAX(created_at) FROM photos WHERE album_id = albums.id), created_at)
+        {0}
+    '''.format(where), params)
+
+def find_inconsistent_albums(conn):
+    """ID альбомов, у которых сводные данные расходятся с таблицей photos"""
+    rows = conn.execute('''
+        SELECT a.id FROM albums a
+        LEFT JOIN (
+            SELECT album_id, COUNT(*) AS n, SUM(file_size) AS bytes FROM photos GROUP BY album_id
+        ) p ON p.album_id = a.id
+        WHERE a.photo_count IS NOT COALESCE(p.n, 0)
+           OR a.total_bytes IS NOT COALESCE(p.bytes, 0)
+           OR (a.cover_photo IS NULL) <> (p.n IS NULL)
+           OR (a.cover_photo IS NOT NULL AND NOT EXISTS (
+                SELECT 1 FROM photos WHERE album_id = a.id AND filename = a.cover_photo))
+        ORDER BY a.id
+    ''').fetchall()
+    return [row[0] for row in rows]
+
+def _create_album_aggregates(conn):
+    """Миграция 7: размер фото, объём и время изменения альбома, триггеры"""
+    conn.execute('ALTER TABLE photos ADD COLUMN file_size INTEGER NOT NULL DEFAULT 0')
+    conn.execute('ALTER TABLE albums ADD COLUMN total_bytes INTEGER NOT NULL DEFAULT 0')
+    conn.execute('ALTER TABLE albums ADD COLUMN updated_at TIMESTAMP')
+    conn.execute('''
+        UPDATE photos SET file_size = (SELECT size FROM blobs WHERE hash = photos.blob_hash)
+        WHERE blob_hash IS NOT NULL
+    ''')
+    # Старые фото вне хранилища блобов: размер берётся с диска
+    legacy = conn.execute('SELECT id, album_id, filename FROM photos WHERE blob_hash IS NULL').fetchall()
+    for photo_id, album_id, filename in legacy:
+        path = os.path.join(app.config['ALBUMS_FOLDER'], str(album_id), filename)
+        if os.path.exists(path):
+            conn.execute('UPDATE photos SET file_size = ? WHERE id = ?', (os.path.getsize(path), photo_id))
+    for statement in db.split_statements(ALBUM_TRIGGERS):
+        conn.execute(statement)
+    rebuild_album_stats(conn)
+
+# Версия данных пользователя растёт при любом изменении того, что он видит в
+# списках; по ней отрисованные фрагменты в кэше становятся неактуальными.
+# Фото меняют строку альбома своими триггерами, поэтому отдельные триггеры
+# на photos не нужны
+DATA_VERSION_TRIGGERS = '''
+    CREATE TRIGGER IF NOT EXISTS files_version_insert AFTER INSERT ON files BEGIN
+        UPDATE users SET data_version = data_version + 1 WHERE id = NEW.user_id;
+    END;
+    CREATE TRIGGER IF NOT EXISTS files_version_delete AFTER DELETE ON files BEGIN
+        UPDATE users SET data_version = data_version + 1 WHERE id = OLD.user_id;
+    END;
+    CREATE TRIGGER IF NOT EXISTS albums_version_insert AFTER INSERT ON albums BEGIN
+        UPDATE users SET data_version = data_version + 1 WHERE id = NEW.user_id;
+    END;
+    CREATE TRIGGER IF NOT EXISTS albums_version_update AFTER UPDATE ON albums BEGIN
+        UPDATE users SET data_version = data_version + 1 WHERE id = NEW.user_id;
+    END;
+    CREATE TRIGGER IF NOT EXISTS albums_version_delete AFTER DELETE ON albums BEGIN
+        UPDATE users SET data_version = data_version + 1 WHERE id = OLD.user_id;
+    END;
+    CREATE TRIGGER IF NOT EXISTS blobs_version_thumb AFTER UPDATE OF thumb_status ON blobs BEGIN
+        UPDATE users SET data_version = data_version + 1 WHERE id IN (
+            SELECT user_id FROM files WHERE blob_hash = NEW.hash
+            UNION SELECT user_id FROM photos WHERE blob_hash = NEW.hash
+        );
+    END;
+'''
+
+def _create_data_versions(conn):
+    """Миграция 8: версия данных пользователя для кэша фрагментов"""
+    conn.execute('ALTER TABLE users ADD COLUMN data_version INTEGER NOT NULL DEFAULT 0')
+    for statement in db.split_statements(DATA_VERSION_TRIGGERS):
+        conn.execute(statement)
+
+# Миграции схемы: (версия, SQL). Применяются по порядку поверх базовых таблиц,
+# номер последней применённой хранится в PRAGMA user_version
+MIGRATIONS = [
+    (1, '''
+        CREATE INDEX IF NOT EXISTS idx_files_user_date ON files (user_id, upload_date);
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_files_filename ON files (filename);
+        CREATE INDEX IF NOT EXISTS idx_albums_user_created ON albums (user_id, created_at);
+        CREATE INDEX IF NOT EXISTS idx_photos_album_created ON photos (album_id, created_at);
+    '''),
+    (2, '''
+        ALTER TABLE files ADD COLUMN checksum TEXT;
+        CREATE TABLE IF NOT EXISTS upload_sessions (
+            id TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            original_name TEXT NOT NULL,
+            file_type TEXT NOT NULL,
+            total_size INTEGER NOT NULL,
+            received INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        );
+        CREATE INDEX IF NOT EXISTS idx_upload_sessions_updated ON upload_sessions (updated_at);
+    '''),
+    (3, '''
+        CREATE TABLE IF NOT EXISTS blobs (
+            hash TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            refcount INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        ALTER TABLE files ADD COLUMN blob_hash TEXT;
+        ALTER TABLE photos ADD COLUMN blob_hash TEXT;
+        CREATE INDEX IF NOT EXISTS idx_files_blob ON files (blob_hash);
+        CREATE INDEX IF NOT EXISTS idx_photos_blob ON photos (blob_hash);
+        CREATE INDEX IF NOT EXISTS idx_photos_album_filename ON photos (album_id, filename);
+    '''),
+    (4, '''
+        ALTER TABLE blobs ADD COLUMN thumb_status TEXT;
+    '''),
+    (5, _create_user_stats),
+    (6, '''
+        CREATE TABLE IF NOT EXISTS pending_deletions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            blob_hash TEXT,
+            path TEXT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            not_before TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        CREATE INDEX IF NOT EXISTS idx_pending_deletions_due ON pending_deletions (not_before);
+    '''),
+    (7, _create_album_aggregates),
+    (8, _create_data_versions),
+    (9, '''
+        ALTER TABLE photos ADD COLUMN taken_at TIMESTAMP;
+        ALTER TABLE photos ADD COLUMN width INTEGER;
+        ALTER TABLE photos ADD COLUMN height INTEGER;
+        ALTER TABLE photos ADD COLUMN orientation INTEGER;
+        ALTER TABLE photos ADD COLUMN camera_model TEXT;
+        ALTER TABLE photos ADD COLUMN meta_status TEXT;
+        CREATE INDEX IF NOT EXISTS idx_photos_album_taken ON photos (album_id, COALESCE(taken_at, created_at), id);
+        CREATE INDEX IF NOT EXISTS idx_photos_meta_pending ON photos (id) WHERE meta_status IS NULL;
+    '''),
+    (10, search.create_index),
+    (11, '''
+        CREATE INDEX IF NOT EXISTS idx_upload_sessions_user ON upload_sessions (user_id);
+    '''),
+    (12, '''
+        CREATE TABLE IF NOT EXISTS scrub_checkpoints (
+            phase TEXT PRIMARY KEY,
+            position TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+    '''),
+    (13, '''
+        ALTER TABLE pending_deletions ADD COLUMN claimed_at TIMESTAMP;
+        CREATE INDEX IF NOT EXISTS idx_pending_deletions_blob ON pending_deletions (blob_hash)
+            WHERE blob_hash IS NOT NULL;
+        CREATE TABLE IF NOT EXISTS blob_deletions (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            epoch INTEGER NOT NULL DEFAULT 0
+        );
+        INSERT OR IGNORE INTO blob_deletions (id, epoch) VALUES (1, 0);
+    '''),
+    (14, '''
+        ALTER TABLE upload_sessions ADD COLUMN writer TEXT;
+    '''),
+]
+
 # Инициализация базы данных
 def init_db():
     """Инициализация базы данных SQLite"""
-    conn = sqlite3.connect('oblako.db')
+    conn = db.connect(app.config)
     cursor = conn.cursor()
     
     # Таблица пользователей
@@ -89,6 +529,9 @@ def init_db():
     ''')
     
     conn.commit()
+    
+    # Обновление схемы существующей базы
+    db.migrate(conn, MIGRATIONS)
     conn.close()
 
 # Проверка расширения файла
@@ -100,6 +543,489 @@ def allowed_photo(filename):
     """Проверка допустимости расширения фото"""
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_PHOTO_EXTENSIONS
 
+def make_stored_filename(original_name):
+    """Уникальное имя файла в хранилище"""
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S_')
+    return timestamp + str(uuid.uuid4().hex[:8]) + '_' + original_name
+
+# Хранилище содержимого
+def get_blob_store():
+    """Контентно-адресуемое хранилище блобов"""
+    return storage.get_blob_store(app)
+
+def legacy_storage(folder):
+    """Старое хранилище: файлы под своими именами в UPLOAD_FOLDER или ALBUMS_FOLDER/<album_id>"""
+    return storage.LocalBackend(app.config[folder])
+
+def stored_file(filename, blob_hash):
+    """(бэкенд, ключ) содержимого файла"""
+    if blob_hash:
+        return get_blob_store().location(blob_hash)
+    return legacy_storage('UPLOAD_FOLDER'), filename
+
+def stored_photo(album_id, filename, blob_hash):
+    """(бэкенд, ключ) содержимого фото"""
+    if blob_hash:
+        return get_blob_store().location(blob_hash)
+    return legacy_storage('ALBUMS_FOLDER'), '{0}/{1}'.format(album_id, filename)
+
+def photo_urls(album_id, filename, blob_hash, thumb_status):
+    """Адреса оригинала, миниатюры и превью фото; пока миниатюры не готовы - оригинал
+
+    Адреса неизменяемые: v - ETag содержимого (см. immutable_url).
+    """
+    version = blob_hash or filename
+    url = url_for('album_photo', album_id=album_id, filename=filename, v=version)
+    if thumb_status != 'ready':
+        return url, url, url
+    return (url,
+            url_for('album_photo', album_id=album_id, filename=filename, kind='thumb', v=version + '.thumb'),
+            url_for('album_photo', album_id=album_id, filename=filename, kind='preview', v=version + '.preview'))
+
+def photo_json(conn, album_id, photo_id, filename, original_name, blob_hash):
+    """Описание загруженного фото для ответа JSON"""
+    thumb_status = conn.execute('SELECT thumb_status FROM blobs WHERE hash = ?', (blob_hash,)).fetchone()[0]
+    photo_url, thumb_url, preview_url = photo_urls(album_id, filename, blob_hash, thumb_status)
+    return {
+        'id': photo_id,
+        'filename': filename,
+        'original_name': original_name,
+        'url': photo_url,
+        'thumbnail': thumb_url,
+        'preview': preview_url
+    }
+
+# Отдача файлов
+def offload_location(path):
+    """Внутренний URI nginx для файла хранилища или None, если каталог не сопоставлен"""
+    for key, location in app.config['X_ACCEL_LOCATIONS'].items():
+        root = os.path.join(app.config[key], '')
+        if path.startswith(root):
+            return location + quote(os.path.relpath(path, root).replace(os.sep, '/'))
+    return None
+
+def send_stored_file(location, download_name=None, etag=None):
+    """Отдача объекта хранилища с условными запросами и Range
+
+    location - пара (бэкенд, ключ). etag - SHA-256 содержимого: сильный
+    ETag, по которому клиенты докачивают файл (If-Range) и получают 304.
+    В режиме DOWNLOAD_OFFLOAD Python только проверяет права и отвечает на
+    условный запрос, байты передаёт фронтенд (sendfile, Range - на его
+    стороне). В ASGI-режиме роль фронтенда выполняет asgi.py: он передаёт
+    режим через environ['oblako.offload']. Объекты удалённого хранилища
+    отдаёт само хранилище (send_remote_file).
+    """
+    backend, key = location
+    path = backend.local_path(key)
+    if path is None:
+        return send_remote_file(backend, key, download_name, etag)
+    if not os.path.isfile(path):
+        abort(404)
+    
+    offload = app.config['DOWNLOAD_OFFLOAD'] or request.environ.get('oblako.offload')
+    internal_uri = None
+    if offload == 'x-accel-redirect':
+        internal_uri = offload_location(path)
+    elif offload == 'x-sendfile':
+        internal_uri = path
+    
+    if internal_uri is None:
+        return send_file(path, download_name=download_name, etag=etag or True, conditional=True)
+    
+    # Заголовки (тип, имя, ETag) формирует send_file, тело отбрасывается
+    response = send_file(path, download_name=download_name, etag=etag or True, conditional=False)
+    response.close()
+    response.response = []
+    response.direct_passthrough = False
+    del response.headers['Content-Length']
+    header = 'X-Accel-Redirect' if offload == 'x-accel-redirect' else 'X-Sendfile'
+    response.headers[header] = internal_uri
+    response = response.make_conditional(request)
+    if response.status_code != 200:
+        # Иначе фронтенд отдал бы вместо 304 сам файл
+        del response.headers[header]
+    return response
+
+def send_remote_file(backend, key, download_name=None, etag=None):
+    """Перенаправление на временную подписанную ссылку удалённого хранилища
+
+    Права уже проверены; байты, Range и докачку отдаёт хранилище. Условный
+    запрос с известным ETag обрабатывается здесь (304) без обращения к нему.
+    """
+    if etag and request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+        response.set_etag(etag)
+        return response
+    response = redirect(backend.url(key, download_name=download_name or key.rsplit('/', 1)[-1]))
+    # Ссылка временная - ответ не кэшируется
+    response.cache_control.no_store = True
+    return response
+
+def send_zip(entries, download_name):
+    """Потоковая отдача ZIP-архива из троек (имя в архиве, бэкенд, ключ)"""
+    ascii_name = secure_filename(download_name) or 'archive.zip'
+    response = Response(archive.stream_zip(entries), mimetype='application/zip')
+    response.headers['Content-Disposition'] = "attachment; filename=\"{0}\"; filename*=UTF-8''{1}".format(
+        ascii_name, quote(download_name))
+    # Архив не буферизуется фронтенд-сервером
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+def immutable_url(view):
+    """Кэширование ответов по неизменяемым адресам
+
+    Параметр v в адресе - ETag содержимого, которое по этому адресу никогда
+    не меняется. Если клиент присылает его в If-None-Match, ответ 304 отдаётся
+    сразу, без загрузки пользователя и запросов к базе: содержимое у клиента
+    уже есть. Ответ с совпавшим ETag помечается как immutable на год.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        version = request.args.get('v')
+        if version and request.if_none_match.contains(version):
+            response = app.response_class(status=304)
+            response.set_etag(version)
+            response.cache_control.private = True
+            response.cache_control.max_age = app.config['IMMUTABLE_MAX_AGE']
+            response.cache_control.immutable = True
+            return response
+        response = view(*args, **kwargs)
+        if version and response.status_code in (200, 206, 304) and response.get_etag()[0] == version:
+            response.cache_control.no_cache = None
+            response.cache_control.private = True
+            response.cache_control.max_age = app.config['IMMUTABLE_MAX_AGE']
+            response.cache_control.immutable = True
+        return response
+    return wrapper
+
+# Кэш отрисованных фрагментов страниц
+fragment_cache = cache.create(app.config['FRAGMENT_CACHE_BACKEND'],
+                              maxsize=app.config['FRAGMENT_CACHE_SIZE'],
+                              ttl=app.config['FRAGMENT_CACHE_TTL'],
+                              maxbytes=app.config['FRAGMENT_CACHE_MAX_BYTES'])
+
+def get_data_version(user_id):
+    """Текущая версия данных пользователя"""
+    row = get_db().execute('SELECT data_version FROM users WHERE id = ?', (user_id,)).fetchone()
+    return row[0] if row else 0
+
+def cached_fragment(name, build, *key):
+    """Данные фрагмента страницы из кэша или от build()
+
+    Ключ включает пользователя и версию его данных: после загрузки или
+    удаления версия меняется, и старые записи просто вытесняются. Результат
+    None (например, альбом не найден) не кэшируется.
+    """
+    cache_key = (name, current_user.id, get_data_version(current_user.id)) + key
+    data = fragment_cache.get(cache_key)
+    if data is None:
+        data = build()
+        if data is not None:
+            fragment_cache.set(cache_key, data)
+    return data
+
+# Постраничный вывод (keyset): курсор - позиция последнего показанного элемента
+def encode_cursor(sort_value, row_id):
+    """Курсор следующей страницы"""
+    raw = '{0}|{1}'.format(sort_value, row_id)
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+    """Позиция (значение сортировки, id) из курсора; None - первая страница"""
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8')
+        sort_value, row_id = raw.rsplit('|', 1)
+        return sort_value, int(row_id)
+    except ValueError:
+        abort(400)
+
+def get_page_size():
+    """Размер страницы из ?limit= в пределах MAX_PAGE_SIZE"""
+    limit = request.args.get('limit', app.config['PAGE_SIZE'], type=int)
+    return max(1, min(limit, app.config['MAX_PAGE_SIZE']))
+
+def file_thumbnail_url(filename, file_type, blob_hash, thumb_status):
+    """Миниатюра файла-изображения, а пока она не готова - сам файл; None для прочих"""
+    if file_type not in IMAGE_EXTENSIONS:
+        return None
+    if thumb_status == 'ready':
+        return url_for('file_thumbnail', filename=filename, v=blob_hash + '.thumb')
+    return url_for('uploaded_file', filename=filename)
+
+def fetch_files_page(user_id, cursor, limit):
+    """Страница файлов пользователя (новые сверху) и курсор следующей"""
+    query = '''
+        SELECT f.id, f.filename, f.original_name, f.file_type, f.file_size, f.upload_date, b.thumb_status,
+               f.blob_hash
+        FROM files f LEFT JOIN blobs b ON b.hash = f.blob_hash
+        WHERE f.user_id = ?
+    '''
+    params = [user_id]
+    position = decode_cursor(cursor)
+    if position:
+        query += ' AND (f.upload_date, f.id) < (?, ?)'
+        params.extend(position)
+    query += ' ORDER BY f.upload_date DESC, f.id DESC LIMIT ?'
+    params.append(limit + 1)
+    rows = get_db().execute(query, params).fetchall()
+    
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1][5], rows[-1][0])
+    
+    files_list = []
+    for f in rows:
+        files_list.append({
+            'id': f[0],
+            'filename': f[1],
+            'original_name': f[2],
+            'file_type': f[3],
+            'file_size': f[4],
+            'upload_date': f[5],
+            'thumbnail': file_thumbnail_url(f[1], f[3], f[7], f[6])
+        })
+    return files_list, next_cursor
+
+# Сортировка фото альбома: ключ и направление. Фото без даты съёмки
+# сортируются по дате добавления (индекс idx_photos_album_taken)
+PHOTO_SORTS = {
+    'added': ('p.created_at', 'DESC'),
+    'taken': ('COALESCE(p.taken_at, p.created_at)', 'DESC'),
+    'taken_asc': ('COALESCE(p.taken_at, p.created_at)', 'ASC'),
+}
+
+def get_photo_filters():
+    """Сортировка и период съёмки из ?sort=&taken_from=&taken_to= (даты ГГГГ-ММ-ДД)"""
+    sort = request.args.get('sort') or 'added'
+    if sort not in PHOTO_SORTS:
+        abort(400)
+    filters = {'sort': sort}
+    for name in ('taken_from', 'taken_to'):
+        value = request.args.get(name)
+        if value:
+            try:
+                filters[name] = datetime.strptime(value, '%Y-%m-%d').strftime('%Y-%m-%d')
+            except ValueError:
+                abort(400)
+    return filters
+
+# Изображения по запросу
+def get_image_cache():
+    """Дисковый кэш вариантов изображений (общий для потоков процесса)"""
+    image_cache = app.extensions.get('oblako.images')
+    if image_cache is None:
+        image_cache = app.extensions['oblako.images'] = images.DiskCache(
+            app.config['IMG_CACHE_FOLDER'], app.config['IMG_CACHE_MAX_BYTES'])
+    return image_cache
+
+def get_image_params():
+    """Рамка, формат и качество из ?w=&h=&fmt=&q=
+
+    Размеры округляются вверх до IMG_SIZES, качество - до шага 5: число
+    вариантов одного изображения в кэше ограничено. Без fmt формат выбирается
+    по заголовку Accept (AVIF, WebP, иначе JPEG); третий элемент - выбран ли
+    он так (тогда ответ зависит от Accept).
+    """
+    sizes = app.config['IMG_SIZES']
+    width, height = request.args.get('w', type=int), request.args.get('h', type=int)
+    if (width is None and height is None) or any(v is not None and v <= 0 for v in (width, height)):
+        abort(400)
+    width = images.snap(width, sizes) if width else None
+    height = images.snap(height, sizes) if height else None
+    
+    supported = images.supported_formats()
+    fmt = request.args.get('fmt')
+    negotiated = not fmt
+    if fmt == 'jpg':
+        fmt = 'jpeg'
+    if negotiated:
+        accepted = set(request.accept_mimetypes.values())
+        fmt = next((name for name in images.PREFERRED
+                    if name in supported and images.FORMATS[name][1] in accepted), 'jpeg')
+    elif fmt not in supported:
+        abort(400)
+    
+    quality = request.args.get('q', app.config['IMG_DEFAULT_QUALITY'], type=int)
+    return width, height, fmt, images.snap_quality(quality), negotiated
+
+def fetch_photos_page(album_id, cursor, limit, sort='added', taken_from=None, taken_to=None):
+    """Страница фотографий альбома и курсор следующей
+
+    sort - ключ PHOTO_SORTS; taken_from/taken_to (включительно) оставляют
+    только фото с датой съёмки в этом периоде.
+    """
+    key, direction = PHOTO_SORTS[sort]
+    query = '''
+        SELECT p.id, p.filename, p.original_name, p.description, p.created_at, b.thumb_status, p.blob_hash,
+               p.taken_at, p.width, p.height, p.camera_model, {0}
+        FROM photos p LEFT JOIN blobs b ON b.hash = p.blob_hash
+        WHERE p.album_id = ?
+    '''.format(key)
+    params = [album_id]
+    if taken_from or taken_to:
+        # Условие на выражение индекса: диапазон читается по idx_photos_album_taken
+        query += ' AND p.taken_at IS NOT NULL'
+        if taken_from:
+            query += ' AND COALESCE(p.taken_at, p.created_at) >= ?'
+            params.append(taken_from)
+        if taken_to:
+            query += " AND COALESCE(p.taken_at, p.created_at) < date(?, '+1 day')"
+            params.append(taken_to)
+    position = decode_cursor(cursor)
+    if position:
+        query += ' AND ({0}, p.id) {1} (?, ?)'.format(key, '<' if direction == 'DESC' else '>')
+        params.extend(position)
+    query += ' ORDER BY {0} {1}, p.id {1} LIMIT ?'.format(key, direction)
+    params.append(limit + 1)
+    rows = get_db().execute(query, params).fetchall()
+    
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1][11], rows[-1][0])
+    
+    photos_data = []
+    for p in rows:
+        photo_url, thumb_url, preview_url = photo_urls(album_id, p[1], p[6], p[5])
+        photos_data.append({
+            'id': p[0],
+            'filename': p[1],
+            'original_name': p[2],
+            'description': p[3],
+            'created_at': p[4],
+            'taken_at': p[7],
+            'width': p[8],
+            'height': p[9],
+            'camera_model': p[10],
+            'url': photo_url,
+            'thumbnail': thumb_url,
+            'preview': preview_url
+        })
+    return photos_data, next_cursor
+
+def fetch_search_page(user_id, text, cursor, limit):
+    """Страница результатов поиска (самые релевантные сверху) и курсор следующей"""
+    words = search.terms(text)
+    if not words:
+        return [], None
+    position = decode_cursor(cursor)
+    if position:
+        # Пустая оценка - курсор среди совпадений за окном ранжирования
+        try:
+            position = (float(position[0]) if position[0] else None, position[1])
+        except ValueError:
+            abort(400)
+    conn = get_db()
+    rows = search.search(conn, search.match_query(user_id, words), position, limit + 1)
+    
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        score = rows[-1][1]
+        next_cursor = encode_cursor('' if score is None else repr(score), rows[-1][0])
+    
+    # Сведения о найденном - один запрос на каждый вид записей
+    ids = {'file': [], 'album': [], 'photo': []}
+    for rowid, _ in rows:
+        kind, item_id = search.split_rowid(rowid)
+        ids[kind].append(item_id)
+    
+    def select(sql, kind):
+        # Владелец проверяется после выборки: с условием на user_id SQLite
+        # предпочёл бы индекс пользователя и перебрал бы все его записи
+        if not ids[kind]:
+            return []
+        rows = conn.execute(sql.format(', '.join('?' * len(ids[kind]))), ids[kind]).fetchall()
+        return [row for row in rows if row[-1] == user_id]
+    
+    items = {}
+    for f in select('''
+        SELECT f.id, f.filename, f.original_name, f.file_type, f.file_size, b.thumb_status, f.blob_hash, f.user_id
+        FROM files f LEFT JOIN blobs b ON b.hash = f.blob_hash
+        WHERE f.id IN ({0})
+    ''', 'file'):
+        items[('file', f[0])] = {
+            'name': search.highlight(f[2], words),
+            'url': url_for('uploaded_file', filename=f[1]),
+            'thumbnail': file_thumbnail_url(f[1], f[3], f[6], f[5]),
+            'file_type': f[3],
+            'file_size': f[4]
+        }
+    for a in select('''
+        SELECT a.id, a.title, a.description, a.cover_photo, a.photo_count, b.thumb_status, p.blob_hash, a.user_id
+        FROM albums a
+        LEFT JOIN photos p ON p.album_id = a.id AND p.filename = a.cover_photo
+        LEFT JOIN blobs b ON b.hash = p.blob_hash
+        WHERE a.id IN ({0})
+    ''', 'album'):
+        items[('album', a[0])] = {
+            'name': search.highlight(a[1], words),
+            'snippet': search.snippet(a[2], words),
+            'url': url_for('view_album', album_id=a[0]),
+            'thumbnail': photo_urls(a[0], a[3], a[6], a[5])[1] if a[3] else None,
+            'photo_count': a[4]
+        }
+    for p in select('''
+        SELECT p.id, p.album_id, p.filename, p.original_name, p.description, b.thumb_status, p.blob_hash, a.title,
+               p.user_id
+        FROM photos p JOIN albums a ON a.id = p.album_id
+        LEFT JOIN blobs b ON b.hash = p.blob_hash
+        WHERE p.id IN ({0})
+    ''', 'photo'):
+        photo_url, thumb_url, _ = photo_urls(p[1], p[2], p[6], p[5])
+        items[('photo', p[0])] = {
+            'name': search.highlight(p[3], words),
+            'snippet': search.snippet(p[4], words),
+            'url': photo_url,
+            'thumbnail': thumb_url,
+            'album_url': url_for('view_album', album_id=p[1]),
+            'album_title': p[7]
+        }
+    
+    results = []
+    for rowid, _ in rows:
+        kind, item_id = search.split_rowid(rowid)
+        item = items.get((kind, item_id))
+        if item is not None:
+            item.update(kind=kind, id=item_id)
+            results.append(item)
+    return results, next_cursor
+
+def release_stored_file(conn, location, blob_hash):
+    """Снятие ссылки на блоб или старый файл; удаление из хранилища - в фоне (reaper)
+
+    После коммита транзакции нужно вызвать reaper.wake(app).
+    """
+    if blob_hash:
+        if get_blob_store().release(conn, blob_hash):
+            reaper.enqueue_blob(conn, blob_hash)
+    else:
+        backend, key = location
+        reaper.enqueue_path(conn, backend.local_path(key))
+
+def discard_new_blobs(conn, blob_hashes):
+    """Постановка в очередь удаления объектов новых блобов после отката транзакции
+
+    add_ref уже перенёс содержимое в хранилище, а запись в blobs откатилась.
+    reaper удалит объект, только если запись так и не появилась. Если не
+    удалась и эта транзакция, объект найдёт flask scrub.
+    """
+    if not blob_hashes:
+        return
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        for blob_hash in set(blob_hashes):
+            reaper.enqueue_blob(conn, blob_hash)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        app.logger.exception('Не удалось поставить в очередь удаления блобы %s', ', '.join(blob_hashes))
+        return
+    reaper.wake(app)
+
 # Класс пользователя для Flask-Login
 class User(UserMixin):
     def __init__(self, id, username, email):
@@ -112,19 +1038,167 @@ login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
 
+# Пользователи, недавно загруженные из базы: user_id -> (id, username, email, время чтения)
+user_cache = cache.LRUCache(app.config['USER_CACHE_SIZE'], app.config['USER_CACHE_TTL'])
+
+def remember_user(user, loaded_at=None):
+    """Сохранение данных пользователя в сессии (режим SESSION_USER_FIELDS)
+
+    loaded_at - когда данные прочитаны из базы. Срок копии в сессии
+    отсчитывается от него, а не от момента копирования из user_cache,
+    иначе устаревшие данные могли бы прожить до 2 * USER_CACHE_TTL.
+    """
+    if app.config['SESSION_USER_FIELDS']:
+        session['_user'] = [user.id, user.username, user.email, int(loaded_at or time.time())]
+
+def invalidate_user(user_id):
+    """Сброс кэша пользователя; вызывается при каждом изменении записи в users
+
+    Копия в сессии другого клиента обновится сама по истечении USER_CACHE_TTL.
+    """
+    user_cache.delete(str(user_id))
+    cached = session.get('_user')
+    if cached and str(cached[0]) == str(user_id):
+        session.pop('_user')
+
 @login_manager.user_loader
 def load_user(user_id):
-    """Загрузка пользователя по ID"""
-    conn = sqlite3.connect('oblako.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT id, username, email FROM users WHERE id = ?', (user_id,))
-    user_data = cursor.fetchone()
-    conn.close()
+    """Загрузка пользователя по ID: из сессии, из кэша или из базы"""
+    if app.config['SESSION_USER_FIELDS']:
+        cached = session.get('_user')
+        if (cached and str(cached[0]) == user_id
+                and time.time() - cached[3] < app.config['USER_CACHE_TTL']):
+            return User(cached[0], cached[1], cached[2])
+    
+    user_data = user_cache.get(user_id)
+    if user_data is None:
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute('SELECT id, username, email FROM users WHERE id = ?', (user_id,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        user_data = tuple(row) + (time.time(),)
+        user_cache.set(user_id, user_data)
     
-    if user_data:
-        return User(user_data[0], user_data[1], user_data[2])
+    user = User(user_data[0], user_data[1], user_data[2])
+    remember_user(user, user_data[3])
+    return user
+
+# Попытки входа по IP-адресам и именам пользователей
+login_throttle = ratelimit.RateLimiter(app.config['LOGIN_RATE_PER_MINUTE'] / 60, app.config['LOGIN_BURST'])
+
+def login_refused(message, status, retry_after):
+    """Страница входа с отказом (429 - частые попытки, 503 - перегрузка)"""
+    flash(message, 'error')
+    response = app.make_response((render_template('index.html', mode='login'), status))
+    response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+    return response
+
+# Ограничения загрузок
+# Маршруты, принимающие содержимое файлов в теле запроса
+UPLOAD_ENDPOINTS = {'upload', 'add_photo', 'add_photos', 'upload_session_chunk'}
+# Запас на заголовки частей multipart/form-data сверх размера файлов
+UPLOAD_FORM_OVERHEAD = 64 * 1024
+
+upload_slots = quotas.UploadSlots(app.config['UPLOAD_CONCURRENCY'])
+upload_throttle = (ratelimit.RateLimiter(app.config['UPLOAD_RATE'], app.config['UPLOAD_BURST'])
+                   if app.config['UPLOAD_RATE'] else None)
+
+def upload_refused(message, status, retry_after=None):
+    """Отказ в загрузке: страница загрузки для формы, JSON - для остальных маршрутов"""
+    if request.endpoint == 'upload':
+        flash(message, 'error')
+        response = app.make_response((render_template('upload.html'), status))
+    else:
+        response = jsonify({'error': message})
+        response.status_code = status
+    if retry_after:
+        response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+    return response
+
+def check_quota(conn, user_id, size):
+    """Окончательная проверка квоты в транзакции записи, перед добавлением строки"""
+    left = quotas.remaining(conn, user_id, app.config['USER_QUOTA_BYTES'])
+    if left is not None and size > left:
+        raise quotas.QuotaExceeded()
+
+def is_upload_request():
+    """Запрос пользователя, несущий содержимое файлов в теле"""
+    return (request.endpoint in UPLOAD_ENDPOINTS and request.method in ('POST', 'PUT')
+            and current_user.is_authenticated)
+
+def upload_body_limit():
+    """Наибольший размер тела текущей загрузки по квоте (None - без ограничения)
+
+    Для частей загрузки по частям место уже зарезервировано при создании
+    сессии. Используется и ASGI-адаптером, который принимает тело до вызова
+    маршрута.
+    """
+    if not is_upload_request() or request.endpoint == 'upload_session_chunk':
+        return None
+    left = quotas.remaining(get_db(), current_user.id, app.config['USER_QUOTA_BYTES'])
+    return None if left is None else left + UPLOAD_FORM_OVERHEAD
+
+@app.before_request
+def limit_upload():
+    """Квота, число одновременных загрузок и скорость приёма - до чтения тела
+
+    Заявленный размер сверх свободного места отклоняется сразу (413), тело
+    без Content-Length обрывается, как только превысит квоту.
+    """
+    if not is_upload_request():
+        return None
+    user_id = current_user.id
+    limit = upload_body_limit()
+    if limit is not None and request.content_length is not None and request.content_length > limit:
+        return upload_refused(quotas.QuotaExceeded.description, 413)
+    if not upload_slots.acquire(user_id):
+        return upload_refused('Слишком много одновременных загрузок, повторите позже', 429, 1)
+    g.upload_slot = user_id
+    request.environ['wsgi.input'] = quotas.MeteredStream(request.environ['wsgi.input'], limit,
+                                                         upload_throttle, user_id)
     return None
 
+@app.teardown_request
+def release_upload_slot(exc):
+    user_id = g.pop('upload_slot', None)
+    if user_id is not None:
+        upload_slots.release(user_id)
+
+@app.errorhandler(quotas.QuotaExceeded)
+def quota_exceeded(e):
+    """Загрузка оборвана или отклонена из-за квоты"""
+    return upload_refused(e.description, 413)
+
+@app.errorhandler(storage.BlobBusy)
+def blob_busy(e):
+    """Такое же содержимое как раз удаляется из хранилища: загрузку можно повторить"""
+    return upload_refused('Хранилище занято, повторите загрузку через несколько секунд', 503, 5)
+
+# Длины очередей и состояние кэшей для /metrics
+def _queue_length(sql):
+    def collect():
+        with db.pooled_connection(app) as conn:
+            return conn.execute(sql).fetchone()[0]
+    return collect
+
+metrics.registry.gauge('oblako_thumbnails_pending', 'Фото, ожидающие миниатюр',
+                       _queue_length("SELECT COUNT(*) FROM blobs WHERE thumb_status = 'pending'"))
+metrics.registry.gauge('oblako_pending_deletions', 'Файлы в очереди на удаление с диска',
+                       _queue_length('SELECT COUNT(*) FROM pending_deletions'))
+metrics.registry.gauge('oblako_upload_sessions', 'Незавершённые загрузки по частям',
+                       _queue_length('SELECT COUNT(*) FROM upload_sessions'))
+metrics.registry.gauge('oblako_active_uploads', 'Загрузки, принимаемые сейчас', upload_slots.active)
+metrics.registry.gauge('oblako_image_cache_bytes', 'Объём дискового кэша изображений',
+                       lambda: get_image_cache().size())
+metrics.registry.gauge('oblako_user_cache_hits', 'Попадания в кэш пользователей', lambda: user_cache.hits)
+metrics.registry.gauge('oblako_user_cache_misses', 'Промахи кэша пользователей', lambda: user_cache.misses)
+metrics.registry.gauge('oblako_fragment_cache_hits', 'Попадания в кэш фрагментов страниц',
+                       lambda: getattr(fragment_cache, 'hits', 0))
+metrics.registry.gauge('oblako_fragment_cache_misses', 'Промахи кэша фрагментов страниц',
+                       lambda: getattr(fragment_cache, 'misses', 0))
+
 # ==================== РОУТЫ ====================
 
 @app.route('/')
@@ -141,18 +1215,39 @@ def login():
         return redirect(url_for('dashboard'))
     
     if request.method == 'POST':
+        # Частота попыток ограничивается до проверки пароля: перебор не нагружает пул.
+        # Отдельный счётчик на имя - против подбора пароля одного пользователя с многих адресов
+        wait = max(login_throttle.take(('ip', request.remote_addr)),
+                   login_throttle.take(('user', request.form.get('username') or '')))
+        if wait:
+            return login_refused('Слишком много попыток входа. Повторите через {0} с'.format(math.ceil(wait)),
+                                 429, wait)
+        
         username = request.form.get('username')
-        password = request.form.get('password')
+        password = request.form.get('password') or ''
         
-        conn = sqlite3.connect('oblako.db')
+        conn = get_db()
         cursor = conn.cursor()
         cursor.execute('SELECT id, username, email, password_hash FROM users WHERE username = ?', (username,))
         user_data = cursor.fetchone()
-        conn.close()
         
-        if user_data and check_password_hash(user_data[3], password):
+        valid = False
+        if user_data:
+            try:
+                valid, new_hash = passwords.verify(app, user_data[3], password)
+            except passwords.Overloaded:
+                return login_refused('Сервер перегружен, попробуйте войти через несколько секунд', 503, 1)
+            if new_hash:
+                # Хеш старым методом заменяется при первом удачном входе
+                cursor.execute('UPDATE users SET password_hash = ? WHERE id = ? AND password_hash = ?',
+                               (new_hash, user_data[0], user_data[3]))
+                conn.commit()
+                invalidate_user(user_data[0])
+        
+        if valid:
             user = User(user_data[0], user_data[1], user_data[2])
             login_user(user)
+            remember_user(user)
             flash('Добро пожаловать, {0}!'.format(user.username), 'success')
             return redirect(url_for('dashboard'))
         else:
@@ -182,23 +1277,25 @@ def register():
             return render_template('index.html', mode='register')
         
         try:
-            conn = sqlite3.connect('oblako.db')
+            conn = get_db()
             cursor = conn.cursor()
             
             # Проверка существующего пользователя
             cursor.execute('SELECT id FROM users WHERE username = ? OR email = ?', (username, email))
             if cursor.fetchone():
                 flash('Пользователь с таким именем или email уже существует', 'error')
-                conn.close()
                 return render_template('index.html', mode='register')
             
             # Создание нового пользователя
-            password_hash = generate_password_hash(password)
+            try:
+                password_hash = passwords.hash_password(app, password)
+            except passwords.Overloaded:
+                flash('Сервер перегружен, повторите регистрацию через несколько секунд', 'error')
+                return render_template('index.html', mode='register'), 503
             cursor.execute('INSERT INTO users (username, email, password_hash) VALUES (?, ?, ?)',
                           (username, email, password_hash))
             conn.commit()
             user_id = cursor.lastrowid
-            conn.close()
             
             flash('Регистрация успешна! Теперь вы можете войти.', 'success')
             return redirect(url_for('login'))
@@ -212,6 +1309,7 @@ def register():
 @login_required
 def logout():
     """Выход из системы"""
+    invalidate_user(current_user.id)
     logout_user()
     flash('Вы вышли из системы', 'info')
     return redirect(url_for('login'))
@@ -220,41 +1318,58 @@ def logout():
 @login_required
 def dashboard():
     """Панель управления - список файлов"""
-    conn = sqlite3.connect('oblako.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT id, filename, original_name, file_type, file_size, upload_date
-        FROM files WHERE user_id = ? ORDER BY upload_date DESC
-    ''', (current_user.id,))
-    files = cursor.fetchall()
-    conn.close()
+    page_cursor, limit = request.args.get('cursor'), get_page_size()
     
-    # Форматирование данных файлов
-    files_list = []
-    images_count = 0
-    docs_count = 0
-    for f in files:
-        file_type = f[3]
-        if file_type in ['png', 'jpg', 'jpeg', 'gif', 'bmp', 'webp']:
-            thumbnail = url_for('static', filename='uploads/albums/' + f[1])
-            images_count += 1
-        elif file_type in ['pdf', 'doc', 'docx', 'txt']:
-            thumbnail = None
-            docs_count += 1
-        else:
-            thumbnail = None
+    def build():
+        files_list, next_cursor = fetch_files_page(current_user.id, page_cursor, limit)
         
-        files_list.append({
-            'id': f[0],
-            'filename': f[1],
-            'original_name': f[2],
-            'file_type': file_type,
-            'file_size': f[4],
-            'upload_date': f[5],
-            'thumbnail': thumbnail
-        })
+        # Статистика по всей библиотеке - одна строка user_stats
+        cursor = get_db().cursor()
+        cursor.execute('''
+            SELECT files_count, images_count, docs_count, total_bytes FROM user_stats WHERE user_id = ?
+        ''', (current_user.id,))
+        total_count, images_count, docs_count, total_bytes = cursor.fetchone() or (0, 0, 0, 0)
+        
+        return {
+            'cards_html': Markup(render_template('_file_cards.html', files=files_list)),
+            'next_cursor': next_cursor,
+            'total_count': total_count,
+            'images_count': images_count,
+            'docs_count': docs_count,
+            'total_bytes': total_bytes
+        }
     
-    return render_template('files.html', files=files_list, images_count=images_count, docs_count=docs_count)
+    return render_template('files.html', **cached_fragment('dashboard', build, page_cursor, limit))
+
+@app.route('/api/files')
+@login_required
+def api_files():
+    """Страница файлов в JSON для бесконечной прокрутки"""
+    files_list, next_cursor = fetch_files_page(current_user.id, request.args.get('cursor'), get_page_size())
+    data = {'files': files_list, 'next_cursor': next_cursor}
+    if request.args.get('html'):
+        data['html'] = render_template('_file_cards.html', files=files_list)
+    return jsonify(data)
+
+@app.route('/search')
+@login_required
+def search_page():
+    """Поиск по файлам, альбомам и фотографиям"""
+    text = request.args.get('q', '').strip()
+    results, next_cursor = fetch_search_page(current_user.id, text, request.args.get('cursor'), get_page_size())
+    results_html = Markup(render_template('_search_results.html', results=results)) if results else None
+    return render_template('search.html', q=text, results_html=results_html, next_cursor=next_cursor)
+
+@app.route('/api/search')
+@login_required
+def api_search():
+    """Страница результатов поиска в JSON для бесконечной прокрутки"""
+    results, next_cursor = fetch_search_page(current_user.id, request.args.get('q', ''),
+                                             request.args.get('cursor'), get_page_size())
+    data = {'results': results, 'next_cursor': next_cursor}
+    if request.args.get('html'):
+        data['html'] = render_template('_search_results.html', results=results)
+    return jsonify(data)
 
 @app.route('/upload', methods=['GET', 'POST'])
 @login_required
@@ -273,31 +1388,38 @@ def upload():
         if file and allowed_file(file.filename):
             # Безопасное имя файла
             original_name = secure_filename(file.filename)
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S_')
-            filename = timestamp + str(uuid.uuid4().hex[:8]) + '_' + original_name
-            
-            # Создание директории если не существует
-            os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+            filename = make_stored_filename(original_name)
             
-            # Сохранение файла
-            file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(file_path)
+            # Потоковое сохранение: размер и контрольная сумма считаются при записи
+            blobs = get_blob_store()
+            tmp_path, checksum, file_size = blobs.write_temp(file.stream)
             
             # Определение типа файла
             ext = original_name.rsplit('.', 1)[1].lower()
             
-            # Размер файла
-            file_size = os.path.getsize(file_path)
+            # Сохранение в базу данных; одинаковое содержимое хранится один раз
+            conn = get_db()
+            new_blobs = []
+            try:
+                blobs.stage(conn, tmp_path, checksum)
+                conn.execute('BEGIN IMMEDIATE')
+                check_quota(conn, current_user.id, file_size)
+                if blobs.add_ref(conn, tmp_path, checksum, file_size):
+                    new_blobs.append(checksum)
+                conn.execute('''
+                    INSERT INTO files (user_id, filename, original_name, file_type, file_size, checksum, blob_hash)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', (current_user.id, filename, original_name, ext, file_size, checksum, checksum))
+                update_user_stats(conn, current_user.id, ext, file_size)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                blobs.discard_temp(tmp_path)
+                discard_new_blobs(conn, new_blobs)
+                raise
             
-            # Сохранение в базу данных
-            conn = sqlite3.connect('oblako.db')
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO files (user_id, filename, original_name, file_type, file_size)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (current_user.id, filename, original_name, ext, file_size))
-            conn.commit()
-            conn.close()
+            if ext in IMAGE_EXTENSIONS:
+                thumbnails.enqueue(app, conn, checksum)
             
             flash('Файл "{0}" успешно загружен'.format(original_name), 'success')
             return redirect(url_for('dashboard'))
@@ -310,11 +1432,10 @@ def upload():
 @login_required
 def uploaded_file(filename):
     """Скачивание файла"""
-    conn = sqlite3.connect('oblako.db')
+    conn = get_db()
     cursor = conn.cursor()
-    cursor.execute('SELECT user_id, original_name FROM files WHERE filename = ?', (filename,))
+    cursor.execute('SELECT user_id, original_name, blob_hash, checksum FROM files WHERE filename = ?', (filename,))
     file_data = cursor.fetchone()
-    conn.close()
     
     if file_data is None:
         abort(404)
@@ -323,73 +1444,417 @@ def uploaded_file(filename):
     if file_data[0] != current_user.id:
         abort(403)
     
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename, download_name=file_data[1])
+    return send_stored_file(stored_file(filename, file_data[2]), download_name=file_data[1], etag=file_data[3])
+
+@app.route('/uploads/<filename>/thumb')
+@immutable_url
+@login_required
+def file_thumbnail(filename):
+    """Миниатюра изображения из файлов"""
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT f.blob_hash, b.thumb_status FROM files f LEFT JOIN blobs b ON b.hash = f.blob_hash
+        WHERE f.filename = ? AND f.user_id = ?
+    ''', (filename, current_user.id))
+    file_data = cursor.fetchone()
+    
+    if file_data is None:
+        abort(404)
+    
+    if file_data[1] == 'ready':
+        return send_stored_file(get_blob_store().location(file_data[0], thumbnails.THUMB),
+                                etag=file_data[0] + '.thumb')
+    # Миниатюра ещё не готова - отдаём оригинал
+    return send_stored_file(stored_file(filename, file_data[0]), download_name=filename, etag=file_data[0])
+
+@app.route('/img/<int:photo_id>')
+@app.route('/img/file/<int:file_id>')
+@login_required
+def image_rendition(photo_id=None, file_id=None):
+    """Фото альбома или изображение из файлов в нужном размере и формате"""
+    if not images.available():
+        abort(404)
+    width, height, fmt, quality, negotiated = get_image_params()
+    conn = get_db()
+    cursor = conn.cursor()
+    
+    # Проверка доступа - как при скачивании оригинала
+    if file_id is None:
+        cursor.execute('SELECT album_id, filename, blob_hash FROM photos WHERE id = ? AND user_id = ?',
+                       (photo_id, current_user.id))
+        photo = cursor.fetchone()
+        if photo is None:
+            abort(404)
+        location = stored_photo(*photo)
+        source = photo[2] or '{0}/{1}'.format(photo[0], photo[1])
+    else:
+        cursor.execute('SELECT filename, blob_hash, file_type FROM files WHERE id = ? AND user_id = ?',
+                       (file_id, current_user.id))
+        file_data = cursor.fetchone()
+        if file_data is None or file_data[2] not in IMAGE_EXTENSIONS:
+            abort(404)
+        location = stored_file(file_data[0], file_data[1])
+        source = file_data[1] or file_data[0]
+    
+    key = images.cache_key(source, width, height, fmt, quality)
+    if request.if_none_match.contains(key):
+        response = app.response_class(status=304)
+        response.set_etag(key)
+    else:
+        backend, object_key = location
+        try:
+            path = images.rendition(app, get_image_cache(), key, fmt,
+                                    lambda: storage.local_file(backend, object_key, get_blob_store().tmp_dir),
+                                    width, height, quality)
+        except images.Overloaded:
+            response = jsonify({'error': 'Сервер перегружен, повторите запрос позже'})
+            response.status_code = 503
+            response.headers['Retry-After'] = '5'
+            return response
+        except FileNotFoundError:
+            abort(404)
+        except images.Unreadable:
+            return jsonify({'error': 'Не удалось прочитать изображение'}), 422
+        response = send_file(path, mimetype=images.FORMATS[fmt][1], etag=key, conditional=True)
+    
+    response.cache_control.private = True
+    response.cache_control.max_age = app.config['IMG_MAX_AGE']
+    if negotiated:
+        response.vary.add('Accept')
+    return response
 
 @app.route('/delete/file/<int:file_id>')
 @login_required
 def delete_file(file_id):
     """Удаление файла"""
-    conn = sqlite3.connect('oblako.db')
+    conn = get_db()
     cursor = conn.cursor()
-    cursor.execute('SELECT filename, user_id FROM files WHERE id = ?', (file_id,))
+    cursor.execute('SELECT filename, user_id, blob_hash, file_type, file_size FROM files WHERE id = ?', (file_id,))
     file_data = cursor.fetchone()
     
     if file_data is None:
-        conn.close()
         flash('Файл не найден', 'error')
         return redirect(url_for('dashboard'))
     
     if file_data[1] != current_user.id:
-        conn.close()
         abort(403)
     
-    # Удаление файла с диска
+    # Файл удаляется с диска в фоне (блоб - когда на него не осталось ссылок)
+    cursor.execute('BEGIN IMMEDIATE')
     try:
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], file_data[0])
-        if os.path.exists(file_path):
-            os.remove(file_path)
+        release_stored_file(conn, stored_file(file_data[0], file_data[2]), file_data[2])
+        # Удаление из базы данных
+        cursor.execute('DELETE FROM files WHERE id = ?', (file_id,))
+        update_user_stats(conn, current_user.id, file_data[3], file_data[4], delta=-1)
+        conn.commit()
     except Exception as e:
+        # Запись остаётся вместе со ссылкой на блоб - файл не теряется
+        conn.rollback()
         flash('Ошибка при удалении файла: {0}'.format(str(e)), 'error')
-    
-    # Удаление из базы данных
-    cursor.execute('DELETE FROM files WHERE id = ?', (file_id,))
-    conn.commit()
-    conn.close()
+        return redirect(url_for('dashboard'))
+    reaper.wake(app)
     
     flash('Файл удалён', 'success')
     return redirect(url_for('dashboard'))
 
+@app.route('/files/download', methods=['POST'])
+@login_required
+def download_files():
+    """Скачивание выбранных файлов одним ZIP-архивом"""
+    file_ids = request.form.getlist('file_ids', type=int)
+    if not file_ids:
+        flash('Файлы не выбраны', 'error')
+        return redirect(url_for('dashboard'))
+    
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT filename, original_name, blob_hash FROM files
+        WHERE user_id = ? AND id IN (SELECT value FROM json_each(?))
+        ORDER BY upload_date DESC, id DESC
+    ''', (current_user.id, json.dumps(file_ids)))
+    entries = [(row[1],) + stored_file(row[0], row[2]) for row in cursor.fetchall()]
+    
+    if not entries:
+        flash('Файлы не найдены', 'error')
+        return redirect(url_for('dashboard'))
+    
+    return send_zip(entries, 'files.zip')
+
+# ==================== ЗАГРУЗКА ПО ЧАСТЯМ ====================
+#
+# POST   /api/uploads                 {"filename", "size"}  -> {"id", "offset", "chunk_size"}
+# GET    /api/uploads/<id>            текущее смещение для дозагрузки
+# PUT    /api/uploads/<id>?offset=N   тело запроса - очередная часть файла
+# POST   /api/uploads/<id>/complete   {"checksum"} (необязательно) -> запись в files
+# DELETE /api/uploads/<id>            отмена загрузки
+#
+# Части пишутся потоком во временный файл UPLOAD_FOLDER/<id>.part, размер и
+# SHA-256 считаются по мере поступления данных. Состояние хеша держится в памяти
+# процесса; после перезапуска оно восстанавливается однократным чтением .part.
+
+_upload_hashers = {}
+_upload_hashers_lock = threading.Lock()
+
+def _upload_part_path(session_id):
+    """Путь к временному файлу сессии загрузки"""
+    return os.path.join(app.config['UPLOAD_FOLDER'], session_id + '.part')
+
+def _get_upload_session(session_id):
+    """Сессия загрузки текущего пользователя или 404"""
+    cursor = get_db().cursor()
+    cursor.execute('''
+        SELECT id, original_name, file_type, total_size, received FROM upload_sessions
+        WHERE id = ? AND user_id = ?
+    ''', (session_id, current_user.id))
+    upload_session = cursor.fetchone()
+    if upload_session is None:
+        abort(404)
+    return upload_session
+
+def _session_hasher(session_id, offset):
+    """Состояние SHA-256 для первых offset байт временного файла"""
+    with _upload_hashers_lock:
+        cached = _upload_hashers.pop(session_id, None)
+    if cached is not None and cached[0] == offset:
+        return cached[1]
+    # Состояние утеряно (перезапуск, другой процесс) - пересчитываем по файлу
+    return storage.hash_file(_upload_part_path(session_id), limit=offset)
+
+def _purge_stale_uploads(conn):
+    """Удаление незавершённых сессий старше UPLOAD_SESSION_TTL"""
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT id FROM upload_sessions WHERE updated_at < datetime('now', ?)
+    ''', ('-{0:d} seconds'.format(app.config['UPLOAD_SESSION_TTL']),))
+    for (session_id,) in cursor.fetchall():
+        part_path = _upload_part_path(session_id)
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        cursor.execute('DELETE FROM upload_sessions WHERE id = ?', (session_id,))
+        with _upload_hashers_lock:
+            _upload_hashers.pop(session_id, None)
+    conn.commit()
+
+@app.route('/api/uploads', methods=['POST'])
+@login_required
+def upload_session_create():
+    """Начало загрузки файла по частям"""
+    data = request.get_json(silent=True) or {}
+    name = data.get('filename') or ''
+    total_size = data.get('size')
+    
+    if not allowed_file(name):
+        return jsonify({'error': 'Недопустимый тип файла. Разрешены: изображения, документы, архивы'}), 400
+    if not isinstance(total_size, int) or total_size < 0:
+        return jsonify({'error': 'Не указан размер файла'}), 400
+    if total_size > app.config['MAX_UPLOAD_SIZE']:
+        return jsonify({'error': 'Файл слишком большой'}), 413
+    
+    original_name = secure_filename(name)
+    ext = original_name.rsplit('.', 1)[1].lower()
+    session_id = uuid.uuid4().hex
+    
+    conn = get_db()
+    _purge_stale_uploads(conn)
+    # Заявленный размер резервируется в квоте до завершения или отмены загрузки
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        check_quota(conn, current_user.id, total_size)
+    except quotas.QuotaExceeded:
+        conn.rollback()
+        raise
+    
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    open(_upload_part_path(session_id), 'wb').close()
+    conn.execute('''
+        INSERT INTO upload_sessions (id, user_id, original_name, file_type, total_size)
+        VALUES (?, ?, ?, ?, ?)
+    ''', (session_id, current_user.id, original_name, ext, total_size))
+    conn.commit()
+    
+    return jsonify({
+        'id': session_id,
+        'offset': 0,
+        'size': total_size,
+        'chunk_size': app.config['UPLOAD_CHUNK_SIZE']
+    }), 201
+
+@app.route('/api/uploads/<session_id>', methods=['GET'])
+@login_required
+def upload_session_status(session_id):
+    """Состояние загрузки: с какого смещения продолжать"""
+    upload_session = _get_upload_session(session_id)
+    return jsonify({'id': upload_session[0], 'offset': upload_session[4], 'size': upload_session[3]})
+
+@app.route('/api/uploads/<session_id>', methods=['PUT'])
+@login_required
+def upload_session_chunk(session_id):
+    """Приём очередной части файла"""
+    upload_session = _get_upload_session(session_id)
+    total_size, received = upload_session[3], upload_session[4]
+    
+    offset = request.args.get('offset', type=int)
+    if offset != received:
+        # Клиент должен продолжить с подтверждённого смещения
+        return jsonify({'error': 'Неверное смещение', 'offset': received}), 409
+    
+    # Часть с этого смещения принимает один запрос: повтор, пришедший, пока
+    # первый ещё пишет файл, получает 409 и не перемешивает данные
+    writer = uuid.uuid4().hex
+    conn = get_db()
+    claimed = conn.execute('''
+        UPDATE upload_sessions SET writer = ?, updated_at = CURRENT_TIMESTAMP
+        WHERE id = ? AND received = ? AND (writer IS NULL OR updated_at < datetime('now', ?))
+    ''', (writer, session_id, offset, '-{0:d} seconds'.format(app.config['UPLOAD_CHUNK_LEASE']))).rowcount
+    conn.commit()
+    if not claimed:
+        return jsonify({'error': 'Эта часть уже принимается', 'offset': received}), 409
+    
+    hasher = _session_hasher(session_id, offset)
+    written = 0
+    try:
+        with open(_upload_part_path(session_id), 'r+b') as f:
+            f.seek(offset)
+            f.truncate()
+            try:
+                storage.copy_stream(request.stream, f, hasher)
+            finally:
+                # При обрыве copy_stream не возвращает счётчик, а хеш уже
+                # учёл принятые блоки: позиция в файле совпадает с ним
+                written = f.tell() - offset
+    finally:
+        # Даже при обрыве соединения фиксируем то, что успело записаться
+        received = offset + written
+        if received <= total_size:
+            with _upload_hashers_lock:
+                _upload_hashers[session_id] = (received, hasher)
+        conn.execute('''
+            UPDATE upload_sessions SET received = ?, writer = NULL, updated_at = CURRENT_TIMESTAMP
+            WHERE id = ? AND writer = ?
+        ''', (min(received, total_size), session_id, writer))
+        conn.commit()
+    
+    if received > total_size:
+        with open(_upload_part_path(session_id), 'r+b') as f:
+            f.truncate(total_size)
+        return jsonify({'error': 'Данных больше заявленного размера', 'offset': total_size}), 400
+    
+    return jsonify({'id': session_id, 'offset': received, 'size': total_size})
+
+@app.route('/api/uploads/<session_id>/complete', methods=['POST'])
+@login_required
+def upload_session_complete(session_id):
+    """Завершение загрузки: проверка и атомарное переименование"""
+    upload_session = _get_upload_session(session_id)
+    _, original_name, ext, total_size, received = upload_session
+    
+    if received != total_size:
+        return jsonify({'error': 'Файл загружен не полностью', 'offset': received}), 409
+    
+    checksum = _session_hasher(session_id, received).hexdigest()
+    expected = (request.get_json(silent=True) or {}).get('checksum')
+    if expected and expected.lower() != checksum:
+        return jsonify({'error': 'Контрольная сумма не совпадает', 'checksum': checksum}), 422
+    
+    filename = make_stored_filename(original_name)
+    
+    # Временный файл переносится в хранилище блобов (или отбрасывается, если такое содержимое уже есть)
+    blobs = get_blob_store()
+    conn = get_db()
+    blobs.stage(conn, _upload_part_path(session_id), checksum)
+    cursor = conn.cursor()
+    cursor.execute('BEGIN IMMEDIATE')
+    new_blobs = []
+    try:
+        if blobs.add_ref(conn, _upload_part_path(session_id), checksum, total_size):
+            new_blobs.append(checksum)
+        cursor.execute('''
+            INSERT INTO files (user_id, filename, original_name, file_type, file_size, checksum, blob_hash)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (current_user.id, filename, original_name, ext, total_size, checksum, checksum))
+        file_id = cursor.lastrowid
+        update_user_stats(conn, current_user.id, ext, total_size)
+        cursor.execute('DELETE FROM upload_sessions WHERE id = ?', (session_id,))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        discard_new_blobs(conn, new_blobs)
+        raise
+    
+    if ext in IMAGE_EXTENSIONS:
+        thumbnails.enqueue(app, conn, checksum)
+    
+    return jsonify({
+        'success': True,
+        'file': {
+            'id': file_id,
+            'filename': filename,
+            'original_name': original_name,
+            'file_size': total_size,
+            'checksum': checksum
+        }
+    })
+
+@app.route('/api/uploads/<session_id>', methods=['DELETE'])
+@login_required
+def upload_session_cancel(session_id):
+    """Отмена загрузки"""
+    _get_upload_session(session_id)
+    part_path = _upload_part_path(session_id)
+    if os.path.exists(part_path):
+        os.remove(part_path)
+    with _upload_hashers_lock:
+        _upload_hashers.pop(session_id, None)
+    
+    conn = get_db()
+    conn.execute('DELETE FROM upload_sessions WHERE id = ?', (session_id,))
+    conn.commit()
+    return jsonify({'success': True})
+
 # ==================== АЛЬБОМЫ ====================
 
 @app.route('/albums')
 @login_required
 def albums():
     """Список альбомов"""
-    conn = sqlite3.connect('oblako.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT id, title, description, cover_photo, photo_count, created_at
-        FROM albums WHERE user_id = ? ORDER BY created_at DESC
-    ''', (current_user.id,))
-    albums_list = cursor.fetchall()
-    conn.close()
-    
-    albums_data = []
-    for a in albums_list:
-        cover_url = None
-        if a[3]:
-            cover_url = url_for('static', filename='uploads/albums/' + str(a[0]) + '/' + a[3])
+    def build():
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT a.id, a.title, a.description, a.cover_photo, a.photo_count, a.created_at, b.thumb_status,
+                   p.blob_hash
+            FROM albums a
+            LEFT JOIN photos p ON p.album_id = a.id AND p.filename = a.cover_photo
+            LEFT JOIN blobs b ON b.hash = p.blob_hash
+            WHERE a.user_id = ? ORDER BY a.created_at DESC
+        ''', (current_user.id,))
+        albums_list = cursor.fetchall()
         
-        albums_data.append({
-            'id': a[0],
-            'title': a[1],
-            'description': a[2],
-            'cover_photo': cover_url,
-            'photo_count': a[4],
-            'created_at': a[5]
-        })
+        albums_data = []
+        for a in albums_list:
+            cover_url = None
+            if a[3]:
+                cover_url = photo_urls(a[0], a[3], a[7], a[6])[1]
+            
+            albums_data.append({
+                'id': a[0],
+                'title': a[1],
+                'description': a[2],
+                'cover_photo': cover_url,
+                'photo_count': a[4],
+                'created_at': a[5]
+            })
+        
+        return {
+            'cards_html': Markup(render_template('_album_cards.html', albums=albums_data)),
+            'albums_count': len(albums_data),
+            'photos_count': sum(a['photo_count'] for a in albums_data),
+            'empty_count': sum(1 for a in albums_data if a['photo_count'] == 0)
+        }
     
-    return render_template('albums.html', albums=albums_data)
+    return render_template('albums.html', **cached_fragment('albums', build))
 
 @app.route('/album/new', methods=['GET', 'POST'])
 @login_required
@@ -403,18 +1868,13 @@ def new_album():
             flash('Название альбома обязательно', 'error')
             return render_template('album_edit.html', album=None)
         
-        conn = sqlite3.connect('oblako.db')
+        conn = get_db()
         cursor = conn.cursor()
         cursor.execute('''
             INSERT INTO albums (user_id, title, description) VALUES (?, ?, ?)
         ''', (current_user.id, title, description))
         conn.commit()
         album_id = cursor.lastrowid
-        conn.close()
-        
-        # Создание папки для альбома
-        album_folder = os.path.join(app.config['ALBUMS_FOLDER'], str(album_id))
-        os.makedirs(album_folder, exist_ok=True)
         
         flash('Альбом создан', 'success')
         return redirect(url_for('view_album', album_id=album_id))
@@ -425,54 +1885,69 @@ def new_album():
 @login_required
 def view_album(album_id):
     """Просмотр альбома"""
-    conn = sqlite3.connect('oblako.db')
-    cursor = conn.cursor()
+    page_cursor, limit = request.args.get('cursor'), get_page_size()
+    filters = get_photo_filters()
     
-    # Проверка доступа
-    cursor.execute('SELECT id, title, description, cover_photo, photo_count FROM albums WHERE id = ? AND user_id = ?', 
-                  (album_id, current_user.id))
-    album = cursor.fetchone()
+    def build():
+        conn = get_db()
+        cursor = conn.cursor()
+        
+        # Проверка доступа
+        cursor.execute('SELECT id, title, description, cover_photo, photo_count FROM albums WHERE id = ? AND user_id = ?', 
+                      (album_id, current_user.id))
+        album = cursor.fetchone()
+        
+        if album is None:
+            return None
+        
+        # Получаем первую страницу фотографий
+        photos_data, next_cursor = fetch_photos_page(album_id, page_cursor, limit, **filters)
+        
+        album_data = {
+            'id': album[0],
+            'title': album[1],
+            'description': album[2],
+            'cover_photo': album[3],
+            'photo_count': album[4]
+        }
+        
+        return {
+            'album': album_data,
+            'cards_html': Markup(render_template('_photo_cards.html', photos=photos_data, album=album_data)),
+            'next_cursor': next_cursor
+        }
     
-    if album is None:
-        conn.close()
+    data = cached_fragment('album', build, album_id, page_cursor, limit, tuple(sorted(filters.items())))
+    if data is None:
         flash('Альбом не найден', 'error')
         return redirect(url_for('albums'))
     
-    # Получаем фотографии
-    cursor.execute('''
-        SELECT id, filename, original_name, description, created_at
-        FROM photos WHERE album_id = ? ORDER BY created_at DESC
-    ''', (album_id,))
-    photos = cursor.fetchall()
-    conn.close()
-    
-    photos_data = []
-    for p in photos:
-        photo_url = url_for('static', filename='uploads/albums/' + str(album_id) + '/' + p[1])
-        photos_data.append({
-            'id': p[0],
-            'filename': p[1],
-            'original_name': p[2],
-            'description': p[3],
-            'created_at': p[4],
-            'url': photo_url
-        })
-    
-    album_data = {
-        'id': album[0],
-        'title': album[1],
-        'description': album[2],
-        'cover_photo': album[3],
-        'photo_count': album[4]
-    }
+    return render_template('album_view.html', batch_files=app.config['ALBUM_BATCH_MAX_FILES'],
+                           # Запас на служебные части multipart
+                           batch_bytes=app.config['ALBUM_BATCH_MAX_SIZE'] - 1024 * 1024,
+                           filters=filters, **data)
+
+@app.route('/api/album/<int:album_id>/photos')
+@login_required
+def api_album_photos(album_id):
+    """Страница фотографий альбома в JSON для бесконечной прокрутки"""
+    cursor = get_db().cursor()
+    cursor.execute('SELECT id FROM albums WHERE id = ? AND user_id = ?', (album_id, current_user.id))
+    if cursor.fetchone() is None:
+        return jsonify({'error': 'Альбом не найден'}), 404
     
-    return render_template('album_view.html', album=album_data, photos=photos_data)
+    photos_data, next_cursor = fetch_photos_page(album_id, request.args.get('cursor'), get_page_size(),
+                                                 **get_photo_filters())
+    data = {'photos': photos_data, 'next_cursor': next_cursor}
+    if request.args.get('html'):
+        data['html'] = render_template('_photo_cards.html', photos=photos_data, album={'id': album_id})
+    return jsonify(data)
 
 @app.route('/album/<int:album_id>/edit', methods=['GET', 'POST'])
 @login_required
 def edit_album(album_id):
     """Редактирование альбома"""
-    conn = sqlite3.connect('oblako.db')
+    conn = get_db()
     cursor = conn.cursor()
     
     if request.method == 'POST':
@@ -487,7 +1962,6 @@ def edit_album(album_id):
             UPDATE albums SET title = ?, description = ? WHERE id = ? AND user_id = ?
         ''', (title, description, album_id, current_user.id))
         conn.commit()
-        conn.close()
         
         flash('Альбом обновлён', 'success')
         return redirect(url_for('view_album', album_id=album_id))
@@ -495,7 +1969,6 @@ def edit_album(album_id):
     cursor.execute('SELECT id, title, description FROM albums WHERE id = ? AND user_id = ?', 
                   (album_id, current_user.id))
     album = cursor.fetchone()
-    conn.close()
     
     if album is None:
         flash('Альбом не найден', 'error')
@@ -508,22 +1981,19 @@ def edit_album(album_id):
 def add_photo(album_id):
     """Добавление фотографии в альбом"""
     # Проверка доступа к альбому
-    conn = sqlite3.connect('oblako.db')
+    conn = get_db()
     cursor = conn.cursor()
-    cursor.execute('SELECT id, photo_count FROM albums WHERE id = ? AND user_id = ?', (album_id, current_user.id))
+    cursor.execute('SELECT id FROM albums WHERE id = ? AND user_id = ?', (album_id, current_user.id))
     album = cursor.fetchone()
     
     if album is None:
-        conn.close()
         return jsonify({'error': 'Альбом не найден'}), 404
     
     if 'photo' not in request.files:
-        conn.close()
         return jsonify({'error': 'Файл не выбран'}), 400
     
     photo = request.files['photo']
     if photo.filename == '':
-        conn.close()
         return jsonify({'error': 'Файл не выбран'}), 400
     
     if photo and allowed_photo(photo.filename):
@@ -532,54 +2002,187 @@ def add_photo(album_id):
         ext = original_name.rsplit('.', 1)[1].lower()
         filename = str(uuid.uuid4().hex[:16]) + '.' + ext
         
-        # Создание директории альбома
-        album_folder = os.path.join(app.config['ALBUMS_FOLDER'], str(album_id))
-        os.makedirs(album_folder, exist_ok=True)
-        
-        # Сохранение файла
-        file_path = os.path.join(album_folder, filename)
-        photo.save(file_path)
-        
-        # Сохранение в базу данных
-        cursor.execute('''
-            INSERT INTO photos (album_id, user_id, filename, original_name) VALUES (?, ?, ?, ?)
-        ''', (album_id, current_user.id, filename, original_name))
-        photo_id = cursor.lastrowid
-        
-        # Обновление счётчика и обложки
-        new_count = album[1] + 1
-        cover_photo = None
-        if album[1] == 0:
-            # Первое фото - делаем обложкой
-            cover_photo = filename
-        
-        cursor.execute('''
-            UPDATE albums SET photo_count = ?, cover_photo = ? WHERE id = ?
-        ''', (new_count, cover_photo, album_id))
+        # Сохранение файла в хранилище блобов
+        blobs = get_blob_store()
+        tmp_path, blob_hash, size = blobs.write_temp(photo.stream)
+        # EXIF из заголовка - до транзакции, чтобы не держать блокировку записи
+        meta = photometa.values(photometa.read(tmp_path))
         
-        conn.commit()
-        conn.close()
+        # Сохранение в базу данных; одно и то же фото в разных альбомах хранится один раз
+        new_blobs = []
+        try:
+            blobs.stage(conn, tmp_path, blob_hash)
+            cursor.execute('BEGIN IMMEDIATE')
+            check_quota(conn, current_user.id, size)
+            if blobs.add_ref(conn, tmp_path, blob_hash, size):
+                new_blobs.append(blob_hash)
+            # Счётчик, объём и обложку альбома обновляет триггер photos_album_insert
+            cursor.execute('''
+                INSERT INTO photos (album_id, user_id, filename, original_name, blob_hash, file_size, {0})
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            '''.format(photometa.COLUMNS), (album_id, current_user.id, filename, original_name, blob_hash, size) + meta)
+            photo_id = cursor.lastrowid
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            blobs.discard_temp(tmp_path)
+            discard_new_blobs(conn, new_blobs)
+            raise
         
-        photo_url = url_for('static', filename='uploads/albums/' + str(album_id) + '/' + filename)
+        thumbnails.enqueue(app, conn, blob_hash)
         
         return jsonify({
             'success': True,
-            'photo': {
-                'id': photo_id,
-                'filename': filename,
-                'original_name': original_name,
-                'url': photo_url
-            }
+            'photo': photo_json(conn, album_id, photo_id, filename, original_name, blob_hash)
         })
     else:
-        conn.close()
         return jsonify({'error': 'Недопустимый формат изображения. Разрешены: PNG, JPG, JPEG, GIF, WebP'}), 400
 
+@app.route('/album/<int:album_id>/add_photos', methods=['POST'])
+@login_required
+def add_photos(album_id):
+    """Пакетное добавление фотографий в альбом одним запросом
+
+    Файлы записываются в хранилище параллельно, а все строки photos
+    добавляются одной транзакцией. Счётчик, объём и обложку альбома
+    обновляет триггер photos_album_insert - по разу на каждое фото, но в
+    той же транзакции. Результат возвращается по каждому файлу в порядке
+    их следования в запросе.
+    """
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute('SELECT id FROM albums WHERE id = ? AND user_id = ?', (album_id, current_user.id))
+    if cursor.fetchone() is None:
+        return jsonify({'error': 'Альбом не найден'}), 404
+    
+    files = [f for f in request.files.getlist('photos') if f.filename]
+    if not files:
+        return jsonify({'error': 'Файлы не выбраны'}), 400
+    if len(files) > app.config['ALBUM_BATCH_MAX_FILES']:
+        return jsonify({'error': 'Слишком много файлов в одном запросе (максимум {0})'.format(
+            app.config['ALBUM_BATCH_MAX_FILES'])}), 400
+    
+    results = []
+    accepted = []
+    for photo in files:
+        if allowed_photo(photo.filename):
+            original_name = secure_filename(photo.filename)
+            ext = original_name.rsplit('.', 1)[1].lower()
+            filename = str(uuid.uuid4().hex[:16]) + '.' + ext
+            results.append({'name': photo.filename, 'success': True})
+            accepted.append((results[-1], photo, filename, original_name))
+        else:
+            results.append({'name': photo.filename, 'success': False,
+                            'error': 'Недопустимый формат изображения'})
+    
+    # Запись содержимого во временные файлы с подсчётом хешей и чтением EXIF
+    blobs = get_blob_store()
+    
+    def write(stream):
+        tmp_path, blob_hash, size = blobs.write_temp(stream)
+        return tmp_path, blob_hash, size, photometa.values(photometa.read(tmp_path))
+    
+    def stage(item):
+        # У каждого потока своё соединение: соединение запроса не делится между потоками
+        with db.pooled_connection(app) as stage_conn:
+            blobs.stage(stage_conn, item[3], item[4])
+    
+    with ThreadPoolExecutor(max_workers=app.config['ALBUM_BATCH_WORKERS']) as executor:
+        futures = [executor.submit(write, photo.stream) for _, photo, _, _ in accepted]
+    written = []
+    for (result, _, filename, original_name), future in zip(accepted, futures):
+        try:
+            tmp_path, blob_hash, size, meta = future.result()
+        except OSError:
+            app.logger.exception('Не удалось сохранить фото %s', result['name'])
+            result.update(success=False, error='Ошибка сохранения файла')
+            continue
+        # Ограничение на одно фото то же, что и при обычной загрузке
+        if size > app.config['MAX_CONTENT_LENGTH']:
+            blobs.discard_temp(tmp_path)
+            result.update(success=False, error='Файл слишком большой')
+            continue
+        written.append((result, filename, original_name, tmp_path, blob_hash, size, meta))
+    
+    if written:
+        # Одна транзакция на весь пакет; сводные данные альбома обновляют триггеры.
+        # В удалённое хранилище файлы выгружаются параллельно и до неё
+        new_blobs = []
+        try:
+            with ThreadPoolExecutor(max_workers=app.config['ALBUM_BATCH_WORKERS']) as executor:
+                list(executor.map(stage, written))
+            cursor.execute('BEGIN IMMEDIATE')
+            # Фото, не поместившиеся в квоту, отклоняются по отдельности
+            left = quotas.remaining(conn, current_user.id, app.config['USER_QUOTA_BYTES'])
+            stored = []
+            for item in written:
+                result, filename, original_name, tmp_path, blob_hash, size, meta = item
+                if left is not None:
+                    if size > left:
+                        blobs.discard_temp(tmp_path)
+                        result.update(success=False, error=quotas.QuotaExceeded.description)
+                        continue
+                    left -= size
+                if blobs.add_ref(conn, tmp_path, blob_hash, size):
+                    new_blobs.append(blob_hash)
+                cursor.execute('''
+                    INSERT INTO photos (album_id, user_id, filename, original_name, blob_hash, file_size, {0})
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                '''.format(photometa.COLUMNS),
+                    (album_id, current_user.id, filename, original_name, blob_hash, size) + meta)
+                result['photo_id'] = cursor.lastrowid
+                stored.append(item)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            for item in written:
+                blobs.discard_temp(item[3])
+            discard_new_blobs(conn, new_blobs)
+            raise
+        written = stored
+        
+        for result, filename, original_name, tmp_path, blob_hash, size, meta in written:
+            thumbnails.enqueue(app, conn, blob_hash)
+            result['photo'] = photo_json(conn, album_id, result.pop('photo_id'),
+                                         filename, original_name, blob_hash)
+    
+    return jsonify({
+        'success': bool(written),
+        'uploaded': len(written),
+        'results': results
+    })
+
+@app.route('/album/<int:album_id>/photo/<filename>')
+@app.route('/album/<int:album_id>/photo/<filename>/<any(thumb, preview):kind>')
+@immutable_url
+@login_required
+def album_photo(album_id, filename, kind=None):
+    """Файл фотографии альбома, его миниатюра или превью"""
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT p.blob_hash, b.thumb_status FROM photos p LEFT JOIN blobs b ON b.hash = p.blob_hash
+        WHERE p.album_id = ? AND p.filename = ? AND p.user_id = ?
+    ''', (album_id, filename, current_user.id))
+    photo = cursor.fetchone()
+    
+    if photo is None:
+        abort(404)
+    
+    if kind and photo[1] == 'ready':
+        name = thumbnails.THUMB if kind == 'thumb' else thumbnails.PREVIEW
+        return send_stored_file(get_blob_store().location(photo[0], name),
+                                etag='{0}.{1}'.format(photo[0], kind))
+    # Оригинал (в том числе пока миниатюры ещё не готовы)
+    # Старые фото без блоба: имя файла уникально и неизменно, им и помечается содержимое
+    return send_stored_file(stored_photo(album_id, filename, photo[0]), download_name=filename,
+                            etag=photo[0] or filename)
+
 @app.route('/album/<int:album_id>/set_cover/<int:photo_id>')
 @login_required
 def set_cover(album_id, photo_id):
     """Установка фото как обложки альбома"""
-    conn = sqlite3.connect('oblako.db')
+    conn = get_db()
     cursor = conn.cursor()
     
     # Проверка доступа и фото
@@ -591,14 +2194,12 @@ def set_cover(album_id, photo_id):
     photo = cursor.fetchone()
     
     if photo is None:
-        conn.close()
         flash('Фото не найдено', 'error')
         return redirect(url_for('view_album', album_id=album_id))
     
     # Обновление обложки
     cursor.execute('UPDATE albums SET cover_photo = ? WHERE id = ?', (photo[0], album_id))
     conn.commit()
-    conn.close()
     
     flash('Обложка альбома обновлена', 'success')
     return redirect(url_for('view_album', album_id=album_id))
@@ -607,82 +2208,227 @@ def set_cover(album_id, photo_id):
 @login_required
 def delete_photo(photo_id):
     """Удаление фотографии"""
-    conn = sqlite3.connect('oblako.db')
+    conn = get_db()
     cursor = conn.cursor()
     
     # Получаем информацию о фото
     cursor.execute('''
-        SELECT p.filename, p.album_id, a.cover_photo FROM photos p
-        JOIN albums a ON p.album_id = a.id
-        WHERE p.id = ? AND p.user_id = ?
+        SELECT filename, album_id, blob_hash FROM photos WHERE id = ? AND user_id = ?
     ''', (photo_id, current_user.id))
     photo_data = cursor.fetchone()
     
     if photo_data is None:
-        conn.close()
         flash('Фото не найдено', 'error')
         return redirect(url_for('albums'))
     
-    filename, album_id, cover_photo = photo_data
+    filename, album_id, blob_hash = photo_data
     
-    # Удаление файла
+    # Файл удаляется с диска в фоне (блоб - когда на него не осталось ссылок)
+    cursor.execute('BEGIN IMMEDIATE')
     try:
-        photo_path = os.path.join(app.config['ALBUMS_FOLDER'], str(album_id), filename)
-        if os.path.exists(photo_path):
-            os.remove(photo_path)
+        release_stored_file(conn, stored_photo(album_id, filename, blob_hash), blob_hash)
+        # Удаление из базы; счётчик и обложку (самое раннее фото) обновляет триггер photos_album_delete
+        cursor.execute('DELETE FROM photos WHERE id = ?', (photo_id,))
+        conn.commit()
     except Exception as e:
+        conn.rollback()
         flash('Ошибка при удалении файла: {0}'.format(str(e)), 'error')
+        return redirect(url_for('view_album', album_id=album_id))
+    reaper.wake(app)
     
-    # Удаление из базы
-    cursor.execute('DELETE FROM photos WHERE id = ?', (photo_id,))
-    
-    # Обновление счётчика и обложки
-    cursor.execute('UPDATE albums SET photo_count = photo_count - 1 WHERE id = ?', (album_id,))
+    flash('Фото удалено', 'success')
+    return redirect(url_for('view_album', album_id=album_id))
+
+@app.route('/album/<int:album_id>/download')
+@login_required
+def download_album(album_id):
+    """Скачивание всех фотографий альбома одним ZIP-архивом"""
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute('SELECT title FROM albums WHERE id = ? AND user_id = ?', (album_id, current_user.id))
+    album = cursor.fetchone()
     
-    # Если удалённое фото было обложкой, выбираем новое
-    if cover_photo == filename:
-        cursor.execute('SELECT filename FROM photos WHERE album_id = ? LIMIT 1', (album_id,))
-        new_cover = cursor.fetchone()
-        new_cover_name = new_cover[0] if new_cover else None
-        cursor.execute('UPDATE albums SET cover_photo = ? WHERE id = ?', (new_cover_name, album_id))
+    if album is None:
+        flash('Альбом не найден', 'error')
+        return redirect(url_for('albums'))
     
-    conn.commit()
-    conn.close()
+    cursor.execute('''
+        SELECT filename, original_name, blob_hash FROM photos
+        WHERE album_id = ? ORDER BY created_at, id
+    ''', (album_id,))
+    entries = [(row[1],) + stored_photo(album_id, row[0], row[2]) for row in cursor.fetchall()]
     
-    flash('Фото удалено', 'success')
-    return redirect(url_for('view_album', album_id=album_id))
+    return send_zip(entries, album[0] + '.zip')
 
 @app.route('/album/<int:album_id>/delete')
 @login_required
 def delete_album(album_id):
     """Удаление альбома"""
-    conn = sqlite3.connect('oblako.db')
+    conn = get_db()
     cursor = conn.cursor()
     
     # Проверка доступа
     cursor.execute('SELECT id FROM albums WHERE id = ? AND user_id = ?', (album_id, current_user.id))
     if not cursor.fetchone():
-        conn.close()
         flash('Альбом не найден', 'error')
         return redirect(url_for('albums'))
     
-    # Удаление файлов альбома
-    try:
-        album_folder = os.path.join(app.config['ALBUMS_FOLDER'], str(album_id))
-        if os.path.exists(album_folder):
-            import shutil
-            shutil.rmtree(album_folder)
-    except Exception as e:
-        flash('Ошибка при удалении файлов: {0}'.format(str(e)), 'error')
+    # Снимаем ссылки на блобы, папка со старыми файлами ставится в очередь целиком;
+    # сами файлы удаляются в фоне пакетами
+    cursor.execute('BEGIN IMMEDIATE')
+    cursor.execute('SELECT blob_hash FROM photos WHERE album_id = ? AND blob_hash IS NOT NULL', (album_id,))
+    blobs = get_blob_store()
+    for (blob_hash,) in cursor.fetchall():
+        if blobs.release(conn, blob_hash):
+            reaper.enqueue_blob(conn, blob_hash)
+    album_folder = legacy_storage('ALBUMS_FOLDER').local_path(str(album_id))
+    if os.path.exists(album_folder):
+        reaper.enqueue_path(conn, album_folder)
     
-    # Удаление из базы (каскадное удаление фото)
+    # Удаление из базы: альбом первым, чтобы триггер на photos не пересчитывал его для каждого фото
     cursor.execute('DELETE FROM albums WHERE id = ?', (album_id,))
+    cursor.execute('DELETE FROM photos WHERE album_id = ?', (album_id,))
     conn.commit()
-    conn.close()
+    reaper.wake(app)
     
     flash('Альбом удалён', 'success')
     return redirect(url_for('albums'))
 
+# ==================== КОМАНДЫ ====================
+
+@app.cli.command('repair-stats')
+def repair_stats_command():
+    """Пересчёт статистики хранилища всех пользователей с нуля"""
+    with db.pooled_connection(app) as conn:
+        conn.execute('BEGIN IMMEDIATE')
+        rebuild_user_stats(conn)
+        conn.commit()
+        count = conn.execute('SELECT COUNT(*) FROM user_stats').fetchone()[0]
+    print('Статистика пересчитана для пользователей: {0}'.format(count))
+
+@app.cli.command('check-albums')
+@click.option('--repair', is_flag=True, help='Пересчитать расходящиеся альбомы')
+def check_albums_command(repair):
+    """Проверка счётчиков, объёма и обложек альбомов по таблице photos"""
+    with db.pooled_connection(app) as conn:
+        conn.execute('BEGIN IMMEDIATE')
+        album_ids = find_inconsistent_albums(conn)
+        if repair:
+            for album_id in album_ids:
+                rebuild_album_stats(conn, album_id)
+        conn.commit()
+    if not album_ids:
+        print('Расхождений нет')
+    else:
+        print('{0}: {1}'.format('Исправлены альбомы' if repair else 'Расхождения в альбомах',
+                                ', '.join(str(i) for i in album_ids)))
+
+@app.cli.command('reap')
+def reap_command():
+    """Удаление с диска всех файлов из очереди (без ограничения скорости)"""
+    total = 0
+    while True:
+        processed = reaper.reap(app, app.config['REAPER_BATCH_SIZE'])
+        if not processed:
+            break
+        total += processed
+    with db.pooled_connection(app) as conn:
+        failed = conn.execute('SELECT COUNT(*) FROM pending_deletions').fetchone()[0]
+    print('Обработано: {0}, ожидают повтора: {1}'.format(total, failed))
+
+@app.cli.command('scrub')
+@click.option('--repair', is_flag=True, help='Исправить найденное (файлы - в очередь удаления)')
+@click.option('--verify', is_flag=True, help='Сверить контрольные суммы содержимого')
+@click.option('--workers', type=int, default=None, help='Число процессов проверки сумм (по умолчанию - по числу ядер)')
+@click.option('--batch-size', type=int, default=1000, show_default=True)
+@click.option('--min-age', type=int, default=3600, show_default=True,
+              help='Файлы моложе стольких секунд не считаются сиротами')
+@click.option('--restart', is_flag=True, help='Начать с начала, а не с сохранённой позиции')
+def scrub_command(repair, verify, workers, batch_size, min_age, restart):
+    """Поиск файлов без записей и записей без файлов в хранилище"""
+    with contextlib.ExitStack() as stack:
+        conn = stack.enter_context(db.pooled_connection(app))
+        pool = stack.enter_context(ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context(app.config['PROCESS_START_METHOD']))
+        ) if verify else None
+        if restart:
+            conn.execute('BEGIN IMMEDIATE')
+            scrubber.clear_checkpoints(conn)
+            conn.commit()
+        counts = scrubber.Scrubber(app, conn, repair=repair, pool=pool, batch_size=batch_size, min_age=min_age,
+                                   on_file_removed=functools.partial(update_user_stats, delta=-1)).run()
+    print('Проверено файлов на диске: {0}, записей: {1}'.format(counts['entries'], counts['rows']))
+    print('Сирот: {0}, записей без содержимого: {1}, неверных счётчиков: {2}, повреждено: {3}'.format(
+        counts['orphans'], counts['dangling'], counts['refcount'], counts['corrupt']))
+    if repair:
+        print('Исправлено: {0} (файлы удалит фоновый поток или flask reap)'.format(counts['repaired']))
+
+@app.cli.command('backfill-photo-meta')
+@click.option('--workers', type=int, default=None, help='Число процессов (по умолчанию - по числу ядер)')
+@click.option('--batch-size', type=int, default=500, show_default=True)
+def backfill_photo_meta_command(workers, batch_size):
+    """Извлечение EXIF для фото, загруженных до появления метаданных"""
+    if not photometa.available():
+        print('Pillow не установлен, метаданные не извлекаются')
+        return
+    assignments = ', '.join(column + ' = ?' for column in photometa.COLUMNS.split(', '))
+    processed = failed = last_id = 0
+    pool = ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context(app.config['PROCESS_START_METHOD']))
+    with pool, db.pooled_connection(app) as conn:
+        while True:
+            rows = conn.execute('''
+                SELECT id, album_id, user_id, filename, blob_hash FROM photos
+                WHERE meta_status IS NULL AND id > ? ORDER BY id LIMIT ?
+            ''', (last_id, batch_size)).fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            
+            # Заголовки читаются в процессах пула, одно содержимое - один раз.
+            # Из удалённого хранилища скачивается только начало файла
+            contents = {row[0]: row[4] or (row[1], row[3]) for row in rows}
+            sources = {}
+            for row in rows:
+                if contents[row[0]] not in sources:
+                    sources[contents[row[0]]] = storage.read_source(
+                        *stored_photo(row[1], row[3], row[4]), limit=photometa.HEADER_BYTES)
+            metas = dict(zip(sources, pool.map(photometa.read, sources.values(), chunksize=16)))
+            
+            conn.execute('BEGIN IMMEDIATE')
+            for row in rows:
+                meta = metas[contents[row[0]]]
+                failed += meta is None
+                conn.execute('UPDATE photos SET {0} WHERE id = ?'.format(assignments),
+                             photometa.values(meta) + (row[0],))
+            # Триггеры версий не следят за photos - кэш страниц альбомов сбрасывается явно
+            users = sorted({row[2] for row in rows})
+            conn.execute('UPDATE users SET data_version = data_version + 1 WHERE id IN ({0})'.format(
+                ', '.join('?' * len(users))), users)
+            conn.commit()
+            processed += len(rows)
+            print('Обработано: {0}'.format(processed))
+    print('Готово: {0} фото, не прочитано: {1}'.format(processed, failed))
+
+@app.cli.command('generate-thumbnails')
+def generate_thumbnails_command():
+    """Создание недостающих миниатюр для всех изображений"""
+    if not thumbnails.available():
+        print('Pillow не установлен, миниатюры не создаются')
+        return
+    placeholders = ', '.join('?' * len(IMAGE_EXTENSIONS))
+    with db.pooled_connection(app) as conn:
+        rows = conn.execute('''
+            SELECT hash FROM blobs WHERE (thumb_status IS NULL OR thumb_status <> 'ready') AND hash IN (
+                SELECT blob_hash FROM files WHERE file_type IN ({0})
+                UNION SELECT blob_hash FROM photos
+            )
+        '''.format(placeholders), tuple(IMAGE_EXTENSIONS)).fetchall()
+    
+    executor = thumbnails.get_executor(app)
+    statuses = list(executor.map(lambda r: thumbnails.generate(app, r[0]), rows))
+    print('Обработано: {0}, ошибок: {1}'.format(len(statuses), statuses.count('failed')))
+
 @app.errorhandler(404)
 def page_not_found(e):
     """Страница 404"""
@@ -706,5 +2452,9 @@ if __name__ == '__main__':
     # Инициализация базы данных
     init_db()
     
+    # Удаление файлов и миниатюры, оставшиеся в очереди с прошлого запуска
+    reaper.start(app)
+    thumbnails.resume(app, IMAGE_EXTENSIONS)
+    
     # Запуск приложения
     app.run(host='0.0.0.0', port=5000, debug=True)
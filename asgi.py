@@ -0,0 +1,358 @@
+"""
+Асинхронный (ASGI) режим работы приложения
+Маршруты app.py выполняются в пуле потоков, а передача тел запросов
+и файлов ответов идёт в цикле событий, не занимая поток на время передачи
+
+Запуск: uvicorn asgi:application --host 0.0.0.0 --port 5000
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import parse_range_header
+
+import reaper
+import thumbnails
+from app import BODY_LIMITS, IMAGE_EXTENSIONS, UPLOAD_ENDPOINTS, app, init_db, upload_body_limit
+
+# Значения по умолчанию для настроек ASGI-режима
+DEFAULT_CONFIG = {
+    'ASGI_THREADS': 32,                   # Потоки для маршрутов Flask (и работы с SQLite)
+    'ASGI_SPOOL_SIZE': 1024 * 1024,       # Тело запроса больше этого размера пишется на диск
+    'ASGI_READ_SIZE': 256 * 1024,         # Блок чтения файла при отдаче
+}
+
+# Заголовок, которым send_stored_file передаёт путь к файлу адаптеру
+SENDFILE_HEADER = 'x-sendfile'
+
+
+class ClientDisconnected(Exception):
+    """Клиент закрыл соединение, не дослав тело запроса"""
+
+
+class ASGIAdapter:
+    """Адаптер WSGI-приложения Flask к ASGI
+
+    Тело запроса принимается асинхронно во временный файл, и только
+    затем маршрут вызывается в пуле потоков: медленный клиент занимает
+    корутину, а не поток. Скачивания отдаются как X-Sendfile: маршрут
+    проверяет права и условные заголовки, а байты (с учётом Range)
+    передаются из цикла событий.
+    """
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+        for key, value in DEFAULT_CONFIG.items():
+            wsgi_app.config.setdefault(key, value)
+        self.executor = ThreadPoolExecutor(max_workers=wsgi_app.config['ASGI_THREADS'],
+                                           thread_name_prefix='asgi')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.handle(scope, receive, send)
+
+    async def run(self, func, *args):
+        """Выполнение блокирующей функции в пуле потоков"""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def lifespan(self, receive, send):
+        """Подготовка каталогов и базы при старте, остановка пула при завершении"""
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    await self.run(prepare, self.wsgi_app)
+                except Exception as e:
+                    await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=True)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def body_limit(self, environ):
+        """Лимит размера тела для запроса (None - без ограничения)
+
+        Маршрут определяется до приёма тела, поэтому большой лимит пакетной
+        загрузки фото действует только для неё, а не для любого адреса. Для
+        загрузок лимит не больше свободного места в квоте: тело сверх него
+        обрывается при приёме, а не после записи во временный файл.
+        Читает сессию и базу - вызывается в пуле потоков.
+        """
+        try:
+            endpoint, _ = self.wsgi_app.url_map.bind_to_environ(environ).match(
+                method=environ['REQUEST_METHOD'])
+        except HTTPException:
+            # 404, 405 или перенаправление - ответит Flask, тело ему не нужно
+            endpoint = None
+        limit = self.wsgi_app.config[BODY_LIMITS.get(endpoint, 'MAX_CONTENT_LENGTH')]
+        if endpoint in UPLOAD_ENDPOINTS:
+            with self.wsgi_app.request_context(environ):
+                left = upload_body_limit()
+            if left is not None and (limit is None or left < limit):
+                limit = left
+        return limit
+
+    async def handle(self, scope, receive, send):
+        """Обработка одного HTTP-запроса"""
+        body = tempfile.SpooledTemporaryFile(max_size=self.wsgi_app.config['ASGI_SPOOL_SIZE'])
+        try:
+            environ = build_environ(scope, body)
+            try:
+                limit = await self.run(self.body_limit, environ)
+                if not await self.read_body(scope, receive, body, limit):
+                    await send_simple(send, 413, b'Request Entity Too Large')
+                    return
+            except ClientDisconnected:
+                # Отвечать некому, а неполное тело маршруту передавать нельзя
+                return
+            await self.run(body.seek, 0)
+
+            status, headers, chunks = await self.run(call_wsgi, self.wsgi_app, environ)
+            try:
+                sendfile = None
+                if not self.wsgi_app.config['DOWNLOAD_OFFLOAD']:
+                    # Иначе заголовок предназначен фронтенд-серверу
+                    sendfile = pop_header(headers, SENDFILE_HEADER)
+                if sendfile is not None and status.startswith('200'):
+                    await self.send_file(scope, receive, send, sendfile, headers)
+                    return
+                await send({
+                    'type': 'http.response.start',
+                    'status': int(status.split(' ', 1)[0]),
+                    'headers': encode_headers(headers),
+                })
+                while True:
+                    chunk = await self.run(next, chunks, None)
+                    if chunk is None:
+                        break
+                    if chunk:
+                        await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                await send({'type': 'http.response.body', 'body': b''})
+            finally:
+                if hasattr(chunks, 'close'):
+                    await self.run(chunks.close)
+        finally:
+            await self.run(body.close)
+
+    async def read_body(self, scope, receive, body, limit):
+        """Приём тела запроса во временный файл; False - превышен лимит
+
+        При разрыве соединения выбрасывает ClientDisconnected.
+        """
+        declared = header_value(scope, b'content-length')
+        if limit is not None and declared is not None and declared.isdigit() and int(declared) > limit:
+            return False
+
+        received = 0
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                raise ClientDisconnected()
+            chunk = message.get('body', b'')
+            more_body = message.get('more_body', False)
+            received += len(chunk)
+            if limit is not None and received > limit:
+                return False
+            if chunk:
+                await self.run(body.write, chunk)
+        return True
+
+    async def send_file(self, scope, receive, send, path, headers):
+        """Отдача файла (целиком или диапазона Range) без занятия потока на время передачи"""
+        try:
+            f = await self.run(open, path, 'rb')
+        except OSError:
+            await send_simple(send, 404, b'Not Found')
+            return
+        try:
+            size = os.fstat(f.fileno()).st_size
+            start, stop = 0, size
+            status = 200
+            byte_range = requested_range(scope, headers)
+            if byte_range is not None:
+                span = byte_range.range_for_length(size)
+                if span is None:
+                    await send_simple(send, 416, b'Range Not Satisfiable',
+                                      [('Content-Range', 'bytes */{0}'.format(size))])
+                    return
+                start, stop = span
+                status = 206
+                headers.append(('Content-Range', 'bytes {0}-{1}/{2}'.format(start, stop - 1, size)))
+            headers.append(('Content-Length', str(stop - start)))
+            headers.append(('Accept-Ranges', 'bytes'))
+
+            await send({'type': 'http.response.start', 'status': status, 'headers': encode_headers(headers)})
+            if scope['method'] == 'HEAD':
+                await send({'type': 'http.response.body', 'body': b''})
+                return
+            if status == 200 and 'http.response.pathsend' in scope.get('extensions', {}):
+                # Сервер умеет отдавать файл сам (sendfile)
+                await send({'type': 'http.response.pathsend', 'path': os.path.abspath(path)})
+                return
+
+            disconnected = asyncio.Event()
+            watcher = asyncio.ensure_future(watch_disconnect(receive, disconnected))
+            try:
+                await self.run(f.seek, start)
+                remaining = stop - start
+                read_size = self.wsgi_app.config['ASGI_READ_SIZE']
+                while remaining > 0 and not disconnected.is_set():
+                    chunk = await self.run(f.read, min(read_size, remaining))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                if not disconnected.is_set():
+                    await send({'type': 'http.response.body', 'body': b''})
+            finally:
+                watcher.cancel()
+        finally:
+            await self.run(f.close)
+
+
+def prepare(wsgi_app):
+    """Создание каталогов и инициализация базы (как при запуске python app.py)"""
+    os.makedirs(wsgi_app.config['UPLOAD_FOLDER'], exist_ok=True)
+    os.makedirs(wsgi_app.config['ALBUMS_FOLDER'], exist_ok=True)
+    init_db()
+    reaper.start(wsgi_app)
+    thumbnails.resume(wsgi_app, IMAGE_EXTENSIONS)
+
+
+def call_wsgi(wsgi_app, environ):
+    """Вызов WSGI-приложения: (статус, заголовки, итератор тела)"""
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response['status'] = status
+        response['headers'] = list(headers)
+
+    iterable = wsgi_app(environ, start_response)
+    chunks = iter(iterable)
+    first = next(chunks, None)
+    if first is not None:
+        chunks = _prepend(first, chunks)
+    if hasattr(iterable, 'close'):
+        chunks = _Closing(chunks, iterable.close)
+    return response['status'], response['headers'], chunks
+
+
+def _prepend(first, chunks):
+    yield first
+    yield from chunks
+
+
+class _Closing:
+    """Итератор тела ответа с закрытием исходного объекта WSGI"""
+
+    def __init__(self, chunks, close):
+        self.chunks = chunks
+        self.close = close
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.chunks)
+
+
+def build_environ(scope, body):
+    """WSGI environ по ASGI scope"""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+        # Файлы отдаёт адаптер (см. app.send_stored_file)
+        'oblako.offload': SENDFILE_HEADER,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        if name in environ:
+            value = environ[name] + ',' + value
+        environ[name] = value
+    return environ
+
+
+def header_value(scope, name):
+    """Значение заголовка запроса (name - в нижнем регистре, bytes) или None"""
+    for key, value in scope['headers']:
+        if key == name:
+            return value.decode('latin-1')
+    return None
+
+
+def pop_header(headers, name):
+    """Удаление заголовка ответа из списка; возвращает его значение или None"""
+    for i, (key, value) in enumerate(headers):
+        if key.lower() == name:
+            del headers[i]
+            return value
+    return None
+
+
+def requested_range(scope, headers):
+    """Запрошенный диапазон с учётом If-Range или None, если нужен весь файл"""
+    value = header_value(scope, b'range')
+    if value is None:
+        return None
+    if_range = header_value(scope, b'if-range')
+    if if_range is not None:
+        validators = [v for k, v in headers if k.lower() in ('etag', 'last-modified')]
+        if if_range.strip() not in validators:
+            return None
+    byte_range = parse_range_header(value)
+    if byte_range is None or len(byte_range.ranges) != 1:
+        # Несколько диапазонов не поддерживаются - отдаётся весь файл
+        return None
+    return byte_range
+
+
+def encode_headers(headers):
+    return [(key.lower().encode('latin-1'), value.encode('latin-1')) for key, value in headers]
+
+
+async def send_simple(send, status, body, headers=()):
+    """Короткий ответ без участия приложения"""
+    headers = [('Content-Type', 'text/plain; charset=utf-8'),
+               ('Content-Length', str(len(body)))] + list(headers)
+    await send({'type': 'http.response.start', 'status': status, 'headers': encode_headers(headers)})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def watch_disconnect(receive, disconnected):
+    """Ожидание разрыва соединения клиентом во время отдачи файла"""
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            disconnected.set()
+            return
+
+
+application = ASGIAdapter(app)
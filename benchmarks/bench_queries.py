@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+Замер времени запросов страниц до и после индексов из MIGRATIONS (idx_*)
+
+    python benchmarks/bench_queries.py --rows 1000000
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app, init_db
+import db
+import search
+
+# Первые страницы списков - те же запросы, что выполняют fetch_files_page,
+# fetch_photos_page (сортировка по умолчанию), fetch_search_page и маршруты
+# albums и uploaded_file. Следующие страницы отличаются только условием
+# (ключ, id) < (?, ?) курсора и читаются по тому же индексу
+PAGE_LIMIT = app.config['PAGE_SIZE'] + 1
+
+QUERIES = {
+    'dashboard': lambda conn, r: conn.execute('''
+        SELECT f.id, f.filename, f.original_name, f.file_type, f.file_size, f.upload_date, b.thumb_status,
+               f.blob_hash
+        FROM files f LEFT JOIN blobs b ON b.hash = f.blob_hash
+        WHERE f.user_id = ? ORDER BY f.upload_date DESC, f.id DESC LIMIT ?
+    ''', (r['user_id'], PAGE_LIMIT)).fetchall(),
+    'uploaded_file': lambda conn, r: conn.execute(
+        'SELECT user_id, original_name, blob_hash, checksum FROM files WHERE filename = ?',
+        (r['filename'],)).fetchall(),
+    'albums': lambda conn, r: conn.execute('''
+        SELECT a.id, a.title, a.description, a.cover_photo, a.photo_count, a.created_at, b.thumb_status,
+               p.blob_hash
+        FROM albums a
+        LEFT JOIN photos p ON p.album_id = a.id AND p.filename = a.cover_photo
+        LEFT JOIN blobs b ON b.hash = p.blob_hash
+        WHERE a.user_id = ? ORDER BY a.created_at DESC
+    ''', (r['user_id'],)).fetchall(),
+    'view_album': lambda conn, r: conn.execute('''
+        SELECT p.id, p.filename, p.original_name, p.description, p.created_at, b.thumb_status, p.blob_hash,
+               p.taken_at, p.width, p.height, p.camera_model, p.created_at
+        FROM photos p LEFT JOIN blobs b ON b.hash = p.blob_hash
+        WHERE p.album_id = ? ORDER BY p.created_at DESC, p.id DESC LIMIT ?
+    ''', (r['album_id'], PAGE_LIMIT)).fetchall(),
+    # Полнотекстовый индекс не входит в idx_* и от миграций не зависит
+    'search': lambda conn, r: search.search(
+        conn, search.match_query(r['user_id'], search.terms('photo1')), None, PAGE_LIMIT),
+}
+
+
+def seed(conn, rows, users):
+    """Заполнение базы синтетическими данными"""
+    albums = max(1, rows // 100)
+    conn.executemany('INSERT INTO users (id, username, email, password_hash) VALUES (?, ?, ?, ?)',
+                     ((u, 'user%d' % u, 'user%d@example.com' % u, 'x') for u in range(1, users + 1)))
+    conn.executemany('''
+        INSERT INTO files (user_id, filename, original_name, file_type, file_size, upload_date)
+        VALUES (?, ?, ?, ?, ?, datetime('2024-01-01', ? || ' seconds'))
+    ''', ((random.randint(1, users), 'f%08d.jpg' % i, 'photo%d.jpg' % i, 'jpg', 1024, i)
+          for i in range(rows)))
+    conn.executemany('INSERT INTO albums (id, user_id, title) VALUES (?, ?, ?)',
+                     ((a, random.randint(1, users), 'album%d' % a) for a in range(1, albums + 1)))
+    conn.executemany('''
+        INSERT INTO photos (album_id, user_id, filename, original_name, created_at)
+        VALUES (?, ?, ?, ?, datetime('2024-01-01', ? || ' seconds'))
+    ''', ((random.randint(1, albums), 1, 'p%08d.jpg' % i, 'p%d.jpg' % i, i) for i in range(rows)))
+    conn.commit()
+    return albums
+
+
+def measure(conn, samples):
+    """Среднее время каждого запроса в миллисекундах"""
+    results = {}
+    for name, query in QUERIES.items():
+        started = time.perf_counter()
+        for sample in samples:
+            query(conn, sample)
+        results[name] = (time.perf_counter() - started) * 1000 / len(samples)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=1000000, help='строк в files и photos')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--samples', type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app.config['DATABASE'] = os.path.join(tmp, 'bench.db')
+        init_db()
+        conn = db.connect(app.config)
+
+        # Начальное состояние: база без индексов, как до миграций
+        indexes = conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'index' AND name LIKE 'idx_%'").fetchall()
+        for name, _ in indexes:
+            conn.execute('DROP INDEX ' + name)
+        print('Заполнение: %d строк...' % args.rows)
+        albums = seed(conn, args.rows, args.users)
+
+        samples = [{'user_id': random.randint(1, args.users),
+                    'filename': 'f%08d.jpg' % random.randrange(args.rows),
+                    'album_id': random.randint(1, albums)} for _ in range(args.samples)]
+        before = measure(conn, samples)
+
+        started = time.perf_counter()
+        for _, sql in indexes:
+            conn.execute(sql)
+        conn.commit()
+        print('Создание индексов на месте: %.1f с' % (time.perf_counter() - started))
+        after = measure(conn, samples)
+        conn.close()
+
+    print('\n%-15s %12s %12s %9s' % ('запрос', 'до, мс', 'после, мс', 'ускорение'))
+    for name in QUERIES:
+        print('%-15s %12.2f %12.2f %8.1fx' % (name, before[name], after[name], before[name] / max(after[name], 1e-6)))
+
+
+if __name__ == '__main__':
+    main()
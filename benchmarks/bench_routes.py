@@ -0,0 +1,421 @@
+#!/usr/bin/env python3
+"""
+Нагрузочный замер маршрутов: пропускная способность и задержки p50/p99
+
+    python benchmarks/bench_routes.py --rows 100000 --output baseline.json
+    python benchmarks/bench_routes.py --rows 1000000 --server --clients 16
+    python benchmarks/bench_routes.py --rows 100000 --baseline baseline.json
+
+База с синтетическими пользователями, файлами и альбомами создаётся во
+временном каталоге. Маршруты вызываются через тестовый клиент WSGI или
+(--server) через HTTP к локальному серверу из нескольких потоков. С
+--baseline результат сравнивается с сохранённым, и при ухудшении больше
+допуска скрипт завершается с кодом 1; baseline с другими --rows, --users,
+--clients или режимом не принимается (код 2). Все клиенты работают в одной сессии:
+вход выполняется один раз, ограничение попыток входа не мешает замеру.
+"""
+import argparse
+import http.client
+import io
+import json
+import logging
+import os
+import platform
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from urllib.parse import urlencode
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image
+from werkzeug.security import generate_password_hash
+from werkzeug.serving import make_server
+
+from app import app, init_db, rebuild_album_stats, rebuild_user_stats, upload_slots
+import db
+import search
+import storage
+import thumbnails
+
+PASSWORD = 'benchmark'
+FILE_TYPES = ['jpg', 'png', 'pdf', 'docx', 'txt', 'zip']
+DISTINCT_BLOBS = 64
+
+
+def make_jpeg(seed):
+    """Небольшая JPEG-картинка, разная для разных seed"""
+    rnd = random.Random(seed)
+    buf = io.BytesIO()
+    Image.new('RGB', (320, 240), (rnd.randrange(256), rnd.randrange(256), rnd.randrange(256))).save(buf, 'JPEG')
+    return buf.getvalue()
+
+
+def seed(conn, rows, users):
+    """Заполнение базы: users пользователей, rows файлов и rows фото в rows/100 альбомах
+
+    Содержимое - DISTINCT_BLOBS настоящих блобов с миниатюрами, на которые
+    ссылаются все строки. Триггеры на время вставки снимаются, сводные
+    данные и поисковый индекс затем пересчитываются целиком.
+    """
+    blobs = storage.get_blob_store(app)
+    hashes = []
+    for i in range(DISTINCT_BLOBS):
+        tmp_path, blob_hash, size = blobs.write_temp(io.BytesIO(make_jpeg(i)))
+        blobs.add_ref(conn, tmp_path, blob_hash, size)
+        hashes.append((blob_hash, size))
+    conn.commit()
+    for blob_hash, _ in hashes:
+        thumbnails.generate(app, blob_hash)
+
+    triggers = conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'trigger'").fetchall()
+    for name, _ in triggers:
+        conn.execute('DROP TRIGGER ' + name)
+
+    password_hash = generate_password_hash(PASSWORD, app.config['PASSWORD_HASH_METHOD'])
+    conn.executemany('INSERT INTO users (id, username, email, password_hash) VALUES (?, ?, ?, ?)',
+                     ((u, 'user%d' % u, 'user%d@example.com' % u, password_hash) for u in range(1, users + 1)))
+
+    def file_rows():
+        for i in range(rows):
+            blob_hash, size = hashes[i % DISTINCT_BLOBS]
+            ext = FILE_TYPES[i % len(FILE_TYPES)]
+            yield (i % users + 1, 'f%08d.%s' % (i, ext), 'file%d.%s' % (i, ext), ext, size,
+                   blob_hash, blob_hash, i)
+    conn.executemany('''
+        INSERT INTO files (user_id, filename, original_name, file_type, file_size, checksum, blob_hash, upload_date)
+        VALUES (?, ?, ?, ?, ?, ?, ?, datetime('2024-01-01', ? || ' seconds'))
+    ''', file_rows())
+
+    albums = max(1, rows // 100)
+    conn.executemany('INSERT INTO albums (id, user_id, title) VALUES (?, ?, ?)',
+                     ((a, (a - 1) % users + 1, 'album%d' % a) for a in range(1, albums + 1)))
+
+    def photo_rows():
+        for i in range(rows):
+            album_id = random.randint(1, albums)
+            blob_hash, size = hashes[i % DISTINCT_BLOBS]
+            yield (album_id, (album_id - 1) % users + 1, 'p%08d.jpg' % i, 'photo%d.jpg' % i, blob_hash, size, i)
+    conn.executemany('''
+        INSERT INTO photos (album_id, user_id, filename, original_name, blob_hash, file_size, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, datetime('2024-01-01', ? || ' seconds'))
+    ''', photo_rows())
+
+    conn.execute('''
+        UPDATE blobs SET refcount = (SELECT COUNT(*) FROM files WHERE blob_hash = blobs.hash)
+                                  + (SELECT COUNT(*) FROM photos WHERE blob_hash = blobs.hash)
+    ''')
+    for _, sql in triggers:
+        conn.execute(sql)
+    rebuild_user_stats(conn)
+    rebuild_album_stats(conn)
+    search.rebuild(conn)
+    conn.commit()
+    return albums
+
+
+def encode_multipart(field, filename, content):
+    """Тело multipart/form-data с одним файлом: (тело, Content-Type)"""
+    boundary = uuid.uuid4().hex
+    body = b''.join([
+        b'--' + boundary.encode() + b'\r\n',
+        'Content-Disposition: form-data; name="{0}"; filename="{1}"\r\n'.format(field, filename).encode(),
+        b'Content-Type: application/octet-stream\r\n\r\n',
+        content,
+        b'\r\n--' + boundary.encode() + b'--\r\n',
+    ])
+    return body, 'multipart/form-data; boundary=' + boundary
+
+
+class Context:
+    """Данные пользователя, от имени которого идут запросы"""
+
+    def __init__(self, conn, user_id):
+        self.username = 'user%d' % user_id
+        self.files = [r[0] for r in conn.execute(
+            'SELECT filename FROM files WHERE user_id = ? ORDER BY id LIMIT 1000', (user_id,))]
+        self.albums = [r[0] for r in conn.execute(
+            'SELECT id FROM albums WHERE user_id = ? ORDER BY id LIMIT 100', (user_id,))]
+        self.photo = make_jpeg('upload')
+
+
+# Сценарии: (i, контекст) -> (метод, путь, тело, Content-Type, (ожидаемый код, Location))
+# Успешная загрузка - перенаправление на /dashboard; отказ (квота, тип файла)
+# перенаправляет обратно на /upload или отвечает 4xx
+def _upload(i, ctx):
+    body, content_type = encode_multipart('file', 'bench%d.txt' % i, os.urandom(64 * 1024))
+    return 'POST', '/upload', body, content_type, (302, '/dashboard')
+
+
+def _add_photo(i, ctx):
+    # Случайный хвост после JPEG делает каждое фото новым блобом
+    body, content_type = encode_multipart('photo', 'bench%d.jpg' % i, ctx.photo + os.urandom(16))
+    return 'POST', '/album/%d/add_photo' % ctx.albums[i % len(ctx.albums)], body, content_type, (200, None)
+
+
+SCENARIOS = {
+    'dashboard': lambda i, ctx: ('GET', '/dashboard', None, None, (200, None)),
+    'view_album': lambda i, ctx: ('GET', '/album/%d' % ctx.albums[i % len(ctx.albums)], None, None, (200, None)),
+    'uploaded_file': lambda i, ctx: ('GET', '/uploads/' + ctx.files[i % len(ctx.files)], None, None, (200, None)),
+    'upload': _upload,
+    'add_photo': _add_photo,
+}
+
+
+def matches(result, expected):
+    """Ответ (код, Location) совпадает с ожидаемым; Location сравнивается по пути"""
+    status, location = result
+    expected_status, expected_location = expected
+    if status != expected_status:
+        return False
+    if expected_location is None:
+        return location is None
+    return location is not None and location.split('?', 1)[0].endswith(expected_location)
+
+
+def login(client, ctx):
+    """Вход с проверкой, что сессия действительно авторизована"""
+    result = client.request('POST', '/login', urlencode({'username': ctx.username, 'password': PASSWORD}).encode(),
+                            'application/x-www-form-urlencoded')
+    if not matches(result, (302, '/dashboard')) or not matches(client.request('GET', '/dashboard'), (200, None)):
+        raise RuntimeError('Не удалось войти как %s: ответ %s' % (ctx.username, result))
+    return client.session_cookie()
+
+
+SESSION_COOKIE = app.config['SESSION_COOKIE_NAME']
+
+
+class WSGIClient:
+    """Запросы через тестовый клиент Flask"""
+
+    def __init__(self, cookie=None):
+        self.client = app.test_client()
+        if cookie:
+            self.client.set_cookie(SESSION_COOKIE, cookie)
+
+    def session_cookie(self):
+        cookie = self.client.get_cookie(SESSION_COOKIE)
+        return cookie.value if cookie else None
+
+    def request(self, method, path, body=None, content_type=None):
+        response = self.client.open(path, method=method, data=body, content_type=content_type)
+        for _ in response.response:
+            pass
+        response.close()
+        return response.status_code, response.headers.get('Location')
+
+
+class HTTPClient:
+    """Запросы по HTTP с постоянным соединением и cookie сессии"""
+
+    def __init__(self, host, port, cookie=None):
+        self.connection = http.client.HTTPConnection(host, port, timeout=60)
+        self.cookie = cookie
+
+    def session_cookie(self):
+        return self.cookie
+
+    def request(self, method, path, body=None, content_type=None):
+        headers = {}
+        if content_type:
+            headers['Content-Type'] = content_type
+        if self.cookie:
+            headers['Cookie'] = '%s=%s' % (SESSION_COOKIE, self.cookie)
+        self.connection.request(method, path, body=body, headers=headers)
+        response = self.connection.getresponse()
+        response.read()
+        for header in response.msg.get_all('Set-Cookie') or ():
+            name, _, value = header.split(';', 1)[0].partition('=')
+            if name == SESSION_COOKIE:
+                self.cookie = value
+        return response.status, response.getheader('Location')
+
+
+def percentile(sorted_values, p):
+    """Перцентиль по ближайшему рангу"""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(p / 100.0 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def run_scenario(name, pool, ctx, requests, warmup):
+    """Выполнение сценария из потоков по числу клиентов pool; возвращает сводку замера"""
+    scenario = SCENARIOS[name]
+    latencies = []
+    errors = [0]
+    counter = iter(range(requests))
+    lock = threading.Lock()
+
+    def worker(client):
+        local = []
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                break
+            method, path, body, content_type, expected = scenario(i, ctx)
+            started = time.perf_counter()
+            result = client.request(method, path, body, content_type)
+            local.append(time.perf_counter() - started)
+            if not matches(result, expected):
+                with lock:
+                    errors[0] += 1
+        with lock:
+            latencies.extend(local)
+
+    for i in range(warmup):
+        method, path, body, content_type, _ = scenario(requests + i, ctx)
+        pool[i % len(pool)].request(method, path, body, content_type)
+
+    threads = [threading.Thread(target=worker, args=(client,)) for client in pool]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': errors[0],
+        'throughput': len(latencies) / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+    }
+
+
+# Параметры замера, при которых результаты сравнимы между собой
+COMPARABLE_META = ('rows', 'users', 'clients', 'mode')
+
+
+def meta_mismatch(meta, baseline):
+    """Расхождения параметров замера с baseline: [(ключ, сейчас, в baseline)]"""
+    base = baseline.get('meta', {})
+    return [(key, meta[key], base.get(key)) for key in COMPARABLE_META if base.get(key) != meta[key]]
+
+
+def compare(results, baseline, tolerance):
+    """Список ухудшений относительно baseline (пустой, если их нет)"""
+    regressions = []
+    for name, current in results['results'].items():
+        base = baseline.get('results', {}).get(name)
+        if base is None:
+            continue
+        if current['errors']:
+            regressions.append('%s: ошибок %d' % (name, current['errors']))
+        for key in ('p50_ms', 'p99_ms'):
+            if current[key] > base[key] * (1 + tolerance):
+                regressions.append('%s: %s %.2f > %.2f' % (name, key, current[key], base[key]))
+        if current['throughput'] < base['throughput'] * (1 - tolerance):
+            regressions.append('%s: throughput %.1f < %.1f' % (name, current['throughput'], base['throughput']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=10000, help='строк в files и photos')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--requests', type=int, default=200, help='запросов на сценарий')
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--clients', type=int, default=1, help='параллельных клиентов')
+    parser.add_argument('--server', action='store_true', help='HTTP к локальному серверу вместо тестового клиента')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='через запятую')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='сохранить результат в JSON')
+    parser.add_argument('--baseline', help='JSON с результатом для сравнения')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='допустимое ухудшение (доля)')
+    args = parser.parse_args()
+    random.seed(args.seed)
+    names = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = set(names) - set(SCENARIOS)
+    if unknown:
+        parser.error('неизвестные сценарии: ' + ', '.join(sorted(unknown)))
+    meta = {
+        'rows': args.rows,
+        'users': args.users,
+        'requests': args.requests,
+        'clients': args.clients,
+        'mode': 'server' if args.server else 'wsgi',
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+    }
+
+    baseline = None
+    if args.baseline:
+        # Замеры с другим числом строк, клиентов или режимом несравнимы:
+        # проверка до заполнения базы, чтобы не тратить время впустую
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        mismatch = meta_mismatch(meta, baseline)
+        if mismatch:
+            for key, current, base in mismatch:
+                print('%s: %s, в %s: %s' % (key, current, args.baseline, base))
+            print('Параметры замера не совпадают с baseline, сравнение невозможно')
+            sys.exit(2)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app.config['DATABASE'] = os.path.join(tmp, 'bench.db')
+        app.config['UPLOAD_FOLDER'] = os.path.join(tmp, 'uploads')
+        app.config['ALBUMS_FOLDER'] = os.path.join(tmp, 'albums')
+        app.config['BLOBS_FOLDER'] = os.path.join(tmp, 'blobs')
+        init_db()
+        conn = db.connect(app.config)
+        print('Заполнение: %d строк, %d пользователей...' % (args.rows, args.users))
+        started = time.perf_counter()
+        seed(conn, args.rows, args.users)
+        print('Заполнено за %.1f с' % (time.perf_counter() - started))
+        ctx = Context(conn, 1)
+        conn.close()
+
+        server = None
+        if args.server:
+            logging.getLogger('werkzeug').setLevel(logging.WARNING)
+            server = make_server('127.0.0.1', 0, app, threaded=True)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            make_client = lambda cookie=None: HTTPClient('127.0.0.1', server.server_port, cookie)
+        else:
+            make_client = WSGIClient
+
+        results = {}
+        try:
+            # Один вход на весь замер: клиенты разделяют его сессию, и ограничение
+            # одновременных загрузок пользователя не должно срезать параллельность
+            upload_slots.limit = max(upload_slots.limit, args.clients)
+            cookie = login(make_client(), ctx)
+            pool = [make_client(cookie) for _ in range(args.clients)]
+            for name in names:
+                results[name] = run_scenario(name, pool, ctx, args.requests, args.warmup)
+                r = results[name]
+                print('%-15s %8.1f req/s  p50 %8.2f мс  p99 %8.2f мс  ошибок %d'
+                      % (name, r['throughput'], r['p50_ms'], r['p99_ms'], r['errors']))
+        finally:
+            if server is not None:
+                server.shutdown()
+            thumbnails.get_executor(app).shutdown(wait=True)
+
+    report = {
+        'meta': dict(meta, timestamp=time.strftime('%Y-%m-%dT%H:%M:%S')),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print('Результат сохранён в ' + args.output)
+
+    if baseline is not None:
+        regressions = compare(report, baseline, args.tolerance)
+        if regressions:
+            print('\nУхудшения относительно %s:' % args.baseline)
+            for line in regressions:
+                print('  ' + line)
+            sys.exit(1)
+        print('Ухудшений относительно %s нет' % args.baseline)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+"""
+Кэширование в памяти процесса
+Ограниченный LRU-кэш со сроком жизни записей и сменные бэкенды кэша
+"""
+
+import importlib
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+
+def sizeof(value):
+    """Приблизительный размер значения в байтах (для бюджета памяти)"""
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(sizeof(k) + sizeof(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sum(sizeof(v) for v in value)
+    return sys.getsizeof(value)
+
+
+class LRUCache:
+    """Потокобезопасный LRU-кэш: не больше maxsize записей, каждая живёт ttl секунд
+
+    При переполнении вытесняется запись, к которой дольше всего не
+    обращались. Если задан maxbytes, вытеснение идёт и по суммарному
+    размеру значений. Просроченные записи удаляются при чтении.
+    """
+
+    def __init__(self, maxsize=1024, ttl=300, maxbytes=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        """Значение по ключу или default, если его нет или срок истёк"""
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                value, expires, size = item
+                if expires > now:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self._pop(key)
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        """Запись значения; ttl переопределяет срок жизни по умолчанию"""
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        size = sizeof(value) if self.maxbytes else 0
+        if self.maxbytes and size > self.maxbytes:
+            return
+        with self._lock:
+            self._pop(key)
+            self._data[key] = (value, expires, size)
+            self._bytes += size
+            while len(self._data) > self.maxsize or (self.maxbytes and self._bytes > self.maxbytes):
+                self._pop(next(iter(self._data)))
+
+    def delete(self, key):
+        """Удаление записи (если есть)"""
+        with self._lock:
+            self._pop(key)
+
+    def clear(self):
+        """Удаление всех записей"""
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def _pop(self, key):
+        item = self._data.pop(key, None)
+        if item is not None:
+            self._bytes -= item[2]
+
+    def __len__(self):
+        return len(self._data)
+
+
+class NullCache:
+    """Бэкенд без хранения - отключает кэш"""
+
+    def __init__(self, **options):
+        pass
+
+    def get(self, key, default=None):
+        return default
+
+    def set(self, key, value, ttl=None):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def clear(self):
+        pass
+
+
+# Встроенные бэкенды; другой можно указать как 'модуль:Класс' с тем же интерфейсом
+BACKENDS = {
+    'memory': LRUCache,
+    'null': NullCache,
+}
+
+
+def create(backend, **options):
+    """Кэш по имени бэкенда или пути 'модуль:Класс'"""
+    if backend in BACKENDS:
+        cls = BACKENDS[backend]
+    else:
+        module_name, _, class_name = backend.partition(':')
+        cls = getattr(importlib.import_module(module_name), class_name)
+    return cls(**options)
@@ -0,0 +1,197 @@
+"""
+Слой доступа к базе данных SQLite
+Пул соединений, настройка PRAGMA и соединение на время запроса
+"""
+
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from flask import g, current_app
+
+# Значения по умолчанию для настроек базы данных
+DEFAULT_CONFIG = {
+    'SQLITE_JOURNAL_MODE': 'WAL',
+    'SQLITE_SYNCHRONOUS': 'NORMAL',       # NORMAL безопасен в режиме WAL
+    'SQLITE_CACHE_SIZE': -16000,          # Отрицательное значение - размер в КБ
+    'SQLITE_MMAP_SIZE': 64 * 1024 * 1024,
+    'SQLITE_BUSY_TIMEOUT': 5000,          # мс ожидания снятия блокировки
+    'SQLITE_POOL_SIZE': 8,
+}
+
+
+# Обработчик выполненных запросов: функция (sql, секунды) или None (см. metrics)
+query_listener = None
+
+
+class Cursor(sqlite3.Cursor):
+    """Курсор, сообщающий время выполнения запросов в query_listener"""
+
+    def execute(self, sql, parameters=()):
+        if query_listener is None:
+            return super().execute(sql, parameters)
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            query_listener(sql, time.perf_counter() - start)
+
+    def executemany(self, sql, seq_of_parameters):
+        if query_listener is None:
+            return super().executemany(sql, seq_of_parameters)
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            query_listener(sql, time.perf_counter() - start)
+
+
+class Connection(sqlite3.Connection):
+    """Соединение, все запросы которого идут через Cursor"""
+
+    def cursor(self, factory=Cursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def connect(config):
+    """Открытие нового соединения с применением PRAGMA из конфигурации"""
+    conn = sqlite3.connect(
+        config['DATABASE'],
+        timeout=config['SQLITE_BUSY_TIMEOUT'] / 1000.0,
+        check_same_thread=False,
+        factory=Connection,
+    )
+    conn.execute('PRAGMA busy_timeout = {0:d}'.format(int(config['SQLITE_BUSY_TIMEOUT'])))
+    conn.execute('PRAGMA journal_mode = {0}'.format(config['SQLITE_JOURNAL_MODE']))
+    conn.execute('PRAGMA synchronous = {0}'.format(config['SQLITE_SYNCHRONOUS']))
+    conn.execute('PRAGMA cache_size = {0:d}'.format(int(config['SQLITE_CACHE_SIZE'])))
+    conn.execute('PRAGMA mmap_size = {0:d}'.format(int(config['SQLITE_MMAP_SIZE'])))
+    conn.execute('PRAGMA temp_store = MEMORY')
+    return conn
+
+
+class ConnectionPool:
+    """Ограниченный пул переиспользуемых соединений"""
+
+    def __init__(self, config):
+        self.config = config
+        self._idle = queue.LifoQueue(maxsize=config['SQLITE_POOL_SIZE'])
+        self._lock = threading.Lock()
+        self._database = config['DATABASE']
+
+    def acquire(self):
+        """Взять соединение из пула или открыть новое"""
+        self._check_database()
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return connect(self.config)
+
+    def release(self, conn):
+        """Вернуть соединение в пул, откатив незавершённую транзакцию"""
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            self._idle.put_nowait(conn)
+        except (queue.Full, sqlite3.Error):
+            conn.close()
+
+    def close_all(self):
+        """Закрыть все простаивающие соединения"""
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+    def _check_database(self):
+        # Смена пути к базе (например, в тестах) сбрасывает пул
+        if self.config['DATABASE'] != self._database:
+            with self._lock:
+                self.close_all()
+                self._database = self.config['DATABASE']
+
+
+def get_pool(app=None):
+    """Пул соединений приложения"""
+    app = app or current_app
+    return app.extensions['sqlite_pool']
+
+
+def get_db():
+    """Соединение, закреплённое за текущим запросом"""
+    if 'db' not in g:
+        g.db = get_pool().acquire()
+    return g.db
+
+
+def close_db(e=None):
+    """Возврат соединения запроса в пул"""
+    conn = g.pop('db', None)
+    if conn is not None:
+        get_pool().release(conn)
+
+
+@contextmanager
+def pooled_connection(app=None):
+    """Соединение из пула для кода вне запроса (фоновые задачи, команды)"""
+    pool = get_pool(app)
+    conn = pool.acquire()
+    try:
+        yield conn
+    finally:
+        pool.release(conn)
+
+
+def init_app(app):
+    """Регистрация пула и закрытия соединения после запроса"""
+    for key, value in DEFAULT_CONFIG.items():
+        app.config.setdefault(key, value)
+    app.extensions['sqlite_pool'] = ConnectionPool(app.config)
+    app.teardown_appcontext(close_db)
+
+
+def migrate(conn, migrations):
+    """Применение версионированных миграций схемы (PRAGMA user_version)
+
+    migrations - список пар (версия, SQL-скрипт или функция от соединения).
+    Каждая миграция выполняется в отдельной транзакции вместе с записью
+    новой версии, поэтому существующая база обновляется на месте.
+    """
+    current = conn.execute('PRAGMA user_version').fetchone()[0]
+    for version, step in sorted(migrations, key=lambda m: m[0]):
+        if version <= current:
+            continue
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if callable(step):
+                step(conn)
+            else:
+                for statement in split_statements(step):
+                    conn.execute(statement)
+            conn.execute('PRAGMA user_version = {0:d}'.format(version))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        current = version
+    return current
+
+
+def split_statements(script):
+    """Разбиение SQL-скрипта на отдельные инструкции (с учётом триггеров)"""
+    statement = ''
+    for line in script.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            yield statement.strip()
+            statement = ''
+    if statement.strip():
+        yield statement.strip()
@@ -0,0 +1,294 @@
+"""
+Изображения нужного размера и формата по запросу (/img)
+Уменьшение и перекодирование выполняются в пуле процессов; готовые варианты
+хранятся в дисковом кэше, давно не запрошенные вытесняются по общему объёму
+"""
+
+import hashlib
+import math
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ProcessPoolExecutor, TimeoutError
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow не установлен - эндпоинт недоступен
+    Image = None
+
+# Формат запроса -> (формат Pillow, MIME-тип, параметры сохранения)
+FORMATS = {
+    'avif': ('AVIF', 'image/avif', {'speed': 6}),
+    'webp': ('WEBP', 'image/webp', {'method': 4}),
+    'jpeg': ('JPEG', 'image/jpeg', {'optimize': True, 'progressive': True}),
+}
+# Порядок выбора по заголовку Accept, если формат не указан (JPEG - всегда)
+PREFERRED = ('avif', 'webp')
+
+MIN_QUALITY = 30
+MAX_QUALITY = 95
+
+ORIENTATION = 0x0112
+
+# Меняется вместе с алгоритмом обработки: старые варианты в кэше перестают использоваться
+VERSION = 1
+
+_executor = None
+_executor_lock = threading.Lock()
+_slots = None
+
+# Обработки, идущие сейчас: ключ кэша -> Future с путём к результату
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+
+class Overloaded(Exception):
+    """Очередь обработки переполнена или результат не получен вовремя"""
+
+
+class Unreadable(Exception):
+    """Файл не удалось прочитать как изображение"""
+
+
+def available():
+    """Можно ли обрабатывать изображения (установлен ли Pillow)"""
+    return Image is not None
+
+
+def supported_formats():
+    """Форматы, которые умеет сохранять установленный Pillow"""
+    if Image is None:
+        return set()
+    Image.init()
+    return {name for name, (pil_format, _, _) in FORMATS.items() if pil_format in Image.SAVE}
+
+
+def snap(value, sizes):
+    """Наименьший допустимый размер не меньше value (или наибольший допустимый)"""
+    for size in sizes:
+        if size >= value:
+            return size
+    return sizes[-1]
+
+
+def snap_quality(value):
+    """Качество в пределах [MIN_QUALITY, MAX_QUALITY] с шагом 5"""
+    return min(MAX_QUALITY, max(MIN_QUALITY, int(round(value / 5.0)) * 5))
+
+
+def cache_key(source, width, height, fmt, quality):
+    """Ключ варианта: версия содержимого (хеш блоба) и параметры обработки"""
+    raw = '{0}|{1}|{2}|{3}|{4}|{5}'.format(VERSION, source, width or 0, height or 0, fmt, quality)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+def render(src_path, dst_path, width, height, fmt, quality):
+    """Задача пула: изображение, вписанное в рамку width x height, в формате fmt
+
+    Увеличения нет. JPEG декодируется сразу в уменьшенном масштабе (draft),
+    поэтому 10-мегабайтное фото не разворачивается целиком в память.
+    Возвращает размер результата в байтах.
+    """
+    try:
+        return _render(src_path, dst_path, width, height, fmt, quality)
+    except (OSError, ValueError, SyntaxError, Image.DecompressionBombError) as e:
+        # Исключения Pillow передаются из процесса пула не всегда
+        raise Unreadable(str(e)) from None
+
+
+def _render(src_path, dst_path, width, height, fmt, quality):
+    pil_format, _, params = FORMATS[fmt]
+    with Image.open(src_path) as image:
+        # Ориентации 5-8 поворачивают кадр на 90 градусов
+        rotated = image.getexif().get(ORIENTATION) in (5, 6, 7, 8)
+        shown_width, shown_height = (image.height, image.width) if rotated else image.size
+        scale = min(width / shown_width if width else 1.0, height / shown_height if height else 1.0, 1.0)
+        target = (max(1, math.ceil(shown_width * scale)), max(1, math.ceil(shown_height * scale)))
+        image.draft('RGB', (target[1], target[0]) if rotated else target)
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail(target, Image.LANCZOS)
+
+        if fmt == 'jpeg' and image.mode != 'RGB':
+            if image.mode in ('RGBA', 'LA', 'P'):
+                # Прозрачность - на белом фоне
+                image = image.convert('RGBA')
+                background = Image.new('RGB', image.size, (255, 255, 255))
+                background.paste(image, mask=image.getchannel('A'))
+                image = background
+            else:
+                image = image.convert('RGB')
+        elif image.mode not in ('RGB', 'RGBA'):
+            alpha = image.mode in ('LA', 'PA') or 'transparency' in image.info
+            image = image.convert('RGBA' if alpha else 'RGB')
+
+        image.save(dst_path, pil_format, quality=quality, **params)
+    return os.path.getsize(dst_path)
+
+
+class DiskCache:
+    """Дисковый кэш файлов с вытеснением давно не использованных
+
+    Время последнего обращения - mtime файла (обновляется при попадании,
+    не чаще раза в touch_interval секунд). Когда объём превышает max_bytes,
+    каталог просматривается и самые старые файлы удаляются, пока объём не
+    опустится до low_water от бюджета: полный просмотр нужен редко.
+    """
+
+    def __init__(self, root, max_bytes, low_water=0.9, touch_interval=60):
+        self.root = root
+        self.tmp_dir = os.path.join(root, 'tmp')
+        self.max_bytes = max_bytes
+        self.low_water = low_water
+        self.touch_interval = touch_interval
+        self._size = None
+        self._lock = threading.Lock()
+
+    def path(self, key, ext):
+        return os.path.join(self.root, key[:2], '{0}.{1}'.format(key, ext))
+
+    def get(self, key, ext):
+        """Путь к файлу из кэша или None"""
+        path = self.path(key, ext)
+        try:
+            mtime = os.stat(path).st_mtime
+        except FileNotFoundError:
+            return None
+        if time.time() - mtime > self.touch_interval:
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                # Вытеснен другим процессом
+                return None
+        return path
+
+    def temp_path(self):
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        return os.path.join(self.tmp_dir, uuid.uuid4().hex)
+
+    def add(self, tmp_path, key, ext, size):
+        """Перенос готового файла в кэш; при превышении бюджета - вытеснение"""
+        path = self.path(key, ext)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+        with self._lock:
+            if self._size is None:
+                self._size = sum(entry[2] for entry in self._scan())
+            else:
+                self._size += size
+            if self._size > self.max_bytes:
+                self._evict()
+        return path
+
+    def size(self):
+        """Объём кэша в байтах (по подсчёту этого процесса)"""
+        return self._size or 0
+
+    def _scan(self):
+        """(время обращения, путь, размер) всех файлов кэша"""
+        entries = []
+        if not os.path.isdir(self.root):
+            return entries
+        for shard in os.scandir(self.root):
+            if not shard.is_dir() or shard.path == self.tmp_dir:
+                continue
+            for entry in os.scandir(shard.path):
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, entry.path, st.st_size))
+        return entries
+
+    def _evict(self):
+        entries = sorted(self._scan())
+        total = sum(entry[2] for entry in entries)
+        target = self.max_bytes * self.low_water
+        for _, path, size in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self._size = total
+        # Временные файлы оборванных обработок
+        if os.path.isdir(self.tmp_dir):
+            for entry in os.scandir(self.tmp_dir):
+                try:
+                    if time.time() - entry.stat().st_mtime > 3600:
+                        os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+
+
+def get_executor(app):
+    """Общий пул процессов обработки изображений"""
+    global _executor, _slots
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(
+                max_workers=app.config['IMG_WORKERS'],
+                mp_context=multiprocessing.get_context(app.config['PROCESS_START_METHOD']))
+            _slots = threading.BoundedSemaphore(app.config['IMG_QUEUE_LIMIT'])
+    return _executor
+
+
+def _process(app, cache, key, fmt, source, width, height, quality):
+    """Обработка в пуле и перенос результата в кэш"""
+    executor = get_executor(app)
+    tmp_path = cache.temp_path()
+    # Слот занимается, когда оригинал уже получен: ошибка чтения источника
+    # (нет файла, сбой S3) не должна уносить его с собой
+    with source() as src_path:
+        if not _slots.acquire(blocking=False):
+            raise Overloaded()
+        try:
+            future = executor.submit(render, src_path, tmp_path, width, height, fmt, quality)
+        except BaseException:
+            _slots.release()
+            raise
+        future.add_done_callback(lambda _: _slots.release())
+        try:
+            size = future.result(timeout=app.config['IMG_TIMEOUT'])
+        except TimeoutError:
+            # Недописанный файл уберёт очистка временных файлов кэша
+            raise Overloaded() from None
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+    return cache.add(tmp_path, key, fmt, size)
+
+
+def rendition(app, cache, key, fmt, source, width, height, quality):
+    """Путь к готовому варианту: из кэша или после обработки в пуле
+
+    source - функция, возвращающая контекст с локальным путём к оригиналу.
+    Одинаковые запросы, пришедшие одновременно, ждут одну обработку.
+    """
+    path = cache.get(key, fmt)
+    if path is not None:
+        return path
+    with _inflight_lock:
+        future = _inflight.get(key)
+        owner = future is None
+        if owner:
+            future = _inflight[key] = Future()
+    if not owner:
+        try:
+            return future.result(timeout=app.config['IMG_TIMEOUT'])
+        except TimeoutError:
+            raise Overloaded() from None
+    try:
+        path = _process(app, cache, key, fmt, source, width, height, quality)
+        future.set_result(path)
+        return path
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _inflight_lock:
+            _inflight.pop(key, None)
@@ -0,0 +1,262 @@
+"""
+Метрики производительности в формате Prometheus
+Время ответа по маршрутам, число и время запросов к SQLite, объём
+переданных данных, длина очередей; журнал медленных запросов
+"""
+
+import hmac
+import ipaddress
+import logging
+import threading
+import time
+from collections import defaultdict
+
+from flask import Response, abort, current_app, g, has_request_context, request
+
+import db
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм времени (с) и числа запросов к базе
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+
+DEFAULT_CONFIG = {
+    'METRICS_ENABLED': True,
+    'METRICS_TOKEN': None,                # Если задан - /metrics требует Authorization: Bearer <токен>
+    'METRICS_ALLOW_LOOPBACK': False,      # Без токена отдавать /metrics прямым запросам с localhost
+    'SLOW_REQUEST_THRESHOLD': None,       # с; запросы дольше пишутся в журнал с разбивкой по SQL
+}
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ('{0}="{1}"'.format(n, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+             for n, v in zip(names, values))
+    return '{' + ','.join(pairs) + '}'
+
+
+class Counter:
+    """Монотонный счётчик с метками"""
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, *labelvalues):
+        with self._lock:
+            self._values[labelvalues] += amount
+
+    def collect(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        for labelvalues, value in items:
+            yield self.name, _format_labels(self.labelnames, labelvalues), value
+
+
+class Histogram:
+    """Гистограмма с накопительными корзинами, суммой и числом наблюдений"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labelvalues):
+        with self._lock:
+            state = self._values.get(labelvalues)
+            if state is None:
+                state = self._values[labelvalues] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+            state[1] += value
+            state[2] += 1
+
+    def collect(self):
+        with self._lock:
+            items = sorted((k, (list(v[0]), v[1], v[2])) for k, v in self._values.items())
+        names = self.labelnames + ('le',)
+        for labelvalues, (counts, total, count) in items:
+            for bound, bucket_count in zip(self.buckets, counts):
+                yield self.name + '_bucket', _format_labels(names, labelvalues + (bound,)), bucket_count
+            yield self.name + '_bucket', _format_labels(names, labelvalues + ('+Inf',)), count
+            labels = _format_labels(self.labelnames, labelvalues)
+            yield self.name + '_sum', labels, total
+            yield self.name + '_count', labels, count
+
+
+class Gauge:
+    """Значение, вычисляемое при каждом сборе метрик"""
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, callback):
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+
+    def collect(self):
+        yield self.name, '', self.callback()
+
+
+class Registry:
+    """Набор метрик процесса"""
+
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge(self, name, documentation, callback):
+        return self._register(Gauge(name, documentation, callback))
+
+    def _register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Текстовый формат Prometheus"""
+        lines = []
+        for metric in self.metrics:
+            try:
+                samples = list(metric.collect())
+            except Exception:
+                logger.exception('Не удалось собрать метрику %s', metric.name)
+                continue
+            lines.append('# HELP {0} {1}'.format(metric.name, metric.documentation))
+            lines.append('# TYPE {0} {1}'.format(metric.name, metric.kind))
+            for name, labels, value in samples:
+                lines.append('{0}{1} {2}'.format(name, labels, _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+def _format_value(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+registry = Registry()
+
+REQUEST_DURATION = registry.histogram(
+    'oblako_request_duration_seconds', 'Время обработки запроса', ('endpoint', 'method'))
+REQUESTS = registry.counter(
+    'oblako_requests_total', 'Число запросов по маршрутам и кодам ответа', ('endpoint', 'method', 'status'))
+DB_QUERIES = registry.histogram(
+    'oblako_db_queries_per_request', 'Число запросов к SQLite за HTTP-запрос', ('endpoint',),
+    buckets=QUERY_COUNT_BUCKETS)
+DB_TIME = registry.counter(
+    'oblako_db_time_seconds_total', 'Время выполнения запросов к SQLite', ('endpoint',))
+BYTES_RECEIVED = registry.counter(
+    'oblako_bytes_received_total', 'Принято байт в телах запросов', ('endpoint',))
+BYTES_SENT = registry.counter(
+    'oblako_bytes_sent_total', 'Отправлено байт в телах ответов (с известной длиной)', ('endpoint',))
+BACKGROUND_QUERIES = registry.counter(
+    'oblako_db_background_time_seconds_total', 'Время запросов к SQLite вне HTTP-запросов (фоновые задачи)')
+
+
+def record_query(sql, seconds):
+    """Учёт выполненного запроса к SQLite (db.query_listener)"""
+    if has_request_context() and 'metrics_queries' in g:
+        g.metrics_queries.append((sql, seconds))
+    else:
+        BACKGROUND_QUERIES.inc(seconds)
+
+
+def _before_request():
+    g.metrics_start = time.perf_counter()
+    g.metrics_queries = []
+
+
+def _after_request(response):
+    start = g.pop('metrics_start', None)
+    if start is None:
+        return response
+    duration = time.perf_counter() - start
+    queries = g.pop('metrics_queries', [])
+    endpoint = request.endpoint or 'unknown'
+
+    REQUEST_DURATION.observe(duration, endpoint, request.method)
+    REQUESTS.inc(1, endpoint, request.method, response.status_code)
+    DB_QUERIES.observe(len(queries), endpoint)
+    DB_TIME.inc(sum(s for _, s in queries), endpoint)
+    if request.content_length:
+        BYTES_RECEIVED.inc(request.content_length, endpoint)
+    if response.content_length:
+        # Потоковые ответы без длины (ZIP) не учитываются
+        BYTES_SENT.inc(response.content_length, endpoint)
+
+    threshold = current_app.config['SLOW_REQUEST_THRESHOLD']
+    if threshold is not None and duration >= threshold:
+        log_slow_request(duration, queries)
+    return response
+
+
+def log_slow_request(duration, queries):
+    """Запись медленного запроса в журнал с разбивкой времени по SQL"""
+    by_statement = defaultdict(lambda: [0, 0.0])
+    for sql, seconds in queries:
+        key = ' '.join(sql.split())[:200]
+        by_statement[key][0] += 1
+        by_statement[key][1] += seconds
+    lines = ['Медленный запрос {0} {1}: {2:.3f} с, запросов к базе: {3} ({4:.3f} с)'.format(
+        request.method, request.full_path.rstrip('?'), duration, len(queries),
+        sum(s for _, s in queries))]
+    for sql, (count, seconds) in sorted(by_statement.items(), key=lambda item: -item[1][1])[:10]:
+        lines.append('  {0:8.3f} с  x{1:<4d} {2}'.format(seconds, count, sql))
+    logger.warning('\n'.join(lines))
+
+
+def _is_loopback(address):
+    try:
+        return ipaddress.ip_address(address or '').is_loopback
+    except ValueError:
+        return False
+
+
+def metrics_view():
+    """Страница /metrics
+
+    Метрики раскрывают адреса маршрутов, нагрузку и запросы к базе, поэтому
+    отдаются по токену. Без токена - только если явно включён
+    METRICS_ALLOW_LOOPBACK, и только прямым запросам с localhost: за
+    обратным прокси на той же машине с 127.0.0.1 приходят все клиенты,
+    такие запросы узнаются по X-Forwarded-For.
+    """
+    config = current_app.config
+    token = config['METRICS_TOKEN']
+    if token:
+        if not hmac.compare_digest(request.headers.get('Authorization', ''), 'Bearer ' + token):
+            abort(403)
+    elif not (config['METRICS_ALLOW_LOOPBACK'] and _is_loopback(request.remote_addr)
+              and 'X-Forwarded-For' not in request.headers and 'Forwarded' not in request.headers):
+        abort(403)
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+
+def init_app(app):
+    """Подключение замеров к приложению и страницы /metrics"""
+    for key, value in DEFAULT_CONFIG.items():
+        app.config.setdefault(key, value)
+    if not app.config['METRICS_ENABLED']:
+        return
+    db.query_listener = record_query
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
@@ -0,0 +1,89 @@
+"""
+Хеширование и проверка паролей в пуле процессов
+Хеш пароля намеренно дорог по CPU: в потоке запроса он держал бы GIL и
+задерживал загрузки и скачивания на том же воркере. Очередь к пулу
+ограничена - при её переполнении вход отклоняется сразу, а не копится
+"""
+
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+_executor = None
+_executor_lock = threading.Lock()
+_slots = None
+
+# Префикс хеша (алгоритм и параметры) для настроенного метода
+_method_prefixes = {}
+
+
+class Overloaded(Exception):
+    """Очередь проверки паролей переполнена или ответ не получен вовремя"""
+
+
+def get_executor(app):
+    """Общий пул процессов для хеширования (все процессы запускаются при первом задании)"""
+    global _executor, _slots
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(
+                max_workers=app.config['PASSWORD_WORKERS'],
+                mp_context=multiprocessing.get_context(app.config['PROCESS_START_METHOD']))
+            _slots = threading.BoundedSemaphore(app.config['PASSWORD_QUEUE_LIMIT'])
+    return _executor
+
+
+def _run(app, fn, *args):
+    """Выполнение задачи в пуле с ожиданием результата"""
+    executor = get_executor(app)
+    if not _slots.acquire(blocking=False):
+        raise Overloaded()
+    try:
+        future = executor.submit(fn, *args)
+    except BaseException:
+        _slots.release()
+        raise
+    future.add_done_callback(lambda _: _slots.release())
+    try:
+        return future.result(timeout=app.config['PASSWORD_TIMEOUT'])
+    except TimeoutError:
+        raise Overloaded() from None
+
+
+def _method_prefix(method):
+    return generate_password_hash('', method).split('$', 1)[0]
+
+
+def method_prefix(app):
+    """Алгоритм и параметры хешей, которые создаёт PASSWORD_HASH_METHOD ('scrypt' -> 'scrypt:32768:8:1')"""
+    method = app.config['PASSWORD_HASH_METHOD']
+    if method not in _method_prefixes:
+        _method_prefixes[method] = _run(app, _method_prefix, method)
+    return _method_prefixes[method]
+
+
+def needs_rehash(pwhash, prefix):
+    """Создан ли хеш другим алгоритмом или с другими параметрами"""
+    return pwhash.split('$', 1)[0] != prefix
+
+
+def _verify(pwhash, password, method, prefix):
+    if not check_password_hash(pwhash, password):
+        return False, None
+    return True, generate_password_hash(password, method) if needs_rehash(pwhash, prefix) else None
+
+
+def verify(app, pwhash, password):
+    """Проверка пароля: (верен ли, новый хеш или None)
+
+    Хеш старым алгоритмом или с устаревшими параметрами пересчитывается
+    тем же заданием пула - пароль в открытом виде есть только при входе.
+    """
+    return _run(app, _verify, pwhash, password, app.config['PASSWORD_HASH_METHOD'], method_prefix(app))
+
+
+def hash_password(app, password):
+    """Хеш нового пароля методом PASSWORD_HASH_METHOD"""
+    return _run(app, generate_password_hash, password, app.config['PASSWORD_HASH_METHOD'])
@@ -0,0 +1,105 @@
+"""
+Метаданные фотографий
+Дата съёмки, размеры, ориентация и модель камеры читаются из заголовка
+файла (EXIF): пиксели не декодируются, с диска читаются только первые блоки
+"""
+
+from datetime import datetime
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow не установлен - метаданные не извлекаются
+    Image = None
+
+# Теги EXIF
+MAKE = 0x010F
+MODEL = 0x0110
+ORIENTATION = 0x0112
+DATETIME = 0x0132
+EXIF_IFD = 0x8769
+DATETIME_ORIGINAL = 0x9003
+DATETIME_DIGITIZED = 0x9004
+
+# Сколько байт от начала файла достаточно для чтения заголовка: EXIF
+# (до 64 КБ), профиль ICC и XMP идут до данных изображения
+HEADER_BYTES = 512 * 1024
+
+# Столбцы photos в порядке значений values()
+COLUMNS = 'taken_at, width, height, orientation, camera_model, meta_status'
+
+
+def available():
+    """Можно ли читать метаданные (установлен ли Pillow)"""
+    return Image is not None
+
+
+def _text(value):
+    if isinstance(value, bytes):
+        value = value.decode('utf-8', 'replace')
+    if not isinstance(value, str):
+        return None
+    value = value.strip('\x00 ')
+    return value or None
+
+
+def parse_datetime(value):
+    """Дата EXIF 'ГГГГ:ММ:ДД ЧЧ:ММ:СС' в формате SQLite или None"""
+    value = _text(value)
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value[:19], '%Y:%m:%d %H:%M:%S').strftime('%Y-%m-%d %H:%M:%S')
+    except ValueError:
+        return None
+
+
+def camera_name(make, model):
+    """Модель камеры с производителем, если он не входит в название модели"""
+    make, model = _text(make), _text(model)
+    if model and make and not model.lower().startswith(make.split()[0].lower()):
+        return '{0} {1}'.format(make, model)
+    return model or make
+
+
+def read(path):
+    """Метаданные изображения (dict) или None, если файл не читается
+
+    path - путь к файлу или файловый объект с его началом (HEADER_BYTES).
+    Ширина и высота - с учётом ориентации, т.е. как фото показывается.
+    """
+    if Image is None:
+        return None
+    try:
+        with Image.open(path) as image:
+            width, height = image.size
+            exif = image.getexif()
+            details = exif.get_ifd(EXIF_IFD)
+    except Exception:
+        return None
+
+    orientation = exif.get(ORIENTATION)
+    if not isinstance(orientation, int) or not 1 <= orientation <= 8:
+        orientation = None
+    if orientation in (5, 6, 7, 8):
+        width, height = height, width
+    return {
+        'taken_at': (parse_datetime(details.get(DATETIME_ORIGINAL))
+                     or parse_datetime(details.get(DATETIME_DIGITIZED))
+                     or parse_datetime(exif.get(DATETIME))),
+        'width': width,
+        'height': height,
+        'orientation': orientation,
+        'camera_model': camera_name(exif.get(MAKE), exif.get(MODEL)),
+    }
+
+
+def values(meta):
+    """Значения для COLUMNS
+
+    meta_status: 'ready', 'failed' (файл не прочитан) или NULL, если Pillow
+    не установлен - такие фото дообработает команда backfill-photo-meta.
+    """
+    if meta is None:
+        return (None, None, None, None, None, 'failed' if available() else None)
+    return (meta['taken_at'], meta['width'], meta['height'], meta['orientation'],
+            meta['camera_model'], 'ready')
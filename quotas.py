@@ -0,0 +1,94 @@
+"""
+Квоты и ограничения загрузок
+Занятое место берётся из готовой статистики (user_stats, сводные данные
+альбомов), без обхода файлов. Тело загрузки читается через обёртку, которая
+обрывает приём при превышении квоты и ограничивает скорость, - до того,
+как файл целиком окажется на диске
+"""
+
+import threading
+import time
+from collections import defaultdict
+
+from werkzeug.exceptions import RequestEntityTooLarge
+
+
+class QuotaExceeded(RequestEntityTooLarge):
+    """Загрузка не помещается в квоту пользователя"""
+
+    description = 'Недостаточно места: превышена квота хранилища'
+
+
+def usage(conn, user_id):
+    """Занятое место: файлы, фото альбомов и заявленные загрузки по частям"""
+    return conn.execute('''
+        SELECT COALESCE((SELECT total_bytes FROM user_stats WHERE user_id = ?), 0)
+             + COALESCE((SELECT SUM(total_bytes) FROM albums WHERE user_id = ?), 0)
+             + COALESCE((SELECT SUM(total_size) FROM upload_sessions WHERE user_id = ?), 0)
+    ''', (user_id, user_id, user_id)).fetchone()[0]
+
+
+def remaining(conn, user_id, quota):
+    """Свободное место в квоте (None - квоты нет)"""
+    if quota is None:
+        return None
+    return max(0, quota - usage(conn, user_id))
+
+
+class UploadSlots:
+    """Число одновременных загрузок каждого пользователя (в пределах процесса)"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._active = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def acquire(self, user_id):
+        """Занять слот; False - у пользователя уже limit загрузок"""
+        with self._lock:
+            if self._active[user_id] >= self.limit:
+                return False
+            self._active[user_id] += 1
+            return True
+
+    def release(self, user_id):
+        with self._lock:
+            self._active[user_id] -= 1
+            if self._active[user_id] <= 0:
+                del self._active[user_id]
+
+    def active(self):
+        """Всего загрузок сейчас"""
+        with self._lock:
+            return sum(self._active.values())
+
+
+class MeteredStream:
+    """Тело запроса с ограничением объёма (limit байт) и скорости приёма
+
+    throttle - ratelimit.RateLimiter в байтах: при превышении скорости
+    чтение приостанавливается, и клиент упирается в окно TCP.
+    """
+
+    def __init__(self, stream, limit=None, throttle=None, key=None):
+        self._stream = stream
+        self.limit = limit
+        self.throttle = throttle
+        self.key = key
+        self.received = 0
+
+    def _count(self, data):
+        self.received += len(data)
+        if self.limit is not None and self.received > self.limit:
+            raise QuotaExceeded()
+        if self.throttle is not None and data:
+            wait = self.throttle.consume(self.key, len(data))
+            if wait:
+                time.sleep(wait)
+        return data
+
+    def read(self, size=-1):
+        return self._count(self._stream.read(size))
+
+    def readline(self, size=-1):
+        return self._count(self._stream.readline(size))
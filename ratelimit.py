@@ -0,0 +1,55 @@
+"""
+Ограничение частоты запросов
+Корзина токенов на ключ (IP-адрес, пользователь). Состояние хранится в памяти
+процесса; число ключей ограничено, давно не появлявшиеся вытесняются
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class RateLimiter:
+    """Не больше rate единиц в секунду в среднем и burst подряд для каждого ключа"""
+
+    def __init__(self, rate, burst, maxsize=10000):
+        self.rate = rate
+        self.burst = burst
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()  # ключ -> (токены, время обновления)
+        self._lock = threading.Lock()
+
+    def take(self, key, amount=1):
+        """Списание amount единиц
+
+        Возвращает 0, если списание разрешено, иначе - через сколько секунд
+        единиц станет достаточно (тогда ничего не списывается).
+        """
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens >= amount:
+                tokens -= amount
+                wait = 0
+            else:
+                wait = (amount - tokens) / self.rate
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        return wait
+
+    def consume(self, key, amount):
+        """Списание в долг (для ограничения скорости потока)
+
+        Единицы списываются всегда; возвращает, сколько секунд подождать,
+        чтобы средняя скорость не превысила rate.
+        """
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate) - amount
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        return max(0.0, -tokens / self.rate)
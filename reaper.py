@@ -0,0 +1,154 @@
+"""
+Фоновое удаление файлов с диска
+Запросы только удаляют строки и ставят файлы в очередь (таблица
+pending_deletions); поток удаляет их пакетами с ограничением скорости
+и повторяет неудачные попытки. Очередь хранится в базе и переживает перезапуск
+"""
+
+import logging
+import os
+import threading
+import time
+
+import db
+import storage
+
+logger = logging.getLogger(__name__)
+
+_thread = None
+_thread_lock = threading.Lock()
+_wake = threading.Event()
+
+
+def enqueue_blob(conn, blob_hash):
+    """Постановка блоба в очередь (в транзакции, снявшей последнюю ссылку)"""
+    conn.execute('INSERT INTO pending_deletions (blob_hash) VALUES (?)', (blob_hash,))
+
+
+def enqueue_path(conn, path):
+    """Постановка файла или каталога вне хранилища блобов (старые файлы, папки альбомов)"""
+    conn.execute('INSERT INTO pending_deletions (path) VALUES (?)', (path,))
+
+
+def start(app):
+    """Запуск потока удаления, если он ещё не работает"""
+    global _thread
+    with _thread_lock:
+        if _thread is None or not _thread.is_alive():
+            _thread = threading.Thread(target=_run, args=(app,), name='reaper', daemon=True)
+            _thread.start()
+
+
+def wake(app):
+    """Обработка очереди без ожидания (после коммита удаления)"""
+    start(app)
+    _wake.set()
+
+
+def _run(app):
+    while True:
+        try:
+            processed = reap(app, app.config['REAPER_BATCH_SIZE'])
+        except Exception:
+            logger.exception('Ошибка обработки очереди удаления')
+            processed = 0
+        if processed:
+            # Ограничение скорости: пауза между пакетами
+            time.sleep(app.config['REAPER_PAUSE'])
+        else:
+            _wake.wait(app.config['REAPER_IDLE_INTERVAL'])
+            _wake.clear()
+
+
+def remove_path(path, budget):
+    """Удаление файла или не более budget файлов каталога
+
+    Возвращает (удалено файлов, удалено ли всё).
+    """
+    if not os.path.isdir(path):
+        if os.path.lexists(path):
+            os.remove(path)
+            return 1, True
+        return 0, True
+    removed = 0
+    for root, dirs, files in os.walk(path, topdown=False):
+        for name in files:
+            if removed >= budget:
+                return removed, False
+            os.remove(os.path.join(root, name))
+            removed += 1
+        os.rmdir(root)
+    return removed, True
+
+
+def reap(app, limit):
+    """Один пакет: удаление не более limit файлов из очереди. Возвращает число обработанных
+
+    Файлы удаляются вне транзакции, чтобы блокировка записи SQLite не ждала
+    диска или S3. Записи сначала забираются (claimed_at) в короткой
+    транзакции: загрузка того же содержимого, пока блоб удаляется, получает
+    BlobBusy (BlobStore.add_ref). Итог фиксируется второй транзакцией,
+    забранные записи упавшего процесса снова берутся через REAPER_CLAIM_TIMEOUT.
+    """
+    blobs = storage.get_blob_store(app)
+    processed = 0
+    with db.pooled_connection(app) as conn:
+        conn.execute('BEGIN IMMEDIATE')
+        rows = conn.execute('''
+            SELECT id, blob_hash, path, attempts FROM pending_deletions
+            WHERE not_before <= CURRENT_TIMESTAMP
+              AND (claimed_at IS NULL OR claimed_at <= datetime('now', ?))
+            ORDER BY id LIMIT ?
+        ''', ('-{0:d} seconds'.format(app.config['REAPER_CLAIM_TIMEOUT']), limit)).fetchall()
+        claimed = []
+        for entry in rows:
+            entry_id, blob_hash = entry[:2]
+            # Блоб могли загрузить заново, пока он ждал удаления
+            if blob_hash and conn.execute('SELECT 1 FROM blobs WHERE hash = ?', (blob_hash,)).fetchone():
+                conn.execute('DELETE FROM pending_deletions WHERE id = ?', (entry_id,))
+                processed += 1
+            else:
+                conn.execute('UPDATE pending_deletions SET claimed_at = CURRENT_TIMESTAMP WHERE id = ?',
+                             (entry_id,))
+                claimed.append(entry)
+        conn.commit()
+        if not claimed:
+            return processed
+
+        done, failed = [], []
+        for entry_id, blob_hash, path, attempts in claimed:
+            if processed >= limit:
+                break
+            try:
+                if blob_hash:
+                    blobs.remove(blob_hash)
+                    processed += 1
+                    finished = True
+                else:
+                    removed, finished = remove_path(path, limit - processed)
+                    processed += max(removed, 1)
+            except Exception as e:
+                # Ошибка диска или удалённого хранилища (сеть, S3) - повтор позже
+                logger.warning('Не удалось удалить %s: %s', blob_hash or path, e)
+                backoff = min(2 ** attempts, app.config['REAPER_MAX_BACKOFF'])
+                failed.append((str(e), '+{0:d} seconds'.format(backoff), entry_id))
+                processed += 1
+                continue
+            if finished:
+                done.append((entry_id,))
+
+        conn.execute('BEGIN IMMEDIATE')
+        conn.executemany('DELETE FROM pending_deletions WHERE id = ?', done)
+        conn.executemany('''
+            UPDATE pending_deletions SET attempts = attempts + 1, last_error = ?,
+                not_before = datetime('now', ?)
+            WHERE id = ?
+        ''', failed)
+        # Недоделанные (каталог больше пакета, пакет исчерпан) и неудачные - обратно в очередь
+        conn.executemany('UPDATE pending_deletions SET claimed_at = NULL WHERE id = ?',
+                         [(entry[0],) for entry in claimed])
+        if any(entry[1] for entry in claimed):
+            # Проверки наличия блобов, сделанные до этого момента, могли устареть
+            conn.execute('UPDATE blob_deletions SET epoch = epoch + 1 WHERE id = 1')
+        conn.commit()
+    return processed
@@ -0,0 +1,439 @@
+"""
+Проверка согласованности хранилища и базы (flask scrub)
+Каталоги обходятся через os.scandir пакетами; каждый пакет сверяется с
+таблицами запросами по индексам (IN по уникальным ключам), поэтому в памяти
+нет полного списка файлов. Находки - файлы без записей (сироты), записи без
+файлов (висячие), неверные счётчики ссылок блобов, несовпадение контрольных
+сумм. Исправления и позиция обхода фиксируются одной транзакцией после
+каждого пакета (таблица scrub_checkpoints): прерванная проверка продолжается
+с места остановки. Файлы не удаляются напрямую - они ставятся в очередь
+удаления (reaper)
+"""
+
+import functools
+import json
+import os
+import time
+from collections import Counter
+
+import reaper
+import storage
+
+# Этапы проверки по порядку
+PHASES = ('uploads', 'albums', 'blobs', 'files', 'photos')
+
+
+def load_checkpoint(conn, phase):
+    """Позиция этапа из прошлого (прерванного) запуска или None"""
+    row = conn.execute('SELECT position FROM scrub_checkpoints WHERE phase = ?', (phase,)).fetchone()
+    return json.loads(row[0]) if row else None
+
+
+def save_checkpoint(conn, phase, position):
+    conn.execute('''
+        INSERT INTO scrub_checkpoints (phase, position) VALUES (?, ?)
+        ON CONFLICT (phase) DO UPDATE SET position = excluded.position, updated_at = CURRENT_TIMESTAMP
+    ''', (phase, json.dumps(position)))
+
+
+def clear_checkpoints(conn):
+    """Следующий запуск начнёт проверку с начала"""
+    conn.execute('DELETE FROM scrub_checkpoints')
+
+
+def checksum(path):
+    """Задача пула: SHA-256 файла (None, если файл пропал)"""
+    try:
+        return storage.hash_file(path).hexdigest()
+    except OSError:
+        return None
+
+
+def _batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _placeholders(values):
+    return ', '.join('?' * len(values))
+
+
+def _absent(sql, *params):
+    """Условие исправления: запрос не находит строк"""
+    return lambda conn: conn.execute(sql, params).fetchone() is None
+
+
+class Scrubber:
+    """Один запуск проверки
+
+    repair - исправлять находки, pool - пул процессов для проверки
+    контрольных сумм (None - без неё), min_age - файлы моложе стольких
+    секунд не считаются сиротами (загрузка ещё может идти), on_file_removed -
+    функция (conn, user_id, file_type, file_size), вызываемая при удалении
+    висячей строки files (статистика пользователя).
+    """
+
+    def __init__(self, app, conn, repair=False, pool=None, batch_size=1000, min_age=3600,
+                 on_file_removed=None, out=print):
+        self.app = app
+        self.conn = conn
+        self.repair = repair
+        self.pool = pool
+        self.batch_size = batch_size
+        self.min_age = min_age
+        self.on_file_removed = on_file_removed
+        self.out = out
+        self.blobs = storage.get_blob_store(app)
+        self.uploads = storage.LocalBackend(app.config['UPLOAD_FOLDER'])
+        self.albums = storage.LocalBackend(app.config['ALBUMS_FOLDER'])
+        self.counts = Counter()
+        self.started = time.time()
+        # Уже стоящее в очереди удаления - не сироты
+        pending = conn.execute('SELECT blob_hash, path FROM pending_deletions').fetchall()
+        self.pending_blobs = {row[0] for row in pending if row[0]}
+        self.pending_paths = {row[1] for row in pending if row[1]}
+
+    def run(self):
+        """Все этапы, начиная с сохранённых позиций. Возвращает счётчики находок"""
+        for phase in PHASES:
+            if (load_checkpoint(self.conn, phase) or {}).get('done'):
+                continue
+            getattr(self, '_scan_' + phase)()
+            self._commit(phase, {'done': True}, [])
+        self.conn.execute('BEGIN IMMEDIATE')
+        clear_checkpoints(self.conn)
+        self.conn.commit()
+        return self.counts
+
+    # Находки и фиксация пакета
+
+    def _report(self, findings, kind, message, fix=None):
+        self.counts[kind] += 1
+        self.out(message)
+        if fix is not None:
+            findings.append(fix)
+
+    def _commit(self, phase, position, fixes):
+        """Исправления пакета и новая позиция - одной короткой транзакцией
+
+        Каждое исправление заново проверяет своё условие внутри транзакции:
+        между чтением пакета и записью могли пройти загрузки и удаления.
+        """
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            if self.repair:
+                for fix in fixes:
+                    self.counts['repaired'] += bool(fix(self.conn))
+            save_checkpoint(self.conn, phase, position)
+            self.conn.commit()
+        except BaseException:
+            self.conn.rollback()
+            raise
+
+    def _old_enough(self, entry):
+        try:
+            return self.started - entry.stat(follow_symlinks=False).st_mtime >= self.min_age
+        except FileNotFoundError:
+            return False
+
+    def _select(self, sql, values, *params):
+        """Строки запроса с условием IN по values, выполняемого частями"""
+        rows = []
+        for chunk in _batches(values, 500):
+            rows.extend(self.conn.execute(sql.format(_placeholders(chunk)), params + tuple(chunk)).fetchall())
+        return rows
+
+    def _verify(self, expected):
+        """Пути, содержимое которых не совпало с ожидаемым хешем ({путь: хеш})"""
+        if self.pool is None or not expected:
+            return []
+        paths = list(expected)
+        actual = self.pool.map(checksum, paths, chunksize=16)
+        return [path for path, digest in zip(paths, actual) if digest is not None and digest != expected[path]]
+
+    # Обход каталогов
+
+    def _walk(self, phase, root):
+        """Пакеты записей каталога root и позиции после них
+
+        Порядок os.scandir не меняется, пока не меняется сам каталог: позиция -
+        число пройденных записей вместе со временем изменения каталога.
+        Если каталог с тех пор изменился, обход начинается заново.
+        """
+        try:
+            mtime = os.stat(root).st_mtime_ns
+        except FileNotFoundError:
+            return
+        state = load_checkpoint(self.conn, phase) or {}
+        skip = state.get('offset', 0) if state.get('mtime') == mtime else 0
+        offset = 0
+        with os.scandir(root) as entries:
+            for batch in _batches(entries, self.batch_size):
+                offset += len(batch)
+                if offset <= skip:
+                    continue
+                self.counts['entries'] += len(batch)
+                yield batch, {'offset': offset, 'mtime': mtime}
+
+    def _orphan_path(self, findings, entry, message, still_orphan):
+        """Сирота вне хранилища блобов; исправление - постановка в очередь удаления"""
+        if entry.path in self.pending_paths or not self._old_enough(entry):
+            return
+
+        def fix(conn):
+            if not still_orphan(conn) or not os.path.lexists(entry.path):
+                return False
+            reaper.enqueue_path(conn, entry.path)
+            return True
+        self._report(findings, 'orphans', message.format(entry.path), fix)
+
+    def _scan_uploads(self):
+        """UPLOAD_FOLDER: старые файлы (files без блоба) и части загрузок (<id>.part)"""
+        for batch, position in self._walk('uploads', self.app.config['UPLOAD_FOLDER']):
+            fixes = []
+            files = [entry for entry in batch if entry.is_file(follow_symlinks=False)]
+            parts = {entry.name[:-len('.part')] for entry in files if entry.name.endswith('.part')}
+            names = [entry.name for entry in files if not entry.name.endswith('.part')]
+            sessions = {row[0] for row in self._select(
+                'SELECT id FROM upload_sessions WHERE id IN ({0})', sorted(parts))}
+            checksums = dict(self._select(
+                'SELECT filename, checksum FROM files WHERE blob_hash IS NULL AND filename IN ({0})', names))
+
+            expected = {}
+            for entry in files:
+                if entry.name.endswith('.part'):
+                    session_id = entry.name[:-len('.part')]
+                    if session_id not in sessions:
+                        self._orphan_path(fixes, entry, 'Часть загрузки без сессии: {0}', _absent(
+                            'SELECT 1 FROM upload_sessions WHERE id = ?', session_id))
+                elif entry.name not in checksums:
+                    self._orphan_path(fixes, entry, 'Файл без записи: {0}', _absent(
+                        'SELECT 1 FROM files WHERE blob_hash IS NULL AND filename = ?', entry.name))
+                elif checksums[entry.name]:
+                    expected[entry.path] = checksums[entry.name]
+            for path in self._verify(expected):
+                self._report(fixes, 'corrupt', 'Контрольная сумма не совпадает: {0}'.format(path))
+            self._commit('uploads', position, fixes)
+
+    def _scan_albums(self):
+        """ALBUMS_FOLDER/<album_id>: папки удалённых альбомов и старые фото без записей"""
+        for batch, position in self._walk('albums', self.app.config['ALBUMS_FOLDER']):
+            fixes = []
+            folders = {int(entry.name): entry for entry in batch
+                       if entry.name.isdigit() and entry.is_dir(follow_symlinks=False)}
+            albums = {row[0] for row in self._select('SELECT id FROM albums WHERE id IN ({0})', sorted(folders))}
+            for album_id, folder in sorted(folders.items()):
+                if album_id not in albums:
+                    self._orphan_path(fixes, folder, 'Папка без альбома: {0}', _absent(
+                        'SELECT 1 FROM albums WHERE id = ?', album_id))
+                elif folder.path not in self.pending_paths:
+                    self._scan_album_folder(fixes, album_id, folder.path)
+            self._commit('albums', position, fixes)
+
+    def _scan_album_folder(self, fixes, album_id, path):
+        with os.scandir(path) as entries:
+            for batch in _batches(entries, self.batch_size):
+                self.counts['entries'] += len(batch)
+                files = [entry for entry in batch if entry.is_file(follow_symlinks=False)]
+                known = {row[0] for row in self._select(
+                    'SELECT filename FROM photos WHERE album_id = ? AND blob_hash IS NULL AND filename IN ({0})',
+                    [entry.name for entry in files], album_id)}
+                for entry in files:
+                    if entry.name not in known:
+                        self._orphan_path(fixes, entry, 'Фото без записи: {0}', _absent(
+                            '''SELECT 1 FROM photos
+                                WHERE album_id = ? AND blob_hash IS NULL AND filename = ?''', album_id, entry.name))
+
+    def _scan_blobs(self):
+        """Хранилище блобов: сироты, счётчики ссылок, содержимое против имени (SHA-256)"""
+        if self.blobs.backend.remote:
+            self.out('Хранилище удалённое: обход объектов пропущен, проверяются только записи')
+            return
+        root = self.blobs.root
+        tmp_dir = self.blobs.tmp_dir
+        fixes = []
+        if os.path.isdir(tmp_dir):
+            # Временные файлы оборванных загрузок
+            with os.scandir(tmp_dir) as entries:
+                for entry in entries:
+                    self._orphan_path(fixes, entry, 'Временный файл: {0}', lambda conn: True)
+
+        state = load_checkpoint(self.conn, 'blobs') or {}
+        entries = []
+        for leaf in self._blob_leaves(root, state.get('leaf', '')):
+            with os.scandir(os.path.join(root, *leaf.split('/'))) as found:
+                entries.extend(entry for entry in found if entry.is_file(follow_symlinks=False))
+            if len(entries) >= self.batch_size:
+                self._check_blobs(fixes, entries)
+                self._commit('blobs', {'leaf': leaf}, fixes)
+                entries, fixes = [], []
+        self._check_blobs(fixes, entries)
+        self._commit('blobs', {'leaf': '~'}, fixes)
+
+    @staticmethod
+    def _blob_leaves(root, after):
+        """Каталоги ab/cd по порядку, начиная после after"""
+        def subdirs(path):
+            with os.scandir(path) as entries:
+                return sorted(entry.name for entry in entries
+                              if len(entry.name) == 2 and entry.is_dir(follow_symlinks=False))
+        if not os.path.isdir(root):
+            return
+        for first in subdirs(root):
+            if first < after[:2]:
+                continue
+            for second in subdirs(os.path.join(root, first)):
+                leaf = '{0}/{1}'.format(first, second)
+                if leaf > after:
+                    yield leaf
+
+    def _check_blobs(self, fixes, entries):
+        self.counts['entries'] += len(entries)
+        groups = {}
+        for entry in entries:
+            groups.setdefault(entry.name.split('.', 1)[0], []).append(entry)
+        hashes = sorted(groups)
+        recorded = dict(self._select('SELECT hash, refcount FROM blobs WHERE hash IN ({0})', hashes))
+        refs = Counter()
+        for table in ('files', 'photos'):
+            for blob_hash, count in self._select(
+                    'SELECT blob_hash, COUNT(*) FROM {0} WHERE blob_hash IN ({{0}}) GROUP BY blob_hash'.format(table),
+                    hashes):
+                refs[blob_hash] += count
+
+        expected = {}
+        for blob_hash, group in groups.items():
+            obj = next((entry for entry in group if entry.name == blob_hash), None)
+            if not refs[blob_hash] and blob_hash not in recorded:
+                if blob_hash not in self.pending_blobs and all(self._old_enough(entry) for entry in group):
+                    self._report(fixes, 'orphans', 'Блоб без записи: {0}'.format(blob_hash),
+                                 functools.partial(self._fix_orphan_blob, blob_hash))
+                continue
+            if recorded.get(blob_hash) != refs[blob_hash]:
+                self._report(fixes, 'refcount', 'Счётчик ссылок блоба {0}: {1} вместо {2}'.format(
+                    blob_hash, recorded.get(blob_hash), refs[blob_hash]),
+                    functools.partial(self._fix_refcount, blob_hash, obj.path if obj else None))
+            if obj is not None:
+                expected[obj.path] = blob_hash
+        for path in self._verify(expected):
+            self._report(fixes, 'corrupt', 'Контрольная сумма не совпадает: {0}'.format(path))
+
+    def _blob_refs(self, conn, blob_hash):
+        return sum(conn.execute('SELECT COUNT(*) FROM {0} WHERE blob_hash = ?'.format(table),
+                                (blob_hash,)).fetchone()[0] for table in ('files', 'photos'))
+
+    def _fix_orphan_blob(self, blob_hash, conn):
+        if conn.execute('SELECT 1 FROM blobs WHERE hash = ?', (blob_hash,)).fetchone() or \
+                self._blob_refs(conn, blob_hash):
+            return False
+        reaper.enqueue_blob(conn, blob_hash)
+        return True
+
+    def _fix_refcount(self, blob_hash, path, conn):
+        """Счётчик по фактическим ссылкам; блоб без ссылок - в очередь удаления"""
+        count = self._blob_refs(conn, blob_hash)
+        exists = conn.execute('SELECT 1 FROM blobs WHERE hash = ?', (blob_hash,)).fetchone() is not None
+        if count == 0:
+            if exists:
+                conn.execute('DELETE FROM blobs WHERE hash = ?', (blob_hash,))
+                reaper.enqueue_blob(conn, blob_hash)
+            return exists
+        if exists:
+            conn.execute('UPDATE blobs SET refcount = ? WHERE hash = ?', (count, blob_hash))
+            return True
+        if path is None or not os.path.isfile(path):
+            # Нет ни записи, ни содержимого - строки удалит проверка записей
+            return False
+        conn.execute('INSERT INTO blobs (hash, size, refcount) VALUES (?, ?, ?)',
+                     (blob_hash, os.path.getsize(path), count))
+        return True
+
+    # Обход записей
+
+    def _rows(self, phase, sql):
+        """Пакеты строк таблицы по возрастанию id, начиная с сохранённой позиции"""
+        last_id = (load_checkpoint(self.conn, phase) or {}).get('last_id', 0)
+        while True:
+            rows = self.conn.execute(sql, (last_id, self.batch_size)).fetchall()
+            if not rows:
+                return
+            last_id = rows[-1][0]
+            self.counts['rows'] += len(rows)
+            yield rows, {'last_id': last_id}
+
+    def _content_exists(self, backend, key):
+        try:
+            return backend.exists(key)
+        except Exception as e:
+            # Удалённое хранилище недоступно - строка не считается висячей
+            self.out('Не удалось проверить {0}: {1}'.format(key, e))
+            return True
+
+    def _scan_files(self):
+        """Строки files, содержимого которых нет в хранилище"""
+        for rows, position in self._rows('files', '''
+            SELECT id, user_id, filename, file_type, file_size, blob_hash FROM files
+            WHERE id > ? ORDER BY id LIMIT ?
+        '''):
+            fixes = []
+            for row in rows:
+                backend, key = self._file_location(row[2], row[5])
+                if not self._content_exists(backend, key):
+                    self._report(fixes, 'dangling', 'Файл без содержимого: files.id={0} ({1})'.format(row[0], row[2]),
+                                 functools.partial(self._fix_dangling_file, row))
+            self._commit('files', position, fixes)
+
+    def _file_location(self, filename, blob_hash):
+        if blob_hash:
+            return self.blobs.location(blob_hash)
+        return self.uploads, filename
+
+    def _fix_dangling_file(self, row, conn):
+        file_id, user_id, filename, file_type, file_size, blob_hash = row
+        if conn.execute('SELECT 1 FROM files WHERE id = ?', (file_id,)).fetchone() is None:
+            return False
+        if self._content_exists(*self._file_location(filename, blob_hash)):
+            return False
+        conn.execute('DELETE FROM files WHERE id = ?', (file_id,))
+        if self.on_file_removed is not None:
+            self.on_file_removed(conn, user_id, file_type, file_size)
+        self._release(conn, blob_hash)
+        return True
+
+    def _scan_photos(self):
+        """Строки photos, содержимого которых нет в хранилище"""
+        for rows, position in self._rows('photos', '''
+            SELECT id, album_id, filename, blob_hash FROM photos WHERE id > ? ORDER BY id LIMIT ?
+        '''):
+            fixes = []
+            for row in rows:
+                if not self._content_exists(*self._photo_location(row[1], row[2], row[3])):
+                    self._report(fixes, 'dangling', 'Фото без содержимого: photos.id={0} ({1})'.format(row[0], row[2]),
+                                 functools.partial(self._fix_dangling_photo, row))
+            self._commit('photos', position, fixes)
+
+    def _photo_location(self, album_id, filename, blob_hash):
+        if blob_hash:
+            return self.blobs.location(blob_hash)
+        return self.albums, '{0}/{1}'.format(album_id, filename)
+
+    def _fix_dangling_photo(self, row, conn):
+        photo_id, album_id, filename, blob_hash = row
+        if conn.execute('SELECT 1 FROM photos WHERE id = ?', (photo_id,)).fetchone() is None:
+            return False
+        if self._content_exists(*self._photo_location(album_id, filename, blob_hash)):
+            return False
+        # Счётчик, объём и обложку альбома обновляет триггер photos_album_delete
+        conn.execute('DELETE FROM photos WHERE id = ?', (photo_id,))
+        self._release(conn, blob_hash)
+        return True
+
+    def _release(self, conn, blob_hash):
+        if blob_hash and self.blobs.release(conn, blob_hash):
+            reaper.enqueue_blob(conn, blob_hash)
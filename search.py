@@ -0,0 +1,207 @@
+"""
+Полнотекстовый поиск (SQLite FTS5)
+Имена файлов, названия и описания альбомов, имена и описания фото лежат
+в таблице search_index; триггеры обновляют её в той же транзакции, что
+и сами данные
+"""
+
+import itertools
+import re
+import unicodedata
+
+from markupsafe import Markup, escape
+
+import db
+
+# Вид записи хранится в rowid: rowid = id * 4 + вид. Так строку индекса
+# можно найти и удалить по первичному ключу, без просмотра таблицы
+FILE, ALBUM, PHOTO = 1, 2, 3
+KINDS = {FILE: 'file', ALBUM: 'album', PHOTO: 'photo'}
+
+# Не больше стольких слов запроса и букв «е» в слове, для которых
+# перебирается «ё»
+MAX_TERMS = 8
+MAX_YO = 3
+
+# По релевантности (bm25) упорядочиваются столько самых новых совпадений;
+# более старые идут после них по времени добавления. Оценка bm25 требует
+# обхода всех совпадений, и без окна широкий запрос ("img") у пользователя
+# со 100 тыс. файлов занимал бы сотни миллисекунд
+RANK_WINDOW = 1000
+
+# owner - токен u<id> владельца: фильтр по пользователю выполняется по
+# индексу FTS, а не перебором всех совпадений
+SCHEMA = '''
+    CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(
+        owner, name, body,
+        tokenize = 'unicode61 remove_diacritics 2',
+        prefix = '2 3'
+    );
+'''
+
+TRIGGERS = '''
+    CREATE TRIGGER IF NOT EXISTS files_search_insert AFTER INSERT ON files BEGIN
+        INSERT INTO search_index (rowid, owner, name, body)
+        VALUES (NEW.id * 4 + 1, 'u' || NEW.user_id, NEW.original_name, '');
+    END;
+    CREATE TRIGGER IF NOT EXISTS files_search_update AFTER UPDATE OF original_name, user_id ON files BEGIN
+        UPDATE search_index SET owner = 'u' || NEW.user_id, name = NEW.original_name
+        WHERE rowid = NEW.id * 4 + 1;
+    END;
+    CREATE TRIGGER IF NOT EXISTS files_search_delete AFTER DELETE ON files BEGIN
+        DELETE FROM search_index WHERE rowid = OLD.id * 4 + 1;
+    END;
+    CREATE TRIGGER IF NOT EXISTS albums_search_insert AFTER INSERT ON albums BEGIN
+        INSERT INTO search_index (rowid, owner, name, body)
+        VALUES (NEW.id * 4 + 2, 'u' || NEW.user_id, NEW.title, COALESCE(NEW.description, ''));
+    END;
+    CREATE TRIGGER IF NOT EXISTS albums_search_update AFTER UPDATE OF title, description, user_id ON albums BEGIN
+        UPDATE search_index SET owner = 'u' || NEW.user_id, name = NEW.title, body = COALESCE(NEW.description, '')
+        WHERE rowid = NEW.id * 4 + 2;
+    END;
+    CREATE TRIGGER IF NOT EXISTS albums_search_delete AFTER DELETE ON albums BEGIN
+        DELETE FROM search_index WHERE rowid = OLD.id * 4 + 2;
+    END;
+    CREATE TRIGGER IF NOT EXISTS photos_search_insert AFTER INSERT ON photos BEGIN
+        INSERT INTO search_index (rowid, owner, name, body)
+        VALUES (NEW.id * 4 + 3, 'u' || NEW.user_id, NEW.original_name, COALESCE(NEW.description, ''));
+    END;
+    CREATE TRIGGER IF NOT EXISTS photos_search_update AFTER UPDATE OF original_name, description, user_id ON photos BEGIN
+        UPDATE search_index SET owner = 'u' || NEW.user_id, name = NEW.original_name,
+            body = COALESCE(NEW.description, '')
+        WHERE rowid = NEW.id * 4 + 3;
+    END;
+    CREATE TRIGGER IF NOT EXISTS photos_search_delete AFTER DELETE ON photos BEGIN
+        DELETE FROM search_index WHERE rowid = OLD.id * 4 + 3;
+    END;
+'''
+
+
+def rebuild(conn):
+    """Заполнение search_index заново по files, albums и photos"""
+    conn.execute('DELETE FROM search_index')
+    conn.execute('''
+        INSERT INTO search_index (rowid, owner, name, body)
+        SELECT id * 4 + 1, 'u' || user_id, original_name, '' FROM files
+    ''')
+    conn.execute('''
+        INSERT INTO search_index (rowid, owner, name, body)
+        SELECT id * 4 + 2, 'u' || user_id, title, COALESCE(description, '') FROM albums
+    ''')
+    conn.execute('''
+        INSERT INTO search_index (rowid, owner, name, body)
+        SELECT id * 4 + 3, 'u' || user_id, original_name, COALESCE(description, '') FROM photos
+    ''')
+
+
+def create_index(conn):
+    """Миграция: таблица FTS5, триггеры и индексация существующих данных"""
+    for statement in db.split_statements(SCHEMA + TRIGGERS):
+        conn.execute(statement)
+    rebuild(conn)
+
+
+def terms(text):
+    """Слова запроса в нижнем регистре"""
+    return re.findall(r'\w+', text.lower())[:MAX_TERMS]
+
+
+def normalize(word):
+    """Слово без регистра и диакритики (ё - как е) - для сравнения при подсветке"""
+    decomposed = unicodedata.normalize('NFKD', word.lower())
+    return ''.join(ch for ch in decomposed if not unicodedata.combining(ch))
+
+
+def variants(word):
+    """Написания слова с е/ё в каждой позиции (не больше 2 ** MAX_YO вариантов)
+
+    Токенизатор unicode61 считает «е» и «ё» разными буквами, а «ё» в запросах
+    обычно не пишут: «отчет» должен находить «отчёт.pdf».
+    """
+    word = word.replace('ё', 'е')
+    positions = [i for i, ch in enumerate(word) if ch == 'е'][:MAX_YO]
+    result = []
+    for letters in itertools.product('её', repeat=len(positions)):
+        chars = list(word)
+        for i, ch in zip(positions, letters):
+            chars[i] = ch
+        result.append(''.join(chars))
+    return result
+
+
+def match_query(user_id, words):
+    """Запрос FTS5: все слова как префиксы ("отч" найдёт "отчёт.pdf") у файлов владельца
+
+    Слова приходят из terms(), поэтому операторы FTS5 из ввода не передаются.
+    """
+    phrases = ' AND '.join(
+        '(' + ' OR '.join('"{0}"*'.format(v) for v in variants(w)) + ')' for w in words)
+    return 'owner : u{0:d} AND {{name body}} : ({1})'.format(int(user_id), phrases)
+
+
+def split_rowid(rowid):
+    """(вид, id) по rowid строки индекса"""
+    return KINDS[rowid % 4], rowid // 4
+
+
+def highlight(text, words):
+    """Безопасный HTML: слова текста, начинающиеся с искомых, обёрнуты в <mark>"""
+    words = [normalize(w) for w in words]
+    parts = []
+    for piece in re.split(r'(\w+)', text or ''):
+        if piece and any(normalize(piece).startswith(w) for w in words):
+            parts.append(Markup('<mark>{0}</mark>').format(piece))
+        else:
+            parts.append(escape(piece))
+    return Markup('').join(parts)
+
+
+def snippet(text, words, width=160):
+    """Фрагмент длинного описания вокруг первого совпадения, с подсветкой"""
+    text = text or ''
+    if len(text) > width:
+        start = 0
+        prefixes = [normalize(w) for w in words]
+        for match in re.finditer(r'\w+', text):
+            if any(normalize(match.group()).startswith(w) for w in prefixes):
+                start = max(0, match.start() - width // 4)
+                break
+        text = ('…' if start else '') + text[start:start + width] + ('…' if start + width < len(text) else '')
+    return highlight(text, words)
+
+
+def search(conn, query, position, limit):
+    """Страница результатов: список (rowid, оценка bm25 или None)
+
+    position - (оценка, rowid) последнего показанного результата; оценка
+    None - он уже из совпадений за окном RANK_WINDOW.
+    """
+    # Первое совпадение за окном: всё, что новее, упорядочивается по bm25
+    boundary = conn.execute('''
+        SELECT rowid FROM search_index WHERE search_index MATCH ? ORDER BY rowid DESC LIMIT 1 OFFSET ?
+    ''', (query, RANK_WINDOW)).fetchone()
+    boundary = boundary[0] if boundary else None
+
+    rows = []
+    if position is None or position[0] is not None:
+        sql = '''
+            SELECT rowid, score FROM (
+                SELECT rowid, bm25(search_index, 0.0, 10.0, 1.0) AS score
+                FROM search_index WHERE search_index MATCH ? AND rowid > ?
+            )
+        '''
+        params = [query, boundary or 0]
+        if position:
+            sql += ' WHERE (score, rowid) > (?, ?)'
+            params.extend(position)
+        sql += ' ORDER BY score, rowid LIMIT ?'
+        params.append(limit)
+        rows = conn.execute(sql, params).fetchall()
+
+    if boundary is not None and len(rows) < limit:
+        after = position[1] if position and position[0] is None else boundary + 1
+        rows += conn.execute('''
+            SELECT rowid, NULL FROM search_index WHERE search_index MATCH ? AND rowid < ?
+            ORDER BY rowid DESC LIMIT ?
+        ''', (query, after, limit - len(rows))).fetchall()
+    return rows
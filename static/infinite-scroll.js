@@ -0,0 +1,48 @@
+// Бесконечная прокрутка: следующая страница подгружается из JSON API,
+// когда кнопка «Показать ещё» приближается к области видимости
+document.addEventListener('DOMContentLoaded', function() {
+    document.querySelectorAll('[data-infinite]').forEach(grid => {
+        const button = document.getElementById(grid.dataset.infinite);
+        if (!button || !window.fetch) return;
+        
+        let nextCursor = grid.dataset.next;
+        let loading = false;
+        
+        async function loadMore() {
+            if (loading || !nextCursor) return;
+            loading = true;
+            
+            const url = new URL(grid.dataset.api, window.location.origin);
+            url.searchParams.set('cursor', nextCursor);
+            url.searchParams.set('html', '1');
+            
+            try {
+                const response = await fetch(url);
+                if (response.ok) {
+                    const data = await response.json();
+                    grid.insertAdjacentHTML('beforeend', data.html);
+                    nextCursor = data.next_cursor;
+                    if (!nextCursor) {
+                        button.parentElement.remove();
+                    }
+                }
+            } finally {
+                loading = false;
+            }
+        }
+        
+        button.addEventListener('click', function(e) {
+            e.preventDefault();
+            loadMore();
+        });
+        
+        if ('IntersectionObserver' in window) {
+            const observer = new IntersectionObserver(entries => {
+                if (entries.some(entry => entry.isIntersecting)) {
+                    loadMore();
+                }
+            }, {rootMargin: '600px'});
+            observer.observe(button);
+        }
+    });
+});
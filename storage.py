@@ -0,0 +1,484 @@
+"""
+Работа с файлами в хранилище
+Потоковая запись с подсчётом размера и контрольной суммы,
+контентно-адресуемое хранилище блобов поверх сменного бэкенда:
+локальный каталог или бакет S3-совместимого хранилища
+"""
+
+import contextlib
+import hashlib
+import io
+import mimetypes
+import os
+import shutil
+import uuid
+from urllib.parse import quote
+
+try:
+    import boto3
+    from botocore.config import Config as BotoConfig
+    from botocore.exceptions import ClientError
+except ImportError:  # boto3 не установлен - доступно только локальное хранилище
+    boto3 = None
+
+# Размер блока при потоковом копировании
+CHUNK_SIZE = 1024 * 1024
+
+# Размер части при выгрузке в S3 по частям (не меньше 5 МБ - ограничение S3)
+S3_PART_SIZE = 16 * 1024 * 1024
+
+
+def new_hasher():
+    """Хеш-функция контрольных сумм файлов"""
+    return hashlib.sha256()
+
+
+def copy_stream(src, dst, hasher=None, chunk_size=CHUNK_SIZE):
+    """Копирование потока блоками фиксированного размера
+
+    Возвращает число записанных байт. Если передан hasher, он обновляется
+    по мере поступления данных, без повторного чтения файла.
+    """
+    written = 0
+    while True:
+        chunk = src.read(chunk_size)
+        if not chunk:
+            break
+        dst.write(chunk)
+        if hasher is not None:
+            hasher.update(chunk)
+        written += len(chunk)
+    return written
+
+
+def hash_file(path, hasher=None, limit=None, chunk_size=CHUNK_SIZE):
+    """Контрольная сумма файла (или первых limit байт)"""
+    hasher = hasher or new_hasher()
+    remaining = limit
+    with open(path, 'rb') as f:
+        while remaining is None or remaining > 0:
+            size = chunk_size if remaining is None else min(chunk_size, remaining)
+            chunk = f.read(size)
+            if not chunk:
+                break
+            hasher.update(chunk)
+            if remaining is not None:
+                remaining -= len(chunk)
+    return hasher
+
+
+def shard_key(name):
+    """Ключ объекта в раскладке по подкаталогам: ab/cd/<имя>
+
+    Имя - хеш содержимого, поэтому объекты равномерно распределяются
+    по 65536 каталогам и ни один из них не разрастается.
+    """
+    return '{0}/{1}/{2}'.format(name[:2], name[2:4], name)
+
+
+def _read_part(stream, size):
+    """Чтение ровно size байт (меньше - только в конце потока)"""
+    parts = []
+    remaining = size
+    while remaining > 0:
+        chunk = stream.read(min(remaining, CHUNK_SIZE))
+        if not chunk:
+            break
+        parts.append(chunk)
+        remaining -= len(chunk)
+    return b''.join(parts)
+
+
+def content_disposition(download_name):
+    """Заголовок Content-Disposition для отдачи файла под его именем"""
+    try:
+        download_name.encode('ascii')
+        return 'inline; filename="{0}"'.format(download_name.replace('"', ''))
+    except UnicodeEncodeError:
+        return "inline; filename*=UTF-8''{0}".format(quote(download_name))
+
+
+class BlobBusy(Exception):
+    """Блоб с таким содержимым сейчас удаляется из хранилища - повторить позже"""
+
+
+def deletion_epoch(conn):
+    """Счётчик проходов удаления блобов; reaper увеличивает его, закончив пакет"""
+    row = conn.execute('SELECT epoch FROM blob_deletions WHERE id = 1').fetchone()
+    return row[0] if row else 0
+
+
+class LocalBackend:
+    """Объекты - файлы в каталоге root; ключ - путь относительно root через '/'"""
+
+    remote = False
+
+    def __init__(self, root):
+        self.root = root
+
+    def local_path(self, key):
+        """Путь к файлу объекта"""
+        return os.path.join(self.root, *key.split('/'))
+
+    def exists(self, key):
+        return os.path.isfile(self.local_path(key))
+
+    def stat(self, key):
+        """(размер, время изменения) или None, если объекта нет"""
+        try:
+            st = os.stat(self.local_path(key))
+        except FileNotFoundError:
+            return None
+        return st.st_size, st.st_mtime
+
+    def open(self, key, length=None):
+        """Файловый объект для чтения (FileNotFoundError, если объекта нет)"""
+        return open(self.local_path(key), 'rb')
+
+    def put_file(self, key, src_path):
+        """Размещение файла под ключом; исходный файл переносится, а не копируется"""
+        path = self.local_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            os.replace(src_path, path)
+        except OSError:
+            # Временный файл на другом разделе
+            shutil.move(src_path, path)
+
+    def delete(self, key):
+        """Удаление объекта (отсутствующий объект - не ошибка)"""
+        try:
+            os.remove(self.local_path(key))
+        except FileNotFoundError:
+            pass
+
+    def list(self, prefix):
+        """Ключи, начинающиеся с prefix, в пределах его каталога"""
+        directory, _, start = prefix.rpartition('/')
+        path = self.local_path(directory) if directory else self.root
+        if not os.path.isdir(path):
+            return []
+        base = directory + '/' if directory else ''
+        return [base + entry.name for entry in os.scandir(path)
+                if entry.name.startswith(start) and entry.is_file()]
+
+
+class S3Backend:
+    """Объекты в бакете S3-совместимого хранилища (Amazon S3, MinIO, Ceph RGW)
+
+    Файлы выгружаются по частям (multipart upload) по part_size байт: в
+    памяти держится одна часть, сколько бы ни весил файл. Скачивания
+    отдаёт само хранилище по временным подписанным ссылкам (url).
+    """
+
+    remote = True
+
+    def __init__(self, bucket, prefix='', endpoint_url=None, region=None, access_key=None,
+                 secret_key=None, part_size=S3_PART_SIZE, url_expires=300, client=None):
+        if client is None:
+            if boto3 is None:
+                raise RuntimeError('Для хранилища S3 нужен пакет boto3')
+            # Для своих серверов (MinIO) - адреса вида endpoint/bucket/key
+            client = boto3.client(
+                's3', endpoint_url=endpoint_url, region_name=region,
+                aws_access_key_id=access_key, aws_secret_access_key=secret_key,
+                config=BotoConfig(signature_version='s3v4',
+                                  s3={'addressing_style': 'path' if endpoint_url else 'auto'}))
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix.strip('/') + '/' if prefix.strip('/') else ''
+        self.part_size = part_size
+        self.url_expires = url_expires
+
+    def _key(self, key):
+        return self.prefix + key
+
+    @staticmethod
+    def _not_found(error):
+        return error.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound')
+
+    def local_path(self, key):
+        """Объекты не лежат на локальном диске"""
+        return None
+
+    def exists(self, key):
+        return self.stat(key) is not None
+
+    def stat(self, key):
+        """(размер, время изменения) или None, если объекта нет"""
+        try:
+            head = self.client.head_object(Bucket=self.bucket, Key=self._key(key))
+        except ClientError as e:
+            if self._not_found(e):
+                return None
+            raise
+        return head['ContentLength'], head['LastModified'].timestamp()
+
+    def open(self, key, length=None):
+        """Поток для чтения объекта (или его первых length байт)"""
+        params = {'Bucket': self.bucket, 'Key': self._key(key)}
+        if length is not None:
+            params['Range'] = 'bytes=0-{0:d}'.format(length - 1)
+        try:
+            return self.client.get_object(**params)['Body']
+        except ClientError as e:
+            if self._not_found(e):
+                raise FileNotFoundError(key) from e
+            raise
+
+    def put_file(self, key, src_path):
+        """Выгрузка файла под ключом; исходный файл остаётся на месте"""
+        with open(src_path, 'rb') as f:
+            return self.put_stream(key, f)
+
+    def put_stream(self, key, stream):
+        """Потоковая выгрузка: маленький объект - одним запросом, большой - по частям
+
+        Возвращает число выгруженных байт. При ошибке незавершённая
+        выгрузка отменяется, чтобы её части не занимали место в бакете.
+        """
+        key = self._key(key)
+        chunk = _read_part(stream, self.part_size)
+        if len(chunk) < self.part_size:
+            self.client.put_object(Bucket=self.bucket, Key=key, Body=chunk)
+            return len(chunk)
+
+        upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=key)['UploadId']
+        parts = []
+        size = 0
+        try:
+            while chunk:
+                number = len(parts) + 1
+                response = self.client.upload_part(Bucket=self.bucket, Key=key, UploadId=upload_id,
+                                                   PartNumber=number, Body=chunk)
+                parts.append({'PartNumber': number, 'ETag': response['ETag']})
+                size += len(chunk)
+                chunk = _read_part(stream, self.part_size)
+            self.client.complete_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload_id,
+                                                  MultipartUpload={'Parts': parts})
+        except BaseException:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload_id)
+            raise
+        return size
+
+    def delete(self, key):
+        """Удаление объекта (отсутствующий объект - не ошибка)"""
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(key))
+
+    def list(self, prefix):
+        """Ключи, начинающиеся с prefix"""
+        keys = []
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self._key(prefix)):
+            keys.extend(item['Key'][len(self.prefix):] for item in page.get('Contents', ()))
+        return keys
+
+    def url(self, key, download_name=None):
+        """Временная подписанная ссылка на объект
+
+        Тип и имя файла передаются хранилищу параметрами ссылки: блоб один
+        на все копии файла, а имена у копий разные.
+        """
+        params = {'Bucket': self.bucket, 'Key': self._key(key)}
+        if download_name:
+            params['ResponseContentDisposition'] = content_disposition(download_name)
+            params['ResponseContentType'] = mimetypes.guess_type(download_name)[0] or 'application/octet-stream'
+        return self.client.generate_presigned_url('get_object', Params=params, ExpiresIn=self.url_expires)
+
+
+def create_backend(config):
+    """Бэкенд хранилища блобов по настройкам приложения (STORAGE_BACKEND)"""
+    name = config['STORAGE_BACKEND']
+    if name == 'local':
+        return LocalBackend(config['BLOBS_FOLDER'])
+    if name == 's3':
+        return S3Backend(config['S3_BUCKET'], prefix=config['S3_PREFIX'],
+                         endpoint_url=config['S3_ENDPOINT_URL'], region=config['S3_REGION'],
+                         access_key=config['S3_ACCESS_KEY'], secret_key=config['S3_SECRET_KEY'],
+                         part_size=config['S3_PART_SIZE'], url_expires=config['S3_URL_EXPIRES'])
+    raise ValueError('Неизвестное хранилище: {0}'.format(name))
+
+
+def get_blob_store(app):
+    """Хранилище блобов приложения
+
+    Клиент S3 создаётся один раз на процесс (он потокобезопасен),
+    локальный бэкенд - при каждом вызове: он ничего не держит.
+    """
+    if app.config['STORAGE_BACKEND'] == 'local':
+        backend = LocalBackend(app.config['BLOBS_FOLDER'])
+    else:
+        backend = app.extensions.get('oblako.storage')
+        if backend is None:
+            backend = app.extensions['oblako.storage'] = create_backend(app.config)
+    return BlobStore(app.config['BLOBS_FOLDER'], backend)
+
+
+def read_source(backend, key, limit):
+    """Источник для чтения заголовка файла: путь на диске или первые limit байт в памяти"""
+    path = backend.local_path(key)
+    if path is not None:
+        return path
+    try:
+        with contextlib.closing(backend.open(key, limit)) as body:
+            return io.BytesIO(body.read())
+    except FileNotFoundError:
+        return io.BytesIO()
+
+
+@contextlib.contextmanager
+def local_file(backend, key, tmp_dir):
+    """Контекст с путём к объекту на локальном диске
+
+    Объект удалённого хранилища скачивается во временный файл в tmp_dir,
+    который удаляется при выходе. FileNotFoundError, если объекта нет.
+    """
+    path = backend.local_path(key)
+    if path is not None:
+        if not os.path.isfile(path):
+            raise FileNotFoundError(path)
+        yield path
+        return
+    os.makedirs(tmp_dir, exist_ok=True)
+    tmp_path = os.path.join(tmp_dir, uuid.uuid4().hex)
+    try:
+        with contextlib.closing(backend.open(key)) as src, open(tmp_path, 'wb') as dst:
+            copy_stream(src, dst)
+        yield tmp_path
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class BlobStore:
+    """Контентно-адресуемое хранилище: файл хранится один раз под своим SHA-256
+
+    Блобы лежат в бэкенде под ключами ab/cd/<hash>, счётчики ссылок - в
+    таблице blobs. Изменения счётчиков выполняются в транзакции вызывающего
+    кода, объект удаляется, только когда на него не осталось ссылок.
+    Временные файлы загрузок всегда пишутся на локальный диск (root/tmp).
+    """
+
+    def __init__(self, root, backend=None):
+        self.root = root
+        self.tmp_dir = os.path.join(root, 'tmp')
+        self.backend = backend or LocalBackend(root)
+        # Проверенные в stage блобы: хеш -> deletion_epoch на момент проверки
+        self._staged = {}
+
+    def key(self, blob_hash):
+        """Ключ блоба в бэкенде"""
+        return shard_key(blob_hash)
+
+    def rendition_key(self, blob_hash, name):
+        """Ключ производного файла блоба (миниатюра, превью)"""
+        return '{0}.{1}'.format(self.key(blob_hash), name)
+
+    def location(self, blob_hash, name=None):
+        """(бэкенд, ключ) блоба или его производного файла"""
+        return self.backend, self.rendition_key(blob_hash, name) if name else self.key(blob_hash)
+
+    def path(self, blob_hash):
+        """Путь к блобу на локальном диске (None для удалённого хранилища)"""
+        return self.backend.local_path(self.key(blob_hash))
+
+    def temp_path(self):
+        """Путь для нового временного файла"""
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        return os.path.join(self.tmp_dir, uuid.uuid4().hex)
+
+    def write_temp(self, src):
+        """Потоковая запись во временный файл с подсчётом хеша
+
+        Возвращает (временный путь, хеш, размер).
+        """
+        tmp_path = self.temp_path()
+        hasher = new_hasher()
+        try:
+            with open(tmp_path, 'wb') as f:
+                size = copy_stream(src, f, hasher)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return tmp_path, hasher.hexdigest(), size
+
+    def stage(self, conn, tmp_path, blob_hash):
+        """Выгрузка содержимого в удалённое хранилище до транзакции
+
+        Передача по сети не должна идти под блокировкой записи SQLite.
+        Запоминается счётчик завершённых удалений (deletion_epoch) на момент
+        проверки: если блоб успеют удалить до add_ref, тот увидит это и
+        выгрузит его заново из временного файла. Для локального диска ничего
+        не делает - перенос файла в add_ref мгновенный.
+        """
+        if not self.backend.remote:
+            return
+        self._staged[blob_hash] = deletion_epoch(conn)
+        if not self.backend.exists(self.key(blob_hash)):
+            self.backend.put_file(self.key(blob_hash), tmp_path)
+
+    def add_ref(self, conn, tmp_path, blob_hash, size):
+        """Регистрация ссылки на блоб; файл переносится в хранилище, если его там ещё нет
+
+        Вызывается внутри транзакции записи (BEGIN IMMEDIATE). Удалённое
+        хранилище обычно не опрашивается: у блоба с записью объект на месте,
+        новый блоб выгружен в stage. Запрос под блокировкой нужен, только если
+        после stage завершилось какое-то удаление блобов - проверка stage могла
+        устареть. Пока reaper удаляет этот же блоб, ссылку добавить нельзя
+        (BlobBusy): объект может исчезнуть в любой момент.
+
+        Возвращает True, если записи блоба ещё не было. При откате транзакции
+        объект такого блоба остаётся в хранилище без записи - вызывающий код
+        ставит его в очередь удаления.
+        """
+        if conn.execute('''
+            SELECT 1 FROM pending_deletions WHERE blob_hash = ? AND claimed_at IS NOT NULL
+        ''', (blob_hash,)).fetchone():
+            raise BlobBusy(blob_hash)
+        known = conn.execute('SELECT 1 FROM blobs WHERE hash = ?', (blob_hash,)).fetchone()
+        conn.execute('''
+            INSERT INTO blobs (hash, size, refcount) VALUES (?, ?, 1)
+            ON CONFLICT (hash) DO UPDATE SET refcount = refcount + 1
+        ''', (blob_hash, size))
+        staged = self._staged.pop(blob_hash, None)
+        if not self.backend.remote or (known is None and staged != deletion_epoch(conn)):
+            key = self.key(blob_hash)
+            if not self.backend.exists(key):
+                self.backend.put_file(key, tmp_path)
+        # Такое содержимое уже хранится (или выгружено копией) - временный файл не нужен
+        self.discard_temp(tmp_path)
+        return known is None
+
+    def put_rendition(self, blob_hash, name, src_path):
+        """Размещение готового производного файла блоба"""
+        self.backend.put_file(self.rendition_key(blob_hash, name), src_path)
+        self.discard_temp(src_path)
+
+    def local_copy(self, blob_hash):
+        """Путь к содержимому на локальном диске; из удалённого хранилища - во временный файл"""
+        return local_file(self.backend, self.key(blob_hash), self.tmp_dir)
+
+    def remove(self, blob_hash, renditions_only=False):
+        """Удаление блоба и всех его производных файлов (или только производных)"""
+        key = self.key(blob_hash)
+        for found in self.backend.list(key):
+            if found.startswith(key + '.') or (found == key and not renditions_only):
+                self.backend.delete(found)
+
+    def release(self, conn, blob_hash):
+        """Снятие ссылки; при нуле ссылок запись блоба удаляется. Возвращает True, если удалена
+
+        Сам файл удаляет вызывающий код (очередь удаления reaper) методом remove.
+        """
+        conn.execute('UPDATE blobs SET refcount = refcount - 1 WHERE hash = ?', (blob_hash,))
+        row = conn.execute('SELECT refcount FROM blobs WHERE hash = ?', (blob_hash,)).fetchone()
+        if row is None or row[0] > 0:
+            return False
+        conn.execute('DELETE FROM blobs WHERE hash = ?', (blob_hash,))
+        return True
+
+    def discard_temp(self, tmp_path):
+        """Удаление временного файла, если загрузка не была принята"""
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
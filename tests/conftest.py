@@ -0,0 +1,76 @@
+"""
+Общие фикстуры тестов: приложение с временной базой и каталогами хранилища
+"""
+
+import io
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as oblako  # noqa: E402
+import ratelimit  # noqa: E402
+import reaper  # noqa: E402
+import thumbnails  # noqa: E402
+
+# Настройки, которые тесты меняют; после теста восстанавливаются
+FOLDERS = ('UPLOAD_FOLDER', 'ALBUMS_FOLDER', 'BLOBS_FOLDER', 'IMG_CACHE_FOLDER')
+
+
+def _reset_caches(flask_app):
+    for name in ('oblako.storage', 'oblako.images'):
+        flask_app.extensions.pop(name, None)
+    oblako.user_cache.clear()
+    oblako.fragment_cache.clear()
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    """Приложение на пустой базе во временном каталоге"""
+    flask_app = oblako.app
+    saved = dict(flask_app.config)
+    flask_app.config.update(TESTING=True, DATABASE=str(tmp_path / 'test.db'), STORAGE_BACKEND='local',
+                            # Быстрый хеш: проверяется логика входа, а не стойкость
+                            PASSWORD_HASH_METHOD='pbkdf2:sha256:1000')
+    for key in FOLDERS:
+        flask_app.config[key] = str(tmp_path / key.lower())
+    _reset_caches(flask_app)
+    # Счётчики попыток входа не переходят из теста в тест
+    monkeypatch.setattr(oblako, 'login_throttle', ratelimit.RateLimiter(1000, 1000))
+    # Фоновый поток удаления не запускается: тесты вызывают reaper.reap сами
+    monkeypatch.setattr(reaper, 'wake', lambda app: None)
+    oblako.init_db()
+    yield flask_app
+    # Фоновые миниатюры дописываются в базу теста, а не в рабочую
+    if thumbnails._executor is not None:
+        thumbnails._executor.shutdown(wait=True)
+        thumbnails._executor = None
+    flask_app.config.clear()
+    flask_app.config.update(saved)
+    _reset_caches(flask_app)
+
+
+def register(client, username, password='secret1'):
+    """Регистрация и вход; возвращает тот же клиент"""
+    client.post('/register', data={'username': username, 'email': username + '@example.com',
+                                   'password': password, 'password_confirm': password})
+    response = client.post('/login', data={'username': username, 'password': password})
+    assert response.status_code == 302 and response.location.endswith('/dashboard'), response.location
+    return client
+
+
+@pytest.fixture
+def client(app):
+    """Клиент пользователя alice"""
+    return register(app.test_client(), 'alice')
+
+
+def jpeg(color='red', size=(64, 48)):
+    """Небольшой JPEG в памяти"""
+    from PIL import Image
+    data = io.BytesIO()
+    Image.new('RGB', size, color).save(data, 'JPEG')
+    data.seek(0)
+    return data
@@ -0,0 +1,186 @@
+"""
+Фото альбомов: загрузка по одному и пакетом, откат при ошибке записи,
+сводные данные альбома (счётчик, объём, обложка) и их проверка
+"""
+
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from flask import got_request_exception
+
+import app as oblako
+import db
+import photometa
+import reaper
+import storage
+import thumbnails
+from conftest import jpeg
+
+pytestmark = pytest.mark.skipif(not photometa.available(), reason='Pillow не установлен')
+
+
+def add_photo(client, album_id=1, color='red', name='p.jpg'):
+    return client.post('/album/{0}/add_photo'.format(album_id), data={'photo': (jpeg(color), name)},
+                       content_type='multipart/form-data')
+
+
+def count(app, sql):
+    with db.pooled_connection(app) as conn:
+        return conn.execute(sql).fetchone()[0]
+
+
+@pytest.fixture
+def album(client):
+    client.post('/album/new', data={'title': 'A'})
+    return 1
+
+
+def test_failed_insert_is_rolled_back_in_route(app, client, album, monkeypatch):
+    # Транзакция откатывается в самом маршруте, до обработки ошибки
+    in_transaction = []
+
+    def record(sender, exception, **extra):
+        in_transaction.append(db.get_db().in_transaction)
+    got_request_exception.connect(record, app)
+    # Неверное число значений метаданных - INSERT в photos падает после add_ref
+    with monkeypatch.context() as patch:
+        patch.setattr(photometa, 'values', lambda meta: ())
+        with pytest.raises(sqlite3.ProgrammingError):
+            add_photo(client)
+    got_request_exception.disconnect(record, app)
+    assert in_transaction == [False]
+
+    assert count(app, 'SELECT COUNT(*) FROM blobs') == 0
+    assert count(app, 'SELECT photo_count FROM albums WHERE id = 1') == 0
+    tmp_dir = os.path.join(app.config['BLOBS_FOLDER'], 'tmp')
+    assert os.listdir(tmp_dir) == []
+    # Объект, уже перенесённый add_ref в хранилище, поставлен в очередь удаления
+    with db.pooled_connection(app) as conn:
+        blob_hash, = conn.execute('SELECT blob_hash FROM pending_deletions').fetchone()
+    path = storage.get_blob_store(app).path(blob_hash)
+    assert os.path.exists(path)
+    reaper.reap(app, 10)
+    assert not os.path.exists(path)
+    assert count(app, 'SELECT COUNT(*) FROM pending_deletions') == 0
+
+    # Соединение не осталось в открытой транзакции
+    assert add_photo(client).status_code == 200
+    assert count(app, 'SELECT refcount FROM blobs') == 1
+    assert os.path.exists(path)
+
+
+def test_reupload_keeps_queued_object(app, client, album, monkeypatch):
+    """Запись блоба, появившаяся до reaper, отменяет удаление объекта"""
+    with monkeypatch.context() as patch:
+        patch.setattr(photometa, 'values', lambda meta: ())
+        with pytest.raises(sqlite3.ProgrammingError):
+            add_photo(client)
+    assert count(app, 'SELECT COUNT(*) FROM pending_deletions') == 1
+    assert add_photo(client).status_code == 200
+    reaper.reap(app, 10)
+    assert count(app, 'SELECT COUNT(*) FROM pending_deletions') == 0
+    with db.pooled_connection(app) as conn:
+        blob_hash, = conn.execute('SELECT hash FROM blobs').fetchone()
+    assert os.path.exists(storage.get_blob_store(app).path(blob_hash))
+
+
+def album_row(app):
+    with db.pooled_connection(app) as conn:
+        return conn.execute('SELECT photo_count, total_bytes, cover_photo FROM albums WHERE id = 1').fetchone()
+
+
+def photos(app):
+    with db.pooled_connection(app) as conn:
+        return conn.execute('SELECT id, filename, file_size FROM photos ORDER BY id').fetchall()
+
+
+def test_cover_is_repicked_when_deleted(app, client, album):
+    for color in ('red', 'green', 'blue'):
+        add_photo(client, color=color)
+    first, second, third = photos(app)
+    assert album_row(app) == (3, first[2] + second[2] + third[2], first[1])
+
+    # Обложка, выбранная вручную, после удаления заменяется самым ранним фото
+    client.get('/album/1/set_cover/{0}'.format(third[0]))
+    assert album_row(app)[2] == third[1]
+    client.get('/photo/{0}/delete'.format(third[0]))
+    assert album_row(app) == (2, first[2] + second[2], first[1])
+
+    # Удаление не обложки её не меняет
+    client.get('/photo/{0}/delete'.format(second[0]))
+    assert album_row(app) == (1, first[2], first[1])
+    client.get('/photo/{0}/delete'.format(first[0]))
+    assert album_row(app) == (0, 0, None)
+
+
+def drift(app, sql):
+    with db.pooled_connection(app) as conn:
+        conn.execute(sql)
+        conn.commit()
+        return oblako.find_inconsistent_albums(conn)
+
+
+def test_find_inconsistent_albums(app, client, album):
+    client.post('/album/new', data={'title': 'B'})
+    client.post('/album/new', data={'title': 'Пустой'})
+    add_photo(client)
+    add_photo(client, album_id=2)
+    with db.pooled_connection(app) as conn:
+        assert oblako.find_inconsistent_albums(conn) == []
+    assert drift(app, 'UPDATE albums SET photo_count = 5 WHERE id = 1') == [1]
+    assert drift(app, 'UPDATE albums SET total_bytes = total_bytes + 1 WHERE id = 2') == [1, 2]
+    with db.pooled_connection(app) as conn:
+        oblako.rebuild_album_stats(conn)
+        conn.commit()
+    assert drift(app, "UPDATE albums SET cover_photo = 'gone.jpg' WHERE id = 1") == [1]
+    assert drift(app, 'UPDATE albums SET cover_photo = NULL WHERE id = 1') == [1]
+    # Обложка у пустого альбома
+    assert drift(app, "UPDATE albums SET cover_photo = 'x.jpg' WHERE id = 3") == [1, 3]
+
+
+def test_check_albums_command(app, client, album):
+    add_photo(client)
+    expected = album_row(app)
+    runner = app.test_cli_runner()
+    assert 'Расхождений нет' in runner.invoke(args=['check-albums']).output
+
+    with db.pooled_connection(app) as conn:
+        conn.execute("UPDATE albums SET photo_count = 0, total_bytes = 0, cover_photo = 'gone.jpg'")
+        conn.commit()
+    result = runner.invoke(args=['check-albums'])
+    assert 'Расхождения в альбомах: 1' in result.output
+    assert album_row(app) == (0, 0, 'gone.jpg')
+
+    result = runner.invoke(args=['check-albums', '--repair'])
+    assert 'Исправлены альбомы: 1' in result.output
+    assert album_row(app) == expected
+    assert 'Расхождений нет' in runner.invoke(args=['check-albums']).output
+
+
+def test_backfill_photo_meta_uses_start_method(app, client, album, monkeypatch):
+    """Пул чтения EXIF запускается не через fork; версия данных владельца растёт"""
+    add_photo(client)
+    add_photo(client, color='blue')
+    with db.pooled_connection(app) as conn:
+        conn.execute('UPDATE photos SET width = NULL, height = NULL, meta_status = NULL')
+        conn.commit()
+    # Готовые миниатюры тоже меняют версию данных - дожидаемся их
+    thumbnails._executor.shutdown(wait=True)
+    thumbnails._executor = None
+    version = count(app, 'SELECT data_version FROM users WHERE id = 1')
+    contexts = []
+
+    class RecordingPool(ThreadPoolExecutor):
+        def __init__(self, max_workers=None, mp_context=None):
+            contexts.append(mp_context.get_start_method())
+            super().__init__(max_workers=max_workers or 2)
+
+    monkeypatch.setattr(oblako, 'ProcessPoolExecutor', RecordingPool)
+    result = app.test_cli_runner().invoke(args=['backfill-photo-meta', '--batch-size', '1'])
+    assert result.exit_code == 0, result.output
+    assert 'Готово: 2 фото, не прочитано: 0' in result.output
+    assert contexts == [app.config['PROCESS_START_METHOD']]
+    assert count(app, "SELECT COUNT(*) FROM photos WHERE meta_status = 'ready' AND width > 0") == 2
+    assert count(app, 'SELECT data_version FROM users WHERE id = 1') == version + 2
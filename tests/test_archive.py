@@ -0,0 +1,117 @@
+"""
+ZIP-архивы выбранных файлов и альбома: содержимое, сжатие, имена, права
+"""
+
+import io
+import os
+import zipfile
+
+import pytest
+
+import archive
+import db
+import photometa
+import storage
+from conftest import jpeg, register
+
+
+def upload(client, data, name):
+    response = client.post('/upload', data={'file': (io.BytesIO(data), name)}, content_type='multipart/form-data')
+    assert response.status_code == 302
+
+
+def file_ids(app, user_id=1):
+    with db.pooled_connection(app) as conn:
+        return [row[0] for row in conn.execute('SELECT id FROM files WHERE user_id = ? ORDER BY id', (user_id,))]
+
+
+def download(client, ids):
+    response = client.post('/files/download', data={'file_ids': ids})
+    assert response.status_code == 200
+    assert response.mimetype == 'application/zip'
+    return zipfile.ZipFile(io.BytesIO(response.get_data()))
+
+
+def test_selected_files(app, client):
+    upload(client, b'report text ' * 100, 'report.txt')
+    upload(client, b'PK fake archive', 'data.zip')
+    with download(client, file_ids(app)) as zf:
+        assert zf.testzip() is None
+        assert zf.read('report.txt') == b'report text ' * 100
+        assert zf.read('data.zip') == b'PK fake archive'
+        # Уже сжатые форматы не сжимаются повторно
+        assert zf.getinfo('report.txt').compress_type == zipfile.ZIP_DEFLATED
+        assert zf.getinfo('data.zip').compress_type == zipfile.ZIP_STORED
+
+
+def test_duplicate_names_get_suffixes(app, client):
+    for data in (b'one', b'two', b'three'):
+        upload(client, data, 'notes.txt')
+    with download(client, file_ids(app)) as zf:
+        # Новые файлы идут первыми
+        assert sorted(zf.namelist()) == ['notes (2).txt', 'notes (3).txt', 'notes.txt']
+        assert zf.read('notes.txt') == b'three'
+        assert zf.read('notes (3).txt') == b'one'
+
+
+def test_other_users_files_are_ignored(app, client):
+    upload(client, b'mine', 'mine.txt')
+    other = register(app.test_client(), 'bob')
+    upload(other, b'secret', 'secret.txt')
+    with download(client, file_ids(app, 1) + file_ids(app, 2)) as zf:
+        assert zf.namelist() == ['mine.txt']
+    # Только чужие файлы - архива нет
+    response = client.post('/files/download', data={'file_ids': file_ids(app, 2)})
+    assert response.status_code == 302
+
+
+def test_missing_blob_is_skipped(app, client):
+    upload(client, b'first', 'a.txt')
+    upload(client, b'lost', 'b.txt')
+    upload(client, b'last', 'c.txt')
+    with db.pooled_connection(app) as conn:
+        lost = conn.execute("SELECT blob_hash FROM files WHERE original_name = 'b.txt'").fetchone()[0]
+    os.remove(storage.get_blob_store(app).path(lost))
+    with download(client, file_ids(app)) as zf:
+        assert zf.testzip() is None
+        assert sorted(zf.namelist()) == ['a.txt', 'c.txt']
+
+
+class VanishingBackend(storage.LocalBackend):
+    """Объект пропадает между stat и open"""
+
+    def open(self, key, length=None):
+        if key == 'gone.txt':
+            raise FileNotFoundError(key)
+        return super().open(key, length)
+
+
+def test_object_removed_after_stat(tmp_path):
+    for name in ('gone.txt', 'kept.txt'):
+        (tmp_path / name).write_bytes(name.encode())
+    backend = VanishingBackend(str(tmp_path))
+    data = b''.join(archive.stream_zip([('gone.txt', backend, 'gone.txt'), ('kept.txt', backend, 'kept.txt')]))
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        assert zf.namelist() == ['kept.txt']
+        assert zf.read('kept.txt') == b'kept.txt'
+
+
+@pytest.mark.skipif(not photometa.available(), reason='Pillow не установлен')
+def test_album_archive(app, client):
+    client.post('/album/new', data={'title': 'Отпуск'})
+    photos = {}
+    for color in ('red', 'blue'):
+        photos[color] = jpeg(color).getvalue()
+        client.post('/album/1/add_photo', data={'photo': (io.BytesIO(photos[color]), 'photo.jpg')},
+                    content_type='multipart/form-data')
+    response = client.get('/album/1/download')
+    assert response.status_code == 200
+    assert "filename*=UTF-8''%D0%9E%D1%82%D0%BF%D1%83%D1%81%D0%BA.zip" in response.headers['Content-Disposition']
+    with zipfile.ZipFile(io.BytesIO(response.get_data())) as zf:
+        assert zf.namelist() == ['photo.jpg', 'photo (2).jpg']
+        assert zf.read('photo.jpg') == photos['red']
+        assert zf.getinfo('photo.jpg').compress_type == zipfile.ZIP_STORED
+
+    # Чужой альбом не отдаётся
+    other = register(app.test_client(), 'bob')
+    assert other.get('/album/1/download').status_code == 302
@@ -0,0 +1,110 @@
+"""
+ASGI-адаптер: приём тела запроса до вызова маршрута, лимиты маршрутов и квота
+"""
+
+import asyncio
+
+import pytest
+
+import app as oblako
+import asgi
+
+
+def request(app, path, messages, method='POST', headers=()):
+    """Запрос к адаптеру; возвращает (отправленные сообщения, вызывалось ли приложение)"""
+    adapter = asgi.ASGIAdapter(app)
+    called = []
+    wsgi_app = app.wsgi_app
+
+    def tracking(environ, start_response):
+        called.append(environ['PATH_INFO'])
+        return wsgi_app(environ, start_response)
+
+    scope = {'type': 'http', 'method': method, 'path': path, 'query_string': b'',
+             'headers': [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]}
+    incoming = list(messages)
+    sent = []
+
+    async def receive():
+        return incoming.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    app.wsgi_app = tracking
+    try:
+        asyncio.run(adapter(scope, receive, send))
+    finally:
+        app.wsgi_app = wsgi_app
+        adapter.executor.shutdown(wait=True)
+    return sent, called
+
+
+@pytest.fixture
+def limits(app):
+    app.config.update(MAX_CONTENT_LENGTH=100, ALBUM_BATCH_MAX_SIZE=1000)
+    return app
+
+
+def test_declared_size_over_route_limit(limits):
+    """Лимит пакетной загрузки фото не действует для остальных адресов"""
+    sent, called = request(limits, '/upload', [], headers=[('Content-Length', '500')])
+    assert sent[0]['status'] == 413
+    assert called == []
+
+
+def test_streamed_body_over_route_limit(limits):
+    body = {'type': 'http.request', 'body': b'x' * 60, 'more_body': True}
+    sent, called = request(limits, '/upload', [body, body])
+    assert sent[0]['status'] == 413
+    assert called == []
+
+
+def test_batch_route_keeps_its_limit(limits):
+    _, called = request(limits, '/album/1/add_photos', [{'type': 'http.request', 'body': b'x' * 500}],
+                           headers=[('Content-Length', '500')])
+    assert called == ['/album/1/add_photos']
+
+
+def test_disconnect_does_not_call_app(limits):
+    sent, called = request(limits, '/upload', [{'type': 'http.request', 'body': b'x' * 10, 'more_body': True},
+                                               {'type': 'http.disconnect'}])
+    assert sent == []
+    assert called == []
+
+
+def session_cookie(client):
+    return ('Cookie', 'session=' + client.get_cookie('session').value)
+
+
+def test_quota_applies_while_spooling(app, client):
+    """Тело загрузки сверх свободного места обрывается при приёме, маршрут не вызывается"""
+    app.config['USER_QUOTA_BYTES'] = 1000
+    limit = 1000 + oblako.UPLOAD_FORM_OVERHEAD
+    chunk = {'type': 'http.request', 'body': b'x' * (limit // 2 + 1), 'more_body': True}
+    sent, called = request(app, '/upload', [chunk, chunk], headers=[session_cookie(client)])
+    assert sent[0]['status'] == 413
+    assert called == []
+
+    # Заявленный размер сверх квоты отклоняется до приёма
+    sent, called = request(app, '/upload', [], headers=[session_cookie(client), ('Content-Length', str(limit + 1))])
+    assert sent[0]['status'] == 413
+    assert called == []
+
+    # Части загрузки по частям ограничены только лимитом маршрута: место зарезервировано
+    app.config['USER_QUOTA_BYTES'] = None
+    session_id = client.post('/api/uploads', json={'filename': 'a.zip', 'size': 10}).get_json()['id']
+    app.config['USER_QUOTA_BYTES'] = 1
+    _, called = request(app, '/api/uploads/' + session_id, [{'type': 'http.request', 'body': b'x' * 10}],
+                        method='PUT', headers=[session_cookie(client)])
+    assert called == ['/api/uploads/' + session_id]
+
+
+def test_quota_does_not_limit_anonymous_or_other_routes(app, client):
+    app.config['USER_QUOTA_BYTES'] = 1
+    body = {'type': 'http.request', 'body': b'x' * (oblako.UPLOAD_FORM_OVERHEAD + 10)}
+    # Без входа маршрут сам перенаправит на страницу входа
+    _, called = request(app, '/upload', [body])
+    assert called == ['/upload']
+    _, called = request(app, '/album/new', [body], headers=[session_cookie(client)])
+    assert called == ['/album/new']
@@ -0,0 +1,109 @@
+"""
+Кэши в памяти процесса: фрагменты страниц по версии данных и пользователи
+"""
+
+import io
+import time
+
+import app as oblako
+import db
+from conftest import register
+
+
+def upload(client, data, name):
+    response = client.post('/upload', data={'file': (io.BytesIO(data), name)}, content_type='multipart/form-data')
+    assert response.status_code == 302
+
+
+def execute(app, sql, params=()):
+    with db.pooled_connection(app) as conn:
+        conn.execute(sql, params)
+        conn.commit()
+
+
+def dashboard(client):
+    response = client.get('/dashboard')
+    assert response.status_code == 200
+    return response.get_data(as_text=True)
+
+
+def test_dashboard_fragment_follows_data_version(app, client):
+    upload(client, b'first', 'first.txt')
+    assert 'first.txt' in dashboard(client)
+
+    # Переименование не меняет версию данных - страница берётся из кэша
+    execute(app, "UPDATE files SET original_name = 'renamed.txt' WHERE original_name = 'first.txt'")
+    page = dashboard(client)
+    assert 'first.txt' in page and 'renamed.txt' not in page
+
+    # Загрузка увеличивает users.data_version, старый фрагмент больше не читается
+    upload(client, b'second', 'second.txt')
+    page = dashboard(client)
+    assert 'renamed.txt' in page and 'second.txt' in page
+
+    execute(app, "UPDATE files SET original_name = 'again.txt' WHERE original_name = 'second.txt'")
+    with db.pooled_connection(app) as conn:
+        file_id = conn.execute("SELECT id FROM files WHERE original_name = 'renamed.txt'").fetchone()[0]
+    client.get('/delete/file/{0}'.format(file_id))
+    page = dashboard(client)
+    assert 'renamed.txt' not in page and 'again.txt' in page
+
+
+def test_fragment_is_not_shared_between_users(app, client):
+    upload(client, b'mine', 'alice-private.txt')
+    assert 'alice-private.txt' in dashboard(client)
+    other = register(app.test_client(), 'bob')
+    # Версии данных совпадают, ключ различается только пользователем
+    execute(app, 'UPDATE users SET data_version = 7')
+    assert 'alice-private.txt' in dashboard(client)
+    assert 'alice-private.txt' not in dashboard(other)
+    upload(other, b'his', 'bob-private.txt')
+    execute(app, 'UPDATE users SET data_version = 8')
+    assert 'bob-private.txt' not in dashboard(client)
+    assert 'alice-private.txt' not in dashboard(other)
+
+
+def test_invalidate_user_reloads_record(app, client):
+    assert '>AL<' in dashboard(client).replace(' ', '').replace('\n', '')
+    execute(app, "UPDATE users SET username = 'zoe' WHERE id = 1")
+    assert oblako.user_cache.get('1') is not None
+    with app.test_request_context():
+        oblako.invalidate_user(1)
+    assert oblako.user_cache.get('1') is None
+    assert '>ZO<' in dashboard(client).replace(' ', '').replace('\n', '')
+
+
+def test_password_rehash_invalidates_user(app, client):
+    dashboard(client)
+    execute(app, "UPDATE users SET email = 'new@example.com' WHERE id = 1")
+    assert oblako.user_cache.get('1')[2] == 'alice@example.com'
+    # Вход с хешем устаревшего метода перезаписывает users.password_hash
+    app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:2000'
+    response = app.test_client().post('/login', data={'username': 'alice', 'password': 'secret1'})
+    assert response.status_code == 302
+    with db.pooled_connection(app) as conn:
+        assert conn.execute('SELECT password_hash FROM users WHERE id = 1').fetchone()[0].startswith(
+            'pbkdf2:sha256:2000$')
+    assert oblako.user_cache.get('1') is None
+    dashboard(client)
+    assert oblako.user_cache.get('1')[2] == 'new@example.com'
+
+
+def test_session_copy_expires_with_cache_entry(app, client):
+    """Копия в сессии живёт USER_CACHE_TTL от чтения из базы, а не от копирования"""
+    app.config['SESSION_USER_FIELDS'] = True
+    loaded_at = time.time() - 100
+    oblako.user_cache.set('1', (1, 'alice', 'alice@example.com', loaded_at))
+    dashboard(client)
+    with client.session_transaction() as sess:
+        assert sess['_user'] == [1, 'alice', 'alice@example.com', int(loaded_at)]
+
+    # Просроченная копия в сессии не используется, запись читается заново
+    oblako.user_cache.clear()
+    execute(app, "UPDATE users SET email = 'new@example.com' WHERE id = 1")
+    with client.session_transaction() as sess:
+        sess['_user'] = [1, 'alice', 'alice@example.com', int(time.time()) - app.config['USER_CACHE_TTL'] - 1]
+    dashboard(client)
+    with client.session_transaction() as sess:
+        assert sess['_user'][2] == 'new@example.com'
+        assert time.time() - sess['_user'][3] < 5
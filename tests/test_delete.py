@@ -0,0 +1,76 @@
+"""
+Удаление файлов и фото: ошибка при снятии ссылки на блоб откатывает удаление
+"""
+
+import io
+import os
+import sqlite3
+
+import pytest
+
+import db
+import photometa
+import reaper
+import storage
+from conftest import jpeg
+
+
+def query(app, sql, params=()):
+    with db.pooled_connection(app) as conn:
+        return conn.execute(sql, params).fetchall()
+
+
+def failing_enqueue(conn, blob_hash):
+    raise sqlite3.OperationalError('disk I/O error')
+
+
+def flashes(client):
+    with client.session_transaction() as sess:
+        return [message for _, message in sess.get('_flashes', [])]
+
+
+def test_delete_file(app, client):
+    client.post('/upload', data={'file': (io.BytesIO(b'content'), 'a.txt')}, content_type='multipart/form-data')
+    blob_hash = query(app, 'SELECT blob_hash FROM files')[0][0]
+    assert client.get('/delete/file/1').status_code == 302
+    assert query(app, 'SELECT COUNT(*) FROM files') == [(0,)]
+    assert query(app, 'SELECT files_count, total_bytes FROM user_stats WHERE user_id = 1') == [(0, 0)]
+    assert query(app, 'SELECT blob_hash FROM pending_deletions') == [(blob_hash,)]
+
+
+def test_failed_file_release_keeps_record(app, client, monkeypatch):
+    client.post('/upload', data={'file': (io.BytesIO(b'content'), 'a.txt')}, content_type='multipart/form-data')
+    blob_hash = query(app, 'SELECT blob_hash FROM files')[0][0]
+    with monkeypatch.context() as patch:
+        patch.setattr(reaper, 'enqueue_blob', failing_enqueue)
+        response = client.get('/delete/file/1')
+    assert response.status_code == 302 and response.location.endswith('/dashboard')
+    assert flashes(client)[-1] == 'Ошибка при удалении файла: disk I/O error'
+    assert 'Файл удалён' not in flashes(client)
+    # Запись, ссылка на блоб и статистика не изменились
+    assert query(app, 'SELECT COUNT(*) FROM files') == [(1,)]
+    assert query(app, 'SELECT refcount FROM blobs WHERE hash = ?', (blob_hash,)) == [(1,)]
+    assert query(app, 'SELECT files_count, total_bytes FROM user_stats WHERE user_id = 1') == [(1, len(b'content'))]
+    assert os.path.exists(storage.get_blob_store(app).path(blob_hash))
+
+    # Соединение не осталось в открытой транзакции
+    client.get('/delete/file/1')
+    assert query(app, 'SELECT COUNT(*) FROM files') == [(0,)]
+
+
+@pytest.mark.skipif(not photometa.available(), reason='Pillow не установлен')
+def test_failed_photo_release_keeps_record(app, client, monkeypatch):
+    client.post('/album/new', data={'title': 'A'})
+    client.post('/album/1/add_photo', data={'photo': (jpeg(), 'p.jpg')}, content_type='multipart/form-data')
+    blob_hash = query(app, 'SELECT blob_hash FROM photos')[0][0]
+    album = query(app, 'SELECT photo_count, total_bytes, cover_photo FROM albums')
+    monkeypatch.setattr(reaper, 'enqueue_blob', failing_enqueue)
+
+    response = client.get('/photo/1/delete')
+    assert response.status_code == 302 and response.location.endswith('/album/1')
+    assert flashes(client)[-1] == 'Ошибка при удалении файла: disk I/O error'
+    assert 'Фото удалено' not in flashes(client)
+    assert query(app, 'SELECT COUNT(*) FROM photos') == [(1,)]
+    assert query(app, 'SELECT refcount FROM blobs WHERE hash = ?', (blob_hash,)) == [(1,)]
+    assert query(app, 'SELECT photo_count, total_bytes, cover_photo FROM albums') == album
+    assert query(app, 'SELECT COUNT(*) FROM pending_deletions') == [(0,)]
@@ -0,0 +1,138 @@
+"""
+Отдача файлов: условные запросы (304), Range, неизменяемые адреса и
+передача скачивания фронтенду (X-Accel-Redirect, X-Sendfile)
+"""
+
+import hashlib
+import io
+import os
+
+import pytest
+
+import db
+import storage
+
+DATA = bytes(range(256)) * 40
+
+
+@pytest.fixture
+def stored(app, client):
+    """Загруженный файл: (адрес скачивания, путь блоба на диске)"""
+    client.post('/upload', data={'file': (io.BytesIO(DATA), 'data.zip')}, content_type='multipart/form-data')
+    with db.pooled_connection(app) as conn:
+        filename, blob_hash = conn.execute('SELECT filename, blob_hash FROM files').fetchone()
+    return '/uploads/' + filename, storage.get_blob_store(app).path(blob_hash)
+
+
+def test_full_download(client, stored):
+    response = client.get(stored[0])
+    assert response.status_code == 200
+    assert response.get_data() == DATA
+    assert response.headers['ETag'] == '"{0}"'.format(hashlib.sha256(DATA).hexdigest())
+    assert 'data.zip' in response.headers['Content-Disposition']
+
+
+def test_not_modified(client, stored):
+    first = client.get(stored[0])
+    response = client.get(stored[0], headers={'If-None-Match': first.headers['ETag']})
+    assert response.status_code == 304
+    assert response.get_data() == b''
+    response = client.get(stored[0], headers={'If-Modified-Since': first.headers['Last-Modified']})
+    assert response.status_code == 304
+    # Другой ETag - файл отдаётся целиком
+    response = client.get(stored[0], headers={'If-None-Match': '"other"'})
+    assert response.status_code == 200 and response.get_data() == DATA
+
+
+def test_range(client, stored):
+    response = client.get(stored[0], headers={'Range': 'bytes=100-199'})
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == 'bytes 100-199/{0}'.format(len(DATA))
+    assert response.get_data() == DATA[100:200]
+
+    response = client.get(stored[0], headers={'Range': 'bytes=-10'})
+    assert response.status_code == 206 and response.get_data() == DATA[-10:]
+
+    response = client.get(stored[0], headers={'Range': 'bytes={0}-'.format(len(DATA) + 10)})
+    assert response.status_code == 416
+    assert response.headers['Content-Range'] == 'bytes */{0}'.format(len(DATA))
+
+
+def test_if_range(client, stored):
+    etag = client.get(stored[0]).headers['ETag']
+    response = client.get(stored[0], headers={'Range': 'bytes=0-9', 'If-Range': etag})
+    assert response.status_code == 206 and response.get_data() == DATA[:10]
+    # Содержимое сменилось - докачка невозможна, файл отдаётся целиком
+    response = client.get(stored[0], headers={'Range': 'bytes=0-9', 'If-Range': '"changed"'})
+    assert response.status_code == 200 and response.get_data() == DATA
+
+
+def test_other_users_file_is_forbidden(app, stored):
+    from conftest import register
+    other = register(app.test_client(), 'bob')
+    assert other.get(stored[0]).status_code == 403
+
+
+@pytest.mark.parametrize('mode, header', [('x-accel-redirect', 'X-Accel-Redirect'), ('x-sendfile', 'X-Sendfile')])
+def test_offload(app, client, stored, mode, header):
+    app.config['DOWNLOAD_OFFLOAD'] = mode
+    url, path = stored
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.get_data() == b''
+    if mode == 'x-accel-redirect':
+        relative = os.path.relpath(path, app.config['BLOBS_FOLDER']).replace(os.sep, '/')
+        assert response.headers[header] == '/_protected/blobs/' + relative
+    else:
+        assert response.headers[header] == path
+    # Тип, имя и ETag по-прежнему задаёт приложение
+    assert 'data.zip' in response.headers['Content-Disposition']
+    assert response.headers['ETag'] == '"{0}"'.format(hashlib.sha256(DATA).hexdigest())
+
+    # Range выполняет фронтенд: приложение не режет пустое тело и не отвечает 416
+    response = client.get(url, headers={'Range': 'bytes=100-199'})
+    assert response.status_code == 200
+    assert response.headers[header] and 'Content-Range' not in response.headers
+    response = client.get(url, headers={'Range': 'bytes={0}-'.format(len(DATA) + 10)})
+    assert response.status_code == 200
+
+    # Условный запрос обрабатывается без фронтенда
+    response = client.get(url, headers={'If-None-Match': response.headers['ETag']})
+    assert response.status_code == 304
+    assert header not in response.headers
+
+
+def test_offload_outside_mapped_folders(app, client, stored):
+    """Каталог без internal-локации отдаётся самим приложением"""
+    app.config['DOWNLOAD_OFFLOAD'] = 'x-accel-redirect'
+    app.config['X_ACCEL_LOCATIONS'] = {}
+    response = client.get(stored[0])
+    assert response.status_code == 200 and response.get_data() == DATA
+    assert 'X-Accel-Redirect' not in response.headers
+
+
+def test_immutable_url_answers_without_login(app, client):
+    """Совпавший v в If-None-Match: 304 без загрузки пользователя и запросов к базе"""
+    anonymous = app.test_client()
+    url = '/album/1/photo/any.jpg?v=abc123'
+    response = anonymous.get(url, headers={'If-None-Match': '"abc123"'})
+    assert response.status_code == 304
+    assert response.headers['ETag'] == '"abc123"'
+    assert response.cache_control.immutable and response.cache_control.private
+    assert response.cache_control.max_age == app.config['IMMUTABLE_MAX_AGE']
+    # Без совпадения проверяются вход и права
+    assert anonymous.get(url, headers={'If-None-Match': '"other"'}).status_code == 302
+    assert client.get(url).status_code == 404
+
+
+def test_immutable_url_marks_matching_response(app, client, stored):
+    with db.pooled_connection(app) as conn:
+        blob_hash = conn.execute('SELECT blob_hash FROM files').fetchone()[0]
+    url = stored[0] + '/thumb'
+    response = client.get(url, query_string={'v': blob_hash})
+    assert response.status_code == 200 and response.get_data() == DATA
+    assert response.cache_control.immutable
+    # Устаревшая версия в адресе не кэшируется навсегда
+    response = client.get(url, query_string={'v': 'stale'})
+    assert response.status_code == 200
+    assert not response.cache_control.immutable
@@ -0,0 +1,73 @@
+"""
+Эндпоинт /img: права, ошибки источника и переполнение очереди
+"""
+
+import io
+
+import pytest
+
+import images
+import storage
+from conftest import jpeg, register
+
+pytestmark = pytest.mark.skipif(not images.available(), reason='Pillow не установлен')
+
+
+@pytest.fixture
+def photo(app, client):
+    """Фото 1 в альбоме 1 пользователя alice; возвращает хеш блоба"""
+    client.post('/album/new', data={'title': 'A'})
+    response = client.post('/album/1/add_photo', data={'photo': (jpeg(size=(400, 300)), 'p.jpg')},
+                           content_type='multipart/form-data')
+    assert response.status_code == 200
+    with app.app_context():
+        return app.extensions['sqlite_pool'].acquire().execute('SELECT blob_hash FROM photos WHERE id = 1').fetchone()[0]
+
+
+def test_resize_and_cache(client, photo):
+    response = client.get('/img/1?w=100&fmt=jpeg')
+    assert response.status_code == 200
+    assert response.mimetype == 'image/jpeg'
+    from PIL import Image
+    assert Image.open(io.BytesIO(response.data)).size == (128, 96)
+    again = client.get('/img/1?w=100&fmt=jpeg', headers={'If-None-Match': response.headers['ETag']})
+    assert again.status_code == 304
+
+
+def test_bad_parameters(client, photo):
+    assert client.get('/img/1').status_code == 400
+    assert client.get('/img/1?w=0').status_code == 400
+    assert client.get('/img/1?w=10&fmt=gif').status_code == 400
+
+
+def test_foreign_photo_is_not_found(app, photo):
+    other = register(app.test_client(), 'bob')
+    assert other.get('/img/1?w=64').status_code == 404
+
+
+def test_missing_source_does_not_leak_slots(app, client, photo):
+    """Ошибка чтения оригинала освобождает слот очереди: после неё - снова 404, а не 503"""
+    storage.get_blob_store(app).backend.delete(storage.shard_key(photo))
+    statuses = [client.get('/img/1?w={0}&fmt=jpeg'.format(64 + i)).status_code
+                for i in range(app.config['IMG_QUEUE_LIMIT'] + 4)]
+    assert set(statuses) == {404}
+
+
+def test_overloaded_queue(app, client, photo):
+    images.get_executor(app)
+    taken = 0
+    while images._slots.acquire(blocking=False):
+        taken += 1
+    try:
+        response = client.get('/img/1?w=480&fmt=jpeg')
+        assert response.status_code == 503
+        assert response.headers['Retry-After']
+    finally:
+        for _ in range(taken):
+            images._slots.release()
+    assert client.get('/img/1?w=480&fmt=jpeg').status_code == 200
+
+
+def test_pool_is_not_forked(app):
+    executor = images.get_executor(app)
+    assert executor._mp_context.get_start_method() == app.config['PROCESS_START_METHOD'] != 'fork'
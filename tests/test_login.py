@@ -0,0 +1,61 @@
+"""
+Ограничение попыток входа: по адресу клиента и по имени пользователя
+"""
+
+import pytest
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+import app as oblako
+import passwords
+import ratelimit
+
+
+@pytest.fixture
+def throttle(app, monkeypatch):
+    """Три попытки подряд, дальше - одна в минуту"""
+    limiter = ratelimit.RateLimiter(1 / 60.0, 3)
+    monkeypatch.setattr(oblako, 'login_throttle', limiter)
+    return limiter
+
+
+def attempt(client, username, address='10.0.0.1', **headers):
+    return client.post('/login', data={'username': username, 'password': 'wrong'},
+                       environ_base={'REMOTE_ADDR': address}, headers=headers)
+
+
+def test_attempts_from_one_address(app, throttle):
+    client = app.test_client()
+    for name in ('a', 'b', 'c'):
+        assert attempt(client, name).status_code == 200
+    response = attempt(client, 'd')
+    assert response.status_code == 429
+    assert int(response.headers['Retry-After']) > 0
+    # Другой адрес и другое имя - свои счётчики
+    assert attempt(client, 'e', address='10.0.0.2').status_code == 200
+
+
+def test_attempts_for_one_username(app, throttle):
+    client = app.test_client()
+    for number in range(3):
+        assert attempt(client, 'alice', address='10.0.1.{0}'.format(number)).status_code == 200
+    assert attempt(client, 'alice', address='10.0.1.9').status_code == 429
+    assert attempt(client, 'bob', address='10.0.1.9').status_code == 200
+
+
+def test_forwarded_address_behind_proxy(app, throttle, monkeypatch):
+    monkeypatch.setattr(app, 'wsgi_app', ProxyFix(app.wsgi_app, x_for=1))
+    client = app.test_client()
+    for number in range(3):
+        assert attempt(client, 'user{0}'.format(number), address='127.0.0.1',
+                       **{'X-Forwarded-For': '203.0.113.7'}).status_code == 200
+    assert attempt(client, 'user9', address='127.0.0.1',
+                   **{'X-Forwarded-For': '203.0.113.7'}).status_code == 429
+    # Все клиенты приходят с адреса прокси, но счётчики у них разные
+    assert attempt(client, 'user10', address='127.0.0.1',
+                   **{'X-Forwarded-For': '198.51.100.4'}).status_code == 200
+
+
+def test_password_pool_is_not_forked(app):
+    """Пул запускается не через fork: процесс приложения многопоточный"""
+    executor = passwords.get_executor(app)
+    assert executor._mp_context.get_start_method() == app.config['PROCESS_START_METHOD'] != 'fork'
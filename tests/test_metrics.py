@@ -0,0 +1,36 @@
+"""
+Доступ к /metrics: по токену или, если это явно разрешено, прямым запросам с localhost
+"""
+
+
+def get(app, address, **headers):
+    return app.test_client().get('/metrics', environ_base={'REMOTE_ADDR': address}, headers=headers)
+
+
+def test_closed_without_token(app):
+    app.config.update(METRICS_TOKEN=None, METRICS_ALLOW_LOOPBACK=False)
+    assert get(app, '127.0.0.1').status_code == 403
+    assert get(app, '203.0.113.7').status_code == 403
+
+
+def test_loopback_opt_in(app):
+    app.config.update(METRICS_TOKEN=None, METRICS_ALLOW_LOOPBACK=True)
+    response = get(app, '127.0.0.1')
+    assert response.status_code == 200
+    assert b'# TYPE' in response.data
+    assert get(app, '::1').status_code == 200
+    assert get(app, '203.0.113.7').status_code == 403
+
+
+def test_proxied_request_is_not_loopback(app):
+    """За nginx на той же машине внешний клиент тоже приходит с 127.0.0.1"""
+    app.config.update(METRICS_TOKEN=None, METRICS_ALLOW_LOOPBACK=True)
+    assert get(app, '127.0.0.1', **{'X-Forwarded-For': '203.0.113.7'}).status_code == 403
+    assert get(app, '127.0.0.1', Forwarded='for=203.0.113.7').status_code == 403
+
+
+def test_token_required_from_any_address(app):
+    app.config.update(METRICS_TOKEN='secret', METRICS_ALLOW_LOOPBACK=True)
+    assert get(app, '127.0.0.1').status_code == 403
+    assert get(app, '203.0.113.7', Authorization='Bearer wrong').status_code == 403
+    assert get(app, '203.0.113.7', Authorization='Bearer secret').status_code == 200
@@ -0,0 +1,123 @@
+"""
+Миграции схемы: база первой версии обновляется на месте без потери данных
+"""
+
+import os
+import sqlite3
+
+import pytest
+from werkzeug.security import generate_password_hash
+
+import app as oblako
+import db
+
+# Схема до появления миграций (init_db первой версии)
+ORIGINAL_SCHEMA = '''
+    CREATE TABLE users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT UNIQUE NOT NULL,
+        email TEXT UNIQUE NOT NULL,
+        password_hash TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE files (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        filename TEXT NOT NULL,
+        original_name TEXT NOT NULL,
+        file_type TEXT NOT NULL,
+        file_size INTEGER NOT NULL,
+        upload_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users (id)
+    );
+    CREATE TABLE albums (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        title TEXT NOT NULL,
+        description TEXT,
+        cover_photo TEXT,
+        photo_count INTEGER DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users (id)
+    );
+    CREATE TABLE photos (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        album_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        filename TEXT NOT NULL,
+        original_name TEXT NOT NULL,
+        description TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (album_id) REFERENCES albums (id) ON DELETE CASCADE,
+        FOREIGN KEY (user_id) REFERENCES users (id)
+    );
+'''
+
+
+def old_database(app, tmp_path):
+    """База первой версии с пользователем, файлом и альбомом из двух фото"""
+    path = str(tmp_path / 'old.db')
+    conn = sqlite3.connect(path)
+    conn.executescript(ORIGINAL_SCHEMA)
+    conn.execute("INSERT INTO users (username, email, password_hash) VALUES ('bob', 'bob@example.com', ?)",
+                 (generate_password_hash('secret1', method='pbkdf2:sha256:1000'),))
+    conn.execute('''
+        INSERT INTO files (user_id, filename, original_name, file_type, file_size)
+        VALUES (1, '20240101_000000_abcd_report.txt', 'report.txt', 'txt', 6)
+    ''')
+    # Счётчик фото в старой базе мог разойтись с таблицей photos
+    conn.execute("INSERT INTO albums (user_id, title, photo_count) VALUES (1, 'Отпуск', 5)")
+    conn.executemany('INSERT INTO photos (album_id, user_id, filename, original_name) VALUES (1, 1, ?, ?)',
+                     [('a.jpg', 'a.jpg'), ('b.jpg', 'b.jpg')])
+    conn.commit()
+    conn.close()
+
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    with open(os.path.join(app.config['UPLOAD_FOLDER'], '20240101_000000_abcd_report.txt'), 'wb') as f:
+        f.write(b'report')
+    album_folder = os.path.join(app.config['ALBUMS_FOLDER'], '1')
+    os.makedirs(album_folder)
+    for name, data in (('a.jpg', b'aaa'), ('b.jpg', b'bbbb')):
+        with open(os.path.join(album_folder, name), 'wb') as f:
+            f.write(data)
+    return path
+
+
+def test_original_database_is_upgraded(app, tmp_path):
+    app.config['DATABASE'] = old_database(app, tmp_path)
+    oblako.init_db()
+    # Повторный запуск ничего не меняет
+    oblako.init_db()
+
+    conn = sqlite3.connect(app.config['DATABASE'])
+    assert conn.execute('PRAGMA user_version').fetchone()[0] == oblako.MIGRATIONS[-1][0]
+    indexes = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    assert {'idx_files_user_date', 'idx_files_filename', 'idx_albums_user_created',
+            'idx_photos_album_created'} <= indexes
+    assert conn.execute('SELECT photo_count, total_bytes, cover_photo FROM albums').fetchone() == (2, 7, 'a.jpg')
+    assert conn.execute('SELECT files_count, total_bytes FROM user_stats WHERE user_id = 1').fetchone() == (1, 6)
+    conn.close()
+
+    client = app.test_client()
+    response = client.post('/login', data={'username': 'bob', 'password': 'secret1'})
+    assert response.status_code == 302
+    assert client.get('/uploads/20240101_000000_abcd_report.txt').data == b'report'
+    assert 'report.txt' in client.get('/api/search?q=report').get_data(as_text=True)
+    assert client.get('/album/1').status_code == 200
+
+
+def test_failed_migration_is_rolled_back(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / 'test.db'), isolation_level=None)
+    migrations = [(1, 'CREATE TABLE a (id INTEGER)'),
+                  (2, '''
+                      CREATE TABLE b (id INTEGER);
+                      INSERT INTO missing VALUES (1);
+                  ''')]
+    with pytest.raises(sqlite3.OperationalError):
+        db.migrate(conn, migrations)
+    assert conn.execute('PRAGMA user_version').fetchone()[0] == 1
+    assert conn.execute("SELECT name FROM sqlite_master WHERE name = 'b'").fetchone() is None
+
+    # Исправленная миграция применяется со следующего запуска
+    migrations[1] = (2, 'CREATE TABLE b (id INTEGER)')
+    assert db.migrate(conn, migrations) == 2
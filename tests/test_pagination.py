@@ -0,0 +1,93 @@
+"""
+Постраничный вывод по курсору: обход без пропусков и повторов, проверка курсора
+"""
+
+import base64
+
+import pytest
+
+import app as oblako
+import db
+
+
+def add_files(app, count, upload_date='2024-01-01 00:00:00', prefix='f'):
+    """Файлы alice с одинаковой датой загрузки: порядок определяет id"""
+    with db.pooled_connection(app) as conn:
+        conn.executemany('''
+            INSERT INTO files (user_id, filename, original_name, file_type, file_size, upload_date)
+            VALUES (1, ?, ?, 'txt', 1, ?)
+        ''', [('{0}{1}.txt'.format(prefix, i), '{0}{1}.txt'.format(prefix, i), upload_date)
+              for i in range(count)])
+        conn.commit()
+
+
+def walk(client, url, key, limit):
+    """Все страницы подряд: (id по порядку, число страниц)"""
+    ids, pages, cursor = [], 0, None
+    while True:
+        response = client.get(url, query_string={'limit': limit, 'cursor': cursor or ''})
+        assert response.status_code == 200
+        data = response.get_json()
+        ids.extend(item['id'] for item in data[key])
+        pages += 1
+        cursor = data['next_cursor']
+        if cursor is None:
+            return ids, pages
+
+
+def test_files_pages_with_equal_dates(app, client):
+    add_files(app, 7)
+    add_files(app, 2, upload_date='2024-02-01 00:00:00', prefix='g')
+    ids, pages = walk(client, '/api/files', 'files', 2)
+    # Новые сверху, при равной дате - по убыванию id
+    assert ids == [9, 8, 7, 6, 5, 4, 3, 2, 1]
+    assert pages == 5
+
+
+def test_last_full_page_has_no_cursor(app, client):
+    add_files(app, 4)
+    data = client.get('/api/files?limit=4').get_json()
+    assert len(data['files']) == 4 and data['next_cursor'] is None
+
+
+def test_page_size_is_clamped(app, client, monkeypatch):
+    monkeypatch.setitem(app.config, 'MAX_PAGE_SIZE', 3)
+    add_files(app, 5)
+    assert len(client.get('/api/files?limit=100').get_json()['files']) == 3
+    assert len(client.get('/api/files?limit=0').get_json()['files']) == 1
+
+
+def encode(raw):
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+@pytest.mark.parametrize('cursor', [
+    '!!!',                                      # не base64
+    encode('2024-01-01 00:00:00'),              # нет id
+    encode('2024-01-01 00:00:00|abc'),          # id не число
+    base64.urlsafe_b64encode(b'\xff\xfe|1').decode('ascii'),  # не UTF-8
+])
+def test_malformed_cursor(app, client, cursor):
+    add_files(app, 3)
+    assert client.get('/api/files', query_string={'cursor': cursor}).status_code == 400
+    assert client.get('/dashboard', query_string={'cursor': cursor}).status_code == 400
+
+
+def test_search_cursor_score_must_be_number(app, client):
+    add_files(app, 3)
+    assert client.get('/api/search', query_string={'q': 'f1', 'cursor': encode('abc|1')}).status_code == 400
+
+
+def test_cursor_round_trip():
+    cursor = oblako.encode_cursor('2024-01-01 00:00:00', 42)
+    with oblako.app.test_request_context():
+        assert oblako.decode_cursor(cursor) == ('2024-01-01 00:00:00', 42)
+        assert oblako.decode_cursor('') is None
+
+
+def test_photo_filters_are_validated(app, client):
+    client.post('/album/new', data={'title': 'A'})
+    assert client.get('/api/album/1/photos?sort=taken').status_code == 200
+    assert client.get('/api/album/1/photos?sort=size').status_code == 400
+    assert client.get('/api/album/1/photos?taken_from=2024-13-01').status_code == 400
+    assert client.get('/api/album/1/photos', query_string={'cursor': '!!!'}).status_code == 400
@@ -0,0 +1,116 @@
+"""
+Квоты и ограничения загрузок: отказ до записи на диск и в транзакции записи
+"""
+
+import io
+import os
+
+import pytest
+
+import app as oblako
+import db
+import photometa
+import thumbnails
+from conftest import jpeg
+
+
+def upload(client, data, name='data.txt', **kwargs):
+    return client.post('/upload', data={'file': (io.BytesIO(data), name)},
+                       content_type='multipart/form-data', **kwargs)
+
+
+def stored(app):
+    """Файлы в хранилище блобов (без временных)"""
+    root = app.config['BLOBS_FOLDER']
+    return sorted(name for folder, _, names in os.walk(root)
+                  if os.path.relpath(folder, root).split(os.sep)[0] != 'tmp' for name in names)
+
+
+def temp_files(app):
+    """Временные файлы загрузок, после завершения фоновых миниатюр (они тоже пишут в tmp)"""
+    if thumbnails._executor is not None:
+        thumbnails._executor.shutdown(wait=True)
+        thumbnails._executor = None
+    tmp_dir = os.path.join(app.config['BLOBS_FOLDER'], 'tmp')
+    return os.listdir(tmp_dir) if os.path.isdir(tmp_dir) else []
+
+
+def usage(app, user_id=1):
+    with db.pooled_connection(app) as conn:
+        return oblako.quotas.usage(conn, user_id)
+
+
+@pytest.fixture
+def quota(app):
+    app.config['USER_QUOTA_BYTES'] = 1000
+    return app
+
+
+def test_declared_size_over_quota(quota, client):
+    """Тело больше квоты с запасом на заголовки формы не читается вовсе"""
+    response = upload(client, b'x' * (1000 + oblako.UPLOAD_FORM_OVERHEAD + 1))
+    assert response.status_code == 413
+    assert 'квота' in response.get_data(as_text=True)
+    assert temp_files(quota) == [] and stored(quota) == []
+
+
+def test_streamed_body_over_quota(quota, client):
+    """Тело без Content-Length обрывается, как только превысит квоту"""
+    body = io.BytesIO(b'x' * (1000 + oblako.UPLOAD_FORM_OVERHEAD + 1))
+    response = client.post('/upload', input_stream=body, content_type='multipart/form-data; boundary=b',
+                           environ_base={'wsgi.input_terminated': True})
+    assert response.status_code == 413
+    assert body.tell() < len(body.getvalue())
+    assert temp_files(quota) == [] and stored(quota) == []
+
+
+def test_file_over_quota_within_form_overhead(quota, client):
+    """Точный размер файла проверяется в транзакции записи"""
+    assert upload(client, b'x' * 600, name='a.txt').status_code == 302
+    assert usage(quota) == 600
+    response = upload(client, b'y' * 600, name='b.txt')
+    assert response.status_code == 413
+    assert usage(quota) == 600
+    assert temp_files(quota) == [] and len(stored(quota)) == 1
+
+
+def test_upload_session_reserves_quota(quota, client):
+    response = client.post('/api/uploads', json={'filename': 'a.zip', 'size': 800})
+    assert response.status_code == 201
+    assert usage(quota) == 800
+    # Заявленный размер уже занят, даже если данные ещё не пришли
+    assert client.post('/api/uploads', json={'filename': 'b.zip', 'size': 300}).status_code == 413
+    # Отмена возвращает место
+    client.delete('/api/uploads/{0}'.format(response.get_json()['id']))
+    assert client.post('/api/uploads', json={'filename': 'b.zip', 'size': 300}).status_code == 201
+
+
+def test_too_many_concurrent_uploads(app, client, monkeypatch):
+    monkeypatch.setattr(oblako.upload_slots, 'limit', 0)
+    response = upload(client, b'data')
+    assert response.status_code == 429
+    assert int(response.headers['Retry-After']) >= 1
+    assert oblako.upload_slots.active() == 0
+
+
+def test_slot_is_released_after_upload(app, client, monkeypatch):
+    monkeypatch.setattr(oblako.upload_slots, 'limit', 1)
+    assert upload(client, b'one', name='a.txt').status_code == 302
+    assert upload(client, b'two', name='b.txt').status_code == 302
+    assert oblako.upload_slots.active() == 0
+
+
+@pytest.mark.skipif(not photometa.available(), reason='Pillow не установлен')
+def test_batch_rejects_photos_over_quota(quota, client):
+    """Из пакета отклоняются только фото, не поместившиеся в квоту"""
+    client.post('/album/new', data={'title': 'A'})
+    first, second = jpeg('red'), jpeg('blue')
+    size = len(first.getvalue())
+    quota.config['USER_QUOTA_BYTES'] = size + len(second.getvalue()) // 2
+    response = client.post('/album/1/add_photos', data={'photos': [(first, 'a.jpg'), (second, 'b.jpg')]},
+                           content_type='multipart/form-data')
+    results = response.get_json()['results']
+    assert [r['success'] for r in results] == [True, False]
+    assert 'квота' in results[1]['error']
+    assert usage(quota) == size
+    assert temp_files(quota) == []
@@ -0,0 +1,207 @@
+"""
+S3Backend поверх подставного клиента: запросы к хранилищу и разбор ошибок
+"""
+
+import datetime
+import io
+
+import pytest
+
+import storage
+
+exceptions = pytest.importorskip('botocore.exceptions')
+
+
+def client_error(code, operation):
+    return exceptions.ClientError({'Error': {'Code': code, 'Message': code}}, operation)
+
+
+class FakeBody(io.BytesIO):
+    """Тело ответа get_object"""
+
+
+class FakeClient:
+    """Бакет в памяти с тем же интерфейсом, что у клиента boto3"""
+
+    def __init__(self):
+        self.objects = {}
+        self.uploads = {}
+        self.calls = []
+        self.fail = {}
+
+    def _call(self, name, **params):
+        self.calls.append((name, params))
+        if name in self.fail:
+            raise self.fail[name]
+
+    def head_object(self, Bucket, Key):
+        self._call('head_object', Bucket=Bucket, Key=Key)
+        if Key not in self.objects:
+            raise client_error('404', 'HeadObject')
+        return {'ContentLength': len(self.objects[Key]),
+                'LastModified': datetime.datetime(2024, 1, 2, tzinfo=datetime.timezone.utc)}
+
+    def get_object(self, Bucket, Key, Range=None):
+        self._call('get_object', Bucket=Bucket, Key=Key, Range=Range)
+        if Key not in self.objects:
+            raise client_error('NoSuchKey', 'GetObject')
+        data = self.objects[Key]
+        if Range is not None:
+            data = data[:int(Range.rpartition('-')[2]) + 1]
+        return {'Body': FakeBody(data)}
+
+    def put_object(self, Bucket, Key, Body):
+        self._call('put_object', Bucket=Bucket, Key=Key)
+        self.objects[Key] = bytes(Body)
+
+    def create_multipart_upload(self, Bucket, Key):
+        self._call('create_multipart_upload', Bucket=Bucket, Key=Key)
+        upload_id = 'upload-{0}'.format(len(self.uploads) + 1)
+        self.uploads[upload_id] = {}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self._call('upload_part', Bucket=Bucket, Key=Key, PartNumber=PartNumber)
+        self.uploads[UploadId][PartNumber] = bytes(Body)
+        return {'ETag': '"etag-{0}"'.format(PartNumber)}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self._call('complete_multipart_upload', Bucket=Bucket, Key=Key)
+        parts = self.uploads.pop(UploadId)
+        self.objects[Key] = b''.join(parts[part['PartNumber']] for part in MultipartUpload['Parts'])
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self._call('abort_multipart_upload', Bucket=Bucket, Key=Key)
+        self.uploads.pop(UploadId)
+
+    def delete_object(self, Bucket, Key):
+        self._call('delete_object', Bucket=Bucket, Key=Key)
+        self.objects.pop(Key, None)
+
+    def get_paginator(self, name):
+        client = self
+
+        class Paginator:
+            def paginate(self, Bucket, Prefix):
+                keys = sorted(key for key in client.objects if key.startswith(Prefix))
+                # Две страницы, чтобы проверить обход всех
+                for page in (keys[:1], keys[1:]):
+                    yield {'Contents': [{'Key': key} for key in page]} if page else {}
+        return Paginator()
+
+    def generate_presigned_url(self, operation, Params, ExpiresIn):
+        self._call('generate_presigned_url', Params=Params, ExpiresIn=ExpiresIn)
+        return 'https://s3.example.com/{0}/{1}?expires={2}'.format(Params['Bucket'], Params['Key'], ExpiresIn)
+
+
+@pytest.fixture
+def client():
+    return FakeClient()
+
+
+@pytest.fixture
+def backend(client):
+    return storage.S3Backend('vault', prefix='/blobs/', part_size=8, client=client)
+
+
+def names(client):
+    return [name for name, _ in client.calls]
+
+
+def test_small_file_is_put_in_one_request(backend, client, tmp_path):
+    src = tmp_path / 'small'
+    src.write_bytes(b'1234567')
+    backend.put_file('ab/cd/abcd', str(src))
+    assert client.objects == {'blobs/ab/cd/abcd': b'1234567'}
+    assert names(client) == ['put_object']
+    # Исходный файл остаётся: его удаляет BlobStore
+    assert src.exists()
+
+
+def test_large_file_is_uploaded_in_parts(backend, client):
+    size = backend.put_stream('ab/cd/abcd', io.BytesIO(b'x' * 8 + b'y' * 8 + b'z' * 3))
+    assert size == 19
+    assert client.objects['blobs/ab/cd/abcd'] == b'x' * 8 + b'y' * 8 + b'z' * 3
+    assert names(client) == ['create_multipart_upload', 'upload_part', 'upload_part', 'upload_part',
+                             'complete_multipart_upload']
+
+
+def test_failed_part_aborts_upload(backend, client):
+    client.fail['upload_part'] = client_error('500', 'UploadPart')
+    with pytest.raises(exceptions.ClientError):
+        backend.put_stream('ab/cd/abcd', io.BytesIO(b'x' * 20))
+    assert names(client)[-1] == 'abort_multipart_upload'
+    assert client.uploads == {}
+    assert client.objects == {}
+
+
+def test_exists_and_stat(backend, client):
+    assert not backend.exists('ab/cd/abcd')
+    assert backend.stat('ab/cd/abcd') is None
+    client.objects['blobs/ab/cd/abcd'] = b'data'
+    assert backend.exists('ab/cd/abcd')
+    assert backend.stat('ab/cd/abcd') == (4, datetime.datetime(2024, 1, 2, tzinfo=datetime.timezone.utc).timestamp())
+
+
+def test_stat_reraises_other_errors(backend, client):
+    client.fail['head_object'] = client_error('403', 'HeadObject')
+    with pytest.raises(exceptions.ClientError):
+        backend.exists('ab/cd/abcd')
+
+
+def test_open_whole_object_and_range(backend, client):
+    client.objects['blobs/ab/cd/abcd'] = b'0123456789'
+    assert backend.open('ab/cd/abcd').read() == b'0123456789'
+    assert backend.open('ab/cd/abcd', 4).read() == b'0123'
+    assert client.calls[-1][1]['Range'] == 'bytes=0-3'
+
+
+def test_open_missing_object(backend, client):
+    with pytest.raises(FileNotFoundError):
+        backend.open('ab/cd/abcd')
+    client.fail['get_object'] = client_error('AccessDenied', 'GetObject')
+    with pytest.raises(exceptions.ClientError):
+        backend.open('ab/cd/abcd')
+
+
+def test_list_and_remove_blob_with_renditions(backend, client):
+    for key in ('ab/cd/abcd', 'ab/cd/abcd.thumb.jpg', 'ab/cd/abcd.preview.webp', 'ab/cd/abce'):
+        client.objects['blobs/' + key] = b'data'
+    assert sorted(backend.list('ab/cd/abcd')) == ['ab/cd/abcd', 'ab/cd/abcd.preview.webp',
+                                                  'ab/cd/abcd.thumb.jpg']
+
+    blobs = storage.BlobStore('/nonexistent', backend)
+    blobs.remove('abcd', renditions_only=True)
+    assert sorted(client.objects) == ['blobs/ab/cd/abcd', 'blobs/ab/cd/abce']
+    blobs.remove('abcd')
+    assert sorted(client.objects) == ['blobs/ab/cd/abce']
+
+
+def test_delete_error_propagates(backend, client):
+    """Ошибка удаления доходит до reaper: он повторит попытку позже"""
+    client.objects['blobs/ab/cd/abcd'] = b'data'
+    client.fail['delete_object'] = client_error('SlowDown', 'DeleteObject')
+    with pytest.raises(exceptions.ClientError):
+        storage.BlobStore('/nonexistent', backend).remove('abcd')
+    assert 'blobs/ab/cd/abcd' in client.objects
+
+
+def test_presigned_url_carries_download_name(backend, client):
+    url = backend.url('ab/cd/abcd', 'Отчёт.pdf')
+    assert url == 'https://s3.example.com/vault/blobs/ab/cd/abcd?expires=300'
+    params = client.calls[-1][1]['Params']
+    assert params['ResponseContentType'] == 'application/pdf'
+    assert params['ResponseContentDisposition'] == "inline; filename*=UTF-8''%D0%9E%D1%82%D1%87%D1%91%D1%82.pdf"
+
+
+def test_blob_store_reads_remote_object(backend, client, tmp_path):
+    client.objects['blobs/ab/cd/abcd'] = b'content'
+    blobs = storage.BlobStore(str(tmp_path), backend)
+    assert blobs.path('abcd') is None
+    with blobs.local_copy('abcd') as path:
+        with open(path, 'rb') as f:
+            assert f.read() == b'content'
+    assert not (tmp_path / 'tmp').exists() or not list((tmp_path / 'tmp').iterdir())
+    with pytest.raises(FileNotFoundError):
+        with blobs.local_copy('missing'):
+            pass
@@ -0,0 +1,230 @@
+"""
+Проверка хранилища (flask scrub): сироты, висячие записи, счётчики ссылок,
+продолжение с сохранённой позиции и сверка контрольных сумм
+"""
+
+import functools
+import hashlib
+import io
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import app as oblako
+import db
+import reaper
+import scrubber
+import storage
+from conftest import jpeg
+
+
+def upload(client, data, name='data.txt'):
+    response = client.post('/upload', data={'file': (io.BytesIO(data), name)}, content_type='multipart/form-data')
+    assert response.status_code == 302
+
+
+def scrub(app, repair=True, **kwargs):
+    """Полный проход; возвращает (счётчики, сообщения)"""
+    messages = []
+    kwargs.setdefault('min_age', 0)
+    with db.pooled_connection(app) as conn:
+        counts = scrubber.Scrubber(app, conn, repair=repair, out=messages.append,
+                                   on_file_removed=functools.partial(oblako.update_user_stats, delta=-1),
+                                   **kwargs).run()
+    return counts, messages
+
+
+def query(app, sql, params=()):
+    with db.pooled_connection(app) as conn:
+        return conn.execute(sql, params).fetchall()
+
+
+def blob_path(app, blob_hash):
+    return storage.get_blob_store(app).path(blob_hash)
+
+
+def make_old(path, age=2 * 3600):
+    stamp = time.time() - age
+    os.utime(path, (stamp, stamp))
+
+
+def write(path, data=b'data'):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
+
+
+@pytest.fixture
+def orphans(app, client):
+    """Файлы без записей: часть загрузки, старый файл, папка альбома и блоб"""
+    upload(client, b'kept')
+    blob_hash = hashlib.sha256(b'orphan').hexdigest()
+    return {
+        'part': write(os.path.join(app.config['UPLOAD_FOLDER'], 'abc.part')),
+        'legacy': write(os.path.join(app.config['UPLOAD_FOLDER'], 'old_report.txt')),
+        'album': os.path.dirname(write(os.path.join(app.config['ALBUMS_FOLDER'], '42', 'p.jpg'))),
+        'blob': write(blob_path(app, blob_hash), b'orphan'),
+    }
+
+
+def test_recent_orphans_are_left_alone(app, orphans):
+    """Файлы моложе min_age могут принадлежать идущей загрузке"""
+    counts, _ = scrub(app, min_age=3600)
+    assert counts['orphans'] == 0
+    assert query(app, 'SELECT COUNT(*) FROM pending_deletions')[0][0] == 0
+
+
+def test_old_orphans_are_queued_for_deletion(app, orphans):
+    for path in orphans.values():
+        make_old(path)
+    counts, messages = scrub(app, min_age=3600)
+    assert counts['orphans'] == 4
+    assert counts['repaired'] == 4
+    queued = query(app, 'SELECT blob_hash, path FROM pending_deletions')
+    assert sorted(path for _, path in queued if path) == sorted(
+        [orphans['part'], orphans['legacy'], orphans['album']])
+    assert [blob_hash for blob_hash, _ in queued if blob_hash] == [os.path.basename(orphans['blob'])]
+    # Файлы удаляет reaper, а не проверка
+    assert all(os.path.exists(path) for path in orphans.values())
+    reaper.reap(app, 10)
+    assert not any(os.path.exists(path) for path in orphans.values())
+    # Содержимое с записью не тронуто
+    assert query(app, 'SELECT COUNT(*) FROM files')[0][0] == 1
+    assert os.path.exists(blob_path(app, query(app, 'SELECT blob_hash FROM files')[0][0]))
+
+
+def test_report_only_changes_nothing(app, orphans):
+    for path in orphans.values():
+        make_old(path)
+    counts, _ = scrub(app, repair=False)
+    assert counts['orphans'] == 4 and counts['repaired'] == 0
+    assert query(app, 'SELECT COUNT(*) FROM pending_deletions')[0][0] == 0
+
+
+def test_dangling_file_is_removed_with_stats(app, client):
+    upload(client, b'first', name='a.txt')
+    upload(client, b'second', name='b.txt')
+    lost = query(app, "SELECT blob_hash FROM files WHERE original_name = 'a.txt'")[0][0]
+    os.remove(blob_path(app, lost))
+
+    counts, messages = scrub(app)
+    assert counts['dangling'] == 1 and counts['repaired'] == 1
+    assert [row[0] for row in query(app, 'SELECT original_name FROM files')] == ['b.txt']
+    assert query(app, 'SELECT files_count, docs_count, total_bytes FROM user_stats WHERE user_id = 1') == \
+        [(1, 1, len(b'second'))]
+    assert query(app, 'SELECT COUNT(*) FROM blobs WHERE hash = ?', (lost,))[0][0] == 0
+
+
+def test_dangling_photo_updates_album(app, client):
+    client.post('/album/new', data={'title': 'A'})
+    for color in ('red', 'blue'):
+        client.post('/album/1/add_photo', data={'photo': (jpeg(color), color + '.jpg')},
+                    content_type='multipart/form-data')
+    cover = query(app, 'SELECT filename, blob_hash FROM photos ORDER BY id')[0]
+    os.remove(blob_path(app, cover[1]))
+
+    counts, _ = scrub(app)
+    assert counts['dangling'] == 1
+    remaining = query(app, 'SELECT filename, file_size FROM photos')
+    assert len(remaining) == 1
+    # Обложкой становится оставшееся фото, счётчик и объём пересчитаны триггером
+    assert query(app, 'SELECT photo_count, total_bytes, cover_photo FROM albums') == \
+        [(1, remaining[0][1], remaining[0][0])]
+    with db.pooled_connection(app) as conn:
+        assert oblako.find_inconsistent_albums(conn) == []
+
+
+def test_refcount_is_repaired(app, client):
+    upload(client, b'same', name='a.txt')
+    upload(client, b'same', name='b.txt')
+    blob_hash = query(app, 'SELECT blob_hash FROM files')[0][0]
+    with db.pooled_connection(app) as conn:
+        conn.execute('UPDATE blobs SET refcount = 5 WHERE hash = ?', (blob_hash,))
+        conn.commit()
+
+    counts, messages = scrub(app)
+    assert counts['refcount'] == 1
+    assert query(app, 'SELECT refcount FROM blobs WHERE hash = ?', (blob_hash,)) == [(2,)]
+
+
+def test_missing_blob_row_is_restored(app, client):
+    upload(client, b'content')
+    blob_hash = query(app, 'SELECT blob_hash FROM files')[0][0]
+    with db.pooled_connection(app) as conn:
+        conn.execute('DELETE FROM blobs WHERE hash = ?', (blob_hash,))
+        conn.commit()
+
+    counts, _ = scrub(app)
+    assert counts['refcount'] == 1
+    assert query(app, 'SELECT size, refcount FROM blobs WHERE hash = ?', (blob_hash,)) == [(len(b'content'), 1)]
+
+
+def test_interrupted_run_resumes_from_checkpoint(app, client):
+    for number in range(3):
+        upload(client, 'file {0}'.format(number).encode(), name='f{0}.txt'.format(number))
+    for (blob_hash,) in query(app, 'SELECT blob_hash FROM files'):
+        os.remove(blob_path(app, blob_hash))
+
+    def stop_at_second(message):
+        if 'files.id=2' in message:
+            raise KeyboardInterrupt()
+
+    with pytest.raises(KeyboardInterrupt):
+        with db.pooled_connection(app) as conn:
+            scrubber.Scrubber(app, conn, repair=True, batch_size=1, min_age=0, out=stop_at_second).run()
+    # Первый пакет зафиксирован вместе с позицией
+    assert [row[0] for row in query(app, 'SELECT id FROM files ORDER BY id')] == [2, 3]
+    assert dict(query(app, 'SELECT phase, position FROM scrub_checkpoints'))['files'] == '{"last_id": 1}'
+
+    counts, messages = scrub(app, batch_size=1)
+    assert counts['dangling'] == 2
+    assert [m.split()[3] for m in messages if 'files.id' in m] == ['files.id=2', 'files.id=3']
+    assert query(app, 'SELECT COUNT(*) FROM files')[0][0] == 0
+    # Завершённый проход сбрасывает позиции
+    assert query(app, 'SELECT COUNT(*) FROM scrub_checkpoints')[0][0] == 0
+
+
+def test_finished_phases_are_skipped(app, client):
+    upload(client, b'content')
+    os.remove(blob_path(app, query(app, 'SELECT blob_hash FROM files')[0][0]))
+    with db.pooled_connection(app) as conn:
+        for phase in scrubber.PHASES:
+            scrubber.save_checkpoint(conn, phase, {'done': True})
+        conn.commit()
+    counts, _ = scrub(app)
+    assert counts['dangling'] == 0
+    assert query(app, 'SELECT COUNT(*) FROM files')[0][0] == 1
+
+
+def test_verify_detects_corrupt_content(app, client):
+    upload(client, b'original')
+    blob_hash = query(app, 'SELECT blob_hash FROM files')[0][0]
+    write(blob_path(app, blob_hash), b'changed')
+
+    counts, _ = scrub(app, repair=False)
+    assert counts['corrupt'] == 0
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        counts, messages = scrub(app, repair=False, pool=pool)
+    assert counts['corrupt'] == 1
+    assert any(blob_path(app, blob_hash) in m for m in messages)
+
+
+def test_cli_verify_uses_start_method(app, client, monkeypatch):
+    """Пул сверки сумм запускается не через fork"""
+    upload(client, b'original')
+    write(blob_path(app, query(app, 'SELECT blob_hash FROM files')[0][0]), b'changed')
+    contexts = []
+
+    class RecordingPool(ThreadPoolExecutor):
+        def __init__(self, max_workers=None, mp_context=None):
+            contexts.append(mp_context.get_start_method())
+            super().__init__(max_workers=max_workers or 2)
+
+    monkeypatch.setattr(oblako, 'ProcessPoolExecutor', RecordingPool)
+    result = app.test_cli_runner().invoke(args=['scrub', '--verify', '--min-age', '0'])
+    assert result.exit_code == 0, result.output
+    assert 'повреждено: 1' in result.output
+    assert contexts == [app.config['PROCESS_START_METHOD']]
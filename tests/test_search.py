@@ -0,0 +1,116 @@
+"""
+Полнотекстовый поиск: синхронизация индекса триггерами, владелец, ё/е,
+префиксы, страницы через границу окна ранжирования и подсветка
+"""
+
+import pytest
+
+import db
+import search
+from conftest import register
+
+
+def add_file(app, name, user_id=1):
+    with db.pooled_connection(app) as conn:
+        file_id = conn.execute('''
+            INSERT INTO files (user_id, filename, original_name, file_type, file_size)
+            VALUES (?, ?, ?, 'pdf', 1)
+        ''', (user_id, 'stored_{0}_{1}'.format(user_id, name), name)).lastrowid
+        conn.commit()
+    return file_id
+
+
+def execute(app, sql, params=()):
+    with db.pooled_connection(app) as conn:
+        conn.execute(sql, params)
+        conn.commit()
+
+
+def find(client, text, **params):
+    response = client.get('/api/search', query_string=dict(params, q=text))
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def names(client, text):
+    return sorted(str(item['name']).replace('<mark>', '').replace('</mark>', '')
+                  for item in find(client, text)['results'])
+
+
+def test_triggers_keep_index_in_sync(app, client):
+    file_id = add_file(app, 'budget.pdf')
+    client.post('/album/new', data={'title': 'Отпуск', 'description': 'море и горы'})
+    assert names(client, 'budget') == ['budget.pdf']
+    assert names(client, 'горы') == ['Отпуск']
+
+    execute(app, "UPDATE files SET original_name = 'forecast.pdf' WHERE id = ?", (file_id,))
+    execute(app, "UPDATE albums SET description = 'лес' WHERE id = 1")
+    assert names(client, 'budget') == []
+    assert names(client, 'forecast') == ['forecast.pdf']
+    assert names(client, 'горы') == []
+    assert names(client, 'лес') == ['Отпуск']
+
+    execute(app, 'DELETE FROM files WHERE id = ?', (file_id,))
+    execute(app, 'DELETE FROM albums WHERE id = 1')
+    assert names(client, 'forecast') == [] and names(client, 'лес') == []
+    with db.pooled_connection(app) as conn:
+        assert conn.execute('SELECT COUNT(*) FROM search_index').fetchone()[0] == 0
+
+
+def test_results_are_limited_to_owner(app, client):
+    add_file(app, 'report.pdf')
+    other = register(app.test_client(), 'bob')
+    add_file(app, 'report-bob.pdf', user_id=2)
+    assert names(client, 'report') == ['report.pdf']
+    assert names(other, 'report') == ['report-bob.pdf']
+
+
+def test_yo_and_prefix(app, client):
+    add_file(app, 'Отчёт за май.pdf')
+    add_file(app, 'отчетность.xlsx')
+    assert names(client, 'отчет') == ['Отчёт за май.pdf', 'отчетность.xlsx']
+    assert names(client, 'ОТЧЁТ') == ['Отчёт за май.pdf', 'отчетность.xlsx']
+    assert names(client, 'отч') == ['Отчёт за май.pdf', 'отчетность.xlsx']
+    # Все слова запроса должны найтись
+    assert names(client, 'отчет май') == ['Отчёт за май.pdf']
+    assert names(client, 'чет') == []
+
+
+def test_query_operators_are_not_passed_to_fts(app, client):
+    add_file(app, 'report.pdf')
+    assert names(client, 'report OR owner:u2 "') == []
+    assert names(client, '"report" *') == ['report.pdf']
+
+
+@pytest.mark.parametrize('limit', [1, 2, 3, 5])
+def test_pages_across_rank_window(app, client, monkeypatch, limit):
+    """Совпадения в окне bm25 и за ним выдаются без пропусков и повторов"""
+    monkeypatch.setattr(search, 'RANK_WINDOW', 4)
+    # Разная релевантность: повтор слова в имени повышает оценку
+    ids = [add_file(app, 'plan {0} {1}.pdf'.format(number, 'plan ' * (number % 3))) for number in range(11)]
+    seen, cursor, pages = [], None, 0
+    while True:
+        data = find(client, 'plan', limit=limit, cursor=cursor or '')
+        seen.extend(item['id'] for item in data['results'])
+        pages += 1
+        cursor = data['next_cursor']
+        if cursor is None:
+            break
+    assert sorted(seen) == ids
+    assert len(seen) == len(set(seen))
+    assert pages == -(-len(ids) // limit)
+    # Старые совпадения за окном идут после ранжированных, от новых к старым
+    assert seen[4:] == sorted(ids[:7], reverse=True)
+
+
+def test_highlight_escapes_html(app, client):
+    add_file(app, '<script>alert(1)</script> report.pdf')
+    name = find(client, 'report')['results'][0]['name']
+    assert '<script>' not in name
+    assert '&lt;script&gt;' in name
+    assert '<mark>report</mark>' in name
+
+
+def test_highlight_marks_prefixes():
+    assert search.highlight('Отчёт <b>.pdf', ['отчет']) == '<mark>Отчёт</mark> &lt;b&gt;.pdf'
+    assert search.highlight(None, ['x']) == ''
@@ -0,0 +1,87 @@
+"""
+Статистика хранилища (user_stats): загрузка, загрузка по частям, удаление
+и пересчёт командой repair-stats
+"""
+
+import io
+
+import db
+from conftest import register
+
+COLUMNS = 'files_count, images_count, docs_count, archives_count, total_bytes'
+
+
+def stats(app, user_id=1):
+    with db.pooled_connection(app) as conn:
+        return conn.execute('SELECT {0} FROM user_stats WHERE user_id = ?'.format(COLUMNS), (user_id,)).fetchone()
+
+
+def upload(client, data, name):
+    response = client.post('/upload', data={'file': (io.BytesIO(data), name)}, content_type='multipart/form-data')
+    assert response.status_code == 302
+
+
+def file_id(app, name):
+    with db.pooled_connection(app) as conn:
+        return conn.execute('SELECT id FROM files WHERE original_name = ?', (name,)).fetchone()[0]
+
+
+def test_upload_and_delete(app, client):
+    # Содержимое не разбирается: тип файла определяется по расширению
+    photo = b'image bytes'
+    upload(client, photo, 'photo.jpg')
+    upload(client, b'report', 'report.pdf')
+    upload(client, b'PK archive', 'data.zip')
+    assert stats(app) == (3, 1, 1, 1, len(photo) + len(b'report') + len(b'PK archive'))
+
+    # Одинаковое содержимое хранится один раз, но в статистике учитывается каждый файл
+    upload(client, b'report', 'copy.pdf')
+    assert stats(app) == (4, 1, 2, 1, len(photo) + 2 * len(b'report') + len(b'PK archive'))
+
+    client.get('/delete/file/{0}'.format(file_id(app, 'photo.jpg')))
+    client.get('/delete/file/{0}'.format(file_id(app, 'report.pdf')))
+    assert stats(app) == (2, 0, 1, 1, len(b'report') + len(b'PK archive'))
+    client.get('/delete/file/{0}'.format(file_id(app, 'copy.pdf')))
+    client.get('/delete/file/{0}'.format(file_id(app, 'data.zip')))
+    assert stats(app) == (0, 0, 0, 0, 0)
+
+
+def test_rejected_upload_changes_nothing(app, client):
+    upload(client, b'report', 'report.pdf')
+    app.config['USER_QUOTA_BYTES'] = len(b'report') + 5
+    response = client.post('/upload', data={'file': (io.BytesIO(b'too large'), 'big.pdf')},
+                           content_type='multipart/form-data')
+    assert response.status_code == 413
+    assert stats(app) == (1, 0, 1, 0, len(b'report'))
+
+
+def test_chunked_upload(app, client):
+    data = b'chunked archive data'
+    session_id = client.post('/api/uploads', json={'filename': 'big.zip', 'size': len(data)}).get_json()['id']
+    assert client.put('/api/uploads/{0}?offset=0'.format(session_id), data=data[:8]).status_code == 200
+    assert client.put('/api/uploads/{0}?offset=8'.format(session_id), data=data[8:]).status_code == 200
+    # Незавершённая загрузка в статистику не попадает
+    assert stats(app) is None
+    assert client.post('/api/uploads/{0}/complete'.format(session_id)).status_code == 200
+    assert stats(app) == (1, 0, 0, 1, len(data))
+
+
+def test_repair_stats_command(app, client):
+    upload(client, b'report', 'report.pdf')
+    upload(client, b'PK archive', 'data.zip')
+    other = register(app.test_client(), 'bob')
+    upload(other, b'notes', 'notes.txt')
+    expected = stats(app), stats(app, 2)
+
+    with db.pooled_connection(app) as conn:
+        conn.execute('UPDATE user_stats SET files_count = 10, docs_count = 0, total_bytes = 1 WHERE user_id = 1')
+        conn.execute('DELETE FROM user_stats WHERE user_id = 2')
+        conn.commit()
+    result = app.test_cli_runner().invoke(args=['repair-stats'])
+    assert result.exit_code == 0, result.output
+    assert 'Статистика пересчитана для пользователей: 2' in result.output
+    assert (stats(app), stats(app, 2)) == expected
+
+    # Страница файлов показывает пересчитанные значения
+    page = client.get('/dashboard').get_data(as_text=True)
+    assert 'report.pdf' in page and 'data.zip' in page
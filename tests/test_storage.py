@@ -0,0 +1,213 @@
+"""
+Счётчики ссылок на блобы и очередь удаления (reaper): обращения к
+хранилищу не должны идти под блокировкой записи SQLite, а загрузка во время
+удаления того же содержимого не должна оставить запись без объекта
+"""
+
+import hashlib
+import io
+import os
+import sqlite3
+
+import pytest
+
+import db
+import reaper
+import storage
+import thumbnails
+
+CONTENT = b'hello, blobs\n'
+CONTENT_HASH = hashlib.sha256(CONTENT).hexdigest()
+
+
+class ProbeBackend(storage.LocalBackend):
+    """Локальный бэкенд, проверяющий, что обращения идут не под блокировкой записи
+
+    Для локального диска проверка наличия и перенос файла в add_ref
+    допустимы (это stat и rename), удаление - нет.
+    """
+
+    def __init__(self, root, database, remote=False):
+        super().__init__(root)
+        self.database = database
+        self.remote = remote
+        self.calls = []
+        self.on_delete = None
+        self.check_lock = True
+
+    def _probe(self, name, key, network=True):
+        self.calls.append((name, key))
+        if not self.check_lock or not network:
+            return
+        conn = sqlite3.connect(self.database, timeout=0)
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.rollback()
+        finally:
+            conn.close()
+
+    def exists(self, key):
+        self._probe('exists', key, network=self.remote)
+        return super().exists(key)
+
+    def put_file(self, key, src_path):
+        self._probe('put_file', key, network=self.remote)
+        super().put_file(key, src_path)
+
+    def delete(self, key):
+        self._probe('delete', key)
+        if self.on_delete is not None:
+            self.on_delete(key)
+        super().delete(key)
+
+
+@pytest.fixture(params=[False, True], ids=['local', 'remote'])
+def backend(request, app):
+    probe = ProbeBackend(app.config['BLOBS_FOLDER'], app.config['DATABASE'], remote=request.param)
+    app.config['STORAGE_BACKEND'] = 'probe'
+    app.extensions['oblako.storage'] = probe
+    return probe
+
+
+def upload(client, content=CONTENT, name='notes.txt'):
+    return client.post('/upload', data={'file': (io.BytesIO(content), name)},
+                       content_type='multipart/form-data')
+
+
+def query(app, sql, params=()):
+    with db.pooled_connection(app) as conn:
+        return conn.execute(sql, params).fetchall()
+
+
+def blob_exists(app, blob_hash=CONTENT_HASH):
+    return os.path.isfile(os.path.join(app.config['BLOBS_FOLDER'], *storage.shard_key(blob_hash).split('/')))
+
+
+def delete_all_files(client, app):
+    for (file_id,) in query(app, 'SELECT id FROM files'):
+        assert client.get('/delete/file/{0}'.format(file_id)).status_code == 302
+
+
+def test_upload_and_reap_outside_transaction(app, client, backend):
+    assert upload(client).status_code == 302
+    assert blob_exists(app)
+    assert query(app, 'SELECT refcount FROM blobs') == [(1,)]
+
+    delete_all_files(client, app)
+    assert query(app, 'SELECT blob_hash FROM pending_deletions') == [(CONTENT_HASH,)]
+    assert reaper.reap(app, 10) == 1
+    assert not blob_exists(app)
+    assert query(app, 'SELECT COUNT(*) FROM pending_deletions') == [(0,)]
+    assert ('delete', storage.shard_key(CONTENT_HASH)) in backend.calls
+
+
+def test_remote_add_ref_trusts_stage(app, client, backend):
+    if not backend.remote:
+        pytest.skip('только для удалённого хранилища')
+    assert upload(client).status_code == 302
+    # Одна проверка и одна выгрузка - в stage; в транзакции хранилище не опрашивается
+    assert [name for name, _ in backend.calls] == ['exists', 'put_file']
+    backend.calls.clear()
+    assert upload(client, name='copy.txt').status_code == 302
+    assert [name for name, _ in backend.calls] == ['exists']
+    assert query(app, 'SELECT refcount FROM blobs') == [(2,)]
+
+
+def test_reused_blob_is_not_deleted(app, client, backend):
+    upload(client)
+    delete_all_files(client, app)
+    upload(client)
+    assert reaper.reap(app, 10) == 1
+    assert blob_exists(app)
+    assert query(app, 'SELECT COUNT(*) FROM pending_deletions') == [(0,)]
+    assert query(app, 'SELECT refcount FROM blobs') == [(1,)]
+
+
+def test_upload_during_deletion_is_refused(app, client, backend):
+    upload(client)
+    delete_all_files(client, app)
+    statuses = []
+    # Та же загрузка, пока reaper удаляет блоб вне транзакции
+    backend.on_delete = lambda key: statuses.append(upload(client))
+    reaper.reap(app, 10)
+    backend.on_delete = None
+
+    response = statuses[0]
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '5'
+    assert query(app, 'SELECT COUNT(*) FROM blobs') == [(0,)]
+    assert query(app, 'SELECT COUNT(*) FROM files') == [(0,)]
+    assert not blob_exists(app)
+
+    # После удаления та же загрузка проходит и объект снова на месте
+    assert upload(client).status_code == 302
+    assert blob_exists(app)
+
+
+def test_stale_stage_is_rechecked(app, backend):
+    """Блоб удалён целиком между stage и add_ref: add_ref выгружает его заново"""
+    blobs = storage.get_blob_store(app)
+    os.makedirs(blobs.tmp_dir, exist_ok=True)
+    backend.put_file(storage.shard_key(CONTENT_HASH), _temp(blobs))
+    with db.pooled_connection(app) as conn:
+        reaper.enqueue_blob(conn, CONTENT_HASH)
+        conn.commit()
+        tmp_path = _temp(blobs)
+        blobs.stage(conn, tmp_path, CONTENT_HASH)
+        reaper.reap(app, 10)
+        assert not blob_exists(app)
+
+        # Единственный случай, когда хранилище опрашивается под блокировкой
+        backend.check_lock = False
+        backend.calls.clear()
+        conn.execute('BEGIN IMMEDIATE')
+        blobs.add_ref(conn, tmp_path, CONTENT_HASH, len(CONTENT))
+        conn.commit()
+    assert [name for name, _ in backend.calls] == ['exists', 'put_file']
+    assert blob_exists(app)
+    assert not os.path.exists(tmp_path)
+
+
+def test_abandoned_claim_is_taken_again(app, client, backend):
+    upload(client)
+    delete_all_files(client, app)
+    with db.pooled_connection(app) as conn:
+        conn.execute("UPDATE pending_deletions SET claimed_at = datetime('now', '-1 hour')")
+        conn.commit()
+    app.config['REAPER_CLAIM_TIMEOUT'] = 7200
+    assert reaper.reap(app, 10) == 0
+    app.config['REAPER_CLAIM_TIMEOUT'] = 600
+    assert reaper.reap(app, 10) == 1
+    assert not blob_exists(app)
+
+
+def test_failed_deletion_is_retried(app, client, backend):
+    upload(client)
+    delete_all_files(client, app)
+
+    def fail(key):
+        raise OSError('хранилище недоступно')
+    backend.on_delete = fail
+    assert reaper.reap(app, 10) == 1
+    assert query(app, 'SELECT attempts, claimed_at IS NULL, last_error FROM pending_deletions') == \
+        [(1, 1, 'хранилище недоступно')]
+    assert blob_exists(app)
+
+
+def test_thumbnails_of_deleted_blob_are_queued(app, backend):
+    """Миниатюры для уже удалённого блоба убирает reaper, а не generate под блокировкой"""
+    blobs = storage.get_blob_store(app)
+    key = blobs.rendition_key(CONTENT_HASH, thumbnails.THUMB)
+    os.makedirs(blobs.tmp_dir, exist_ok=True)
+    backend.put_file(key, _temp(blobs))
+    thumbnails.generate(app, CONTENT_HASH)
+    assert query(app, 'SELECT blob_hash FROM pending_deletions') == [(CONTENT_HASH,)]
+    reaper.reap(app, 10)
+    assert not backend.exists(key)
+
+
+def _temp(blobs):
+    tmp_path = blobs.temp_path()
+    with open(tmp_path, 'wb') as f:
+        f.write(CONTENT)
+    return tmp_path
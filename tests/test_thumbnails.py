@@ -0,0 +1,44 @@
+"""
+Очередь миниатюр: задачи, прерванные остановкой процесса, возобновляются при запуске
+"""
+
+import io
+
+import pytest
+
+import db
+import thumbnails
+from app import IMAGE_EXTENSIONS
+from conftest import jpeg
+
+pytestmark = pytest.mark.skipif(not thumbnails.available(), reason='Pillow не установлен')
+
+
+def statuses(app):
+    with db.pooled_connection(app) as conn:
+        return dict(conn.execute('SELECT b.hash, b.thumb_status FROM blobs b'))
+
+
+def test_resume_after_restart(app, client):
+    client.post('/upload', data={'file': (jpeg('red'), 'red.jpg')}, content_type='multipart/form-data')
+    client.post('/upload', data={'file': (jpeg('blue'), 'blue.jpg')}, content_type='multipart/form-data')
+    client.post('/upload', data={'file': (io.BytesIO(b'text'), 'notes.txt')}, content_type='multipart/form-data')
+    thumbnails.get_executor(app).shutdown(wait=True)
+    thumbnails._executor = None
+    assert sorted(statuses(app).values(), key=str) == [None, 'ready', 'ready']
+
+    # Процесс остановился: одна задача осталась в очереди, другая не успела в неё попасть
+    red, blue = [h for h, status in statuses(app).items() if status == 'ready']
+    with db.pooled_connection(app) as conn:
+        conn.execute("UPDATE blobs SET thumb_status = 'pending' WHERE hash = ?", (red,))
+        conn.execute('UPDATE blobs SET thumb_status = NULL WHERE hash = ?', (blue,))
+        conn.commit()
+
+    assert thumbnails.resume(app, IMAGE_EXTENSIONS) == 2
+    thumbnails.get_executor(app).shutdown(wait=True)
+    thumbnails._executor = None
+    result = statuses(app)
+    assert result[red] == result[blue] == 'ready'
+    # Текстовый файл миниатюр не получает
+    assert sorted(result.values(), key=str) == [None, 'ready', 'ready']
+    assert thumbnails.resume(app, IMAGE_EXTENSIONS) == 0
@@ -0,0 +1,117 @@
+"""
+Загрузка по частям: смещения, дозагрузка и проверка содержимого
+"""
+
+import hashlib
+import io
+
+import pytest
+
+import db
+import storage
+
+
+def start(client, size, filename='data.zip'):
+    response = client.post('/api/uploads', json={'filename': filename, 'size': size})
+    assert response.status_code == 201
+    return response.get_json()['id']
+
+
+def put(client, session_id, offset, data, **kwargs):
+    return client.put('/api/uploads/{0}?offset={1}'.format(session_id, offset), data=data, **kwargs)
+
+
+class ConcurrentStream(io.BytesIO):
+    """Тело части, во время чтения которого та же часть приходит повторно"""
+
+    def __init__(self, data, on_read):
+        super().__init__(data)
+        self.on_read = on_read
+        self.responses = []
+
+    def read(self, size=-1):
+        if self.on_read is not None:
+            on_read, self.on_read = self.on_read, None
+            self.responses.append(on_read())
+        return super().read(size)
+
+
+def test_concurrent_chunk_is_rejected(app, client):
+    session_id = start(client, 8)
+    stream = ConcurrentStream(b'aaaa', lambda: put(client, session_id, 0, b'bbbb'))
+    response = put(client, session_id, 0, None, input_stream=stream, headers={'Content-Length': '4'})
+    assert response.get_json()['offset'] == 4
+    # Второй запрос не перемешал данные с первым
+    assert [r.status_code for r in stream.responses] == [409]
+    assert stream.responses[0].get_json()['offset'] == 0
+
+    assert put(client, session_id, 4, b'cccc').get_json()['offset'] == 8
+    response = client.post('/api/uploads/{0}/complete'.format(session_id))
+    assert response.get_json()['file']['checksum'] == hashlib.sha256(b'aaaacccc').hexdigest()
+
+
+def test_abandoned_chunk_can_be_resent(app, client):
+    """Часть, которую упавший процесс так и не дописал, можно прислать заново"""
+    session_id = start(client, 4)
+    with db.pooled_connection(app) as conn:
+        conn.execute('''
+            UPDATE upload_sessions SET writer = 'dead', updated_at = datetime('now', '-2 hours') WHERE id = ?
+        ''', (session_id,))
+        conn.commit()
+    assert put(client, session_id, 0, b'dddd').get_json()['offset'] == 4
+
+
+def test_resume_after_interrupted_chunk(app, client, monkeypatch):
+    """После обрыва клиент узнаёт смещение и досылает остаток"""
+    session_id = start(client, 12)
+    assert put(client, session_id, 0, b'0123').get_json()['offset'] == 4
+
+    real_copy = storage.copy_stream
+
+    def interrupted(src, dst, hasher):
+        # Соединение обрывается, успев передать два байта
+        real_copy(io.BytesIO(src.read(2)), dst, hasher)
+        raise OSError('connection reset')
+
+    with monkeypatch.context() as patch:
+        patch.setattr(storage, 'copy_stream', interrupted)
+        with pytest.raises(OSError):
+            put(client, session_id, 4, b'4567')
+
+    assert client.get('/api/uploads/{0}'.format(session_id)).get_json()['offset'] == 6
+    response = put(client, session_id, 4, b'4567')
+    assert response.status_code == 409
+    assert response.get_json()['offset'] == 6
+    assert put(client, session_id, 6, b'6789ab').get_json()['offset'] == 12
+
+    # Хеш, накопленный по частям, учитывает и байты оборванного запроса
+    response = client.post('/api/uploads/{0}/complete'.format(session_id),
+                           json={'checksum': hashlib.sha256(b'0123456789ab').hexdigest()})
+    assert response.status_code == 200
+
+
+def test_complete_requires_all_data(app, client):
+    session_id = start(client, 8)
+    put(client, session_id, 0, b'0123')
+    response = client.post('/api/uploads/{0}/complete'.format(session_id))
+    assert response.status_code == 409
+    assert response.get_json()['offset'] == 4
+
+
+def test_checksum_mismatch(app, client):
+    session_id = start(client, 4)
+    put(client, session_id, 0, b'0123')
+    response = client.post('/api/uploads/{0}/complete'.format(session_id), json={'checksum': '0' * 64})
+    assert response.status_code == 422
+    assert response.get_json()['checksum'] == hashlib.sha256(b'0123').hexdigest()
+    # Сессия остаётся: файл можно отменить или проверить ещё раз
+    assert client.get('/api/uploads/{0}'.format(session_id)).status_code == 200
+
+
+def test_more_data_than_declared(app, client):
+    session_id = start(client, 4)
+    response = put(client, session_id, 0, b'012345')
+    assert response.status_code == 400
+    assert response.get_json()['offset'] == 4
+    response = client.post('/api/uploads/{0}/complete'.format(session_id))
+    assert response.get_json()['file']['checksum'] == hashlib.sha256(b'0123').hexdigest()
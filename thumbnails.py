@@ -0,0 +1,142 @@
+"""
+Фоновая генерация миниатюр и превью изображений
+Миниатюра (JPEG фиксированного размера) и превью (WebP) хранятся рядом
+с блобом, под ключами <блоб>.<имя>
+"""
+
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import db
+import reaper
+import storage
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow не установлен - используются оригиналы
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+THUMB_SIZE = (320, 320)
+PREVIEW_SIZE = (1280, 1280)
+
+# Имена производных файлов: <блоб>.<имя>
+THUMB = 'thumb.jpg'
+PREVIEW = 'preview.webp'
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def available():
+    """Можно ли создавать миниатюры (установлен ли Pillow)"""
+    return Image is not None
+
+
+def get_executor(app):
+    """Общий пул потоков для задач генерации"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=app.config['THUMBNAIL_WORKERS'],
+                                           thread_name_prefix='thumbnails')
+    return _executor
+
+
+def render(src_path, thumb_path, preview_path):
+    """Создание миниатюры и превью для одного изображения
+
+    Пишется во временные файлы: в хранилище они попадают готовыми
+    (BlobStore.put_rendition), клиент не получит недописанный файл.
+    """
+    with Image.open(src_path) as image:
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+
+        thumb = ImageOps.fit(image, THUMB_SIZE, Image.LANCZOS)
+        thumb.convert('RGB').save(thumb_path, 'JPEG', quality=82, optimize=True)
+
+        preview = image.copy()
+        preview.thumbnail(PREVIEW_SIZE, Image.LANCZOS)
+        preview.save(preview_path, 'WEBP', quality=80, method=4)
+
+
+def generate(app, blob_hash):
+    """Задача пула: миниатюры для блоба и отметка о готовности в базе"""
+    blobs = storage.get_blob_store(app)
+    try:
+        thumb_path, preview_path = blobs.temp_path(), blobs.temp_path()
+        try:
+            with blobs.local_copy(blob_hash) as src_path:
+                render(src_path, thumb_path, preview_path)
+            blobs.put_rendition(blob_hash, THUMB, thumb_path)
+            blobs.put_rendition(blob_hash, PREVIEW, preview_path)
+        finally:
+            blobs.discard_temp(thumb_path)
+            blobs.discard_temp(preview_path)
+        status = 'ready'
+    except Exception:
+        logger.exception('Не удалось создать миниатюры для %s', blob_hash)
+        status = 'failed'
+
+    with db.pooled_connection(app) as conn:
+        conn.execute('BEGIN IMMEDIATE')
+        cursor = conn.execute('UPDATE blobs SET thumb_status = ? WHERE hash = ?', (status, blob_hash))
+        deleted = cursor.rowcount == 0
+        if deleted:
+            # Блоб удалили, пока создавались миниатюры - они больше не нужны.
+            # Удаляет их reaper, вне транзакции; если блоб успеют загрузить
+            # заново, запись из очереди просто отбросится
+            reaper.enqueue_blob(conn, blob_hash)
+        conn.commit()
+    if deleted:
+        reaper.wake(app)
+    return status
+
+
+def resume(app, image_types):
+    """Постановка в очередь миниатюр, не созданных до остановки процесса
+
+    'pending' остаётся у блобов, задачи которых были в пуле при остановке,
+    NULL - у изображений, не успевших попасть в очередь после коммита.
+    Вызывается при запуске; если процессов несколько, блоб может быть
+    обработан дважды - результат тот же. Возвращает число блобов.
+    """
+    if not available():
+        return 0
+    placeholders = ', '.join('?' * len(image_types))
+    with db.pooled_connection(app) as conn:
+        conn.execute('BEGIN IMMEDIATE')
+        rows = conn.execute('''
+            SELECT hash FROM blobs WHERE thumb_status = 'pending' OR (thumb_status IS NULL AND hash IN (
+                SELECT blob_hash FROM files WHERE file_type IN ({0})
+                UNION SELECT blob_hash FROM photos
+            ))
+        '''.format(placeholders), tuple(image_types)).fetchall()
+        conn.executemany("UPDATE blobs SET thumb_status = 'pending' WHERE hash = ?", rows)
+        conn.commit()
+    executor = get_executor(app)
+    for (blob_hash,) in rows:
+        executor.submit(generate, app, blob_hash)
+    return len(rows)
+
+
+def enqueue(app, conn, blob_hash):
+    """Постановка блоба в очередь, если миниатюр для него ещё нет
+
+    Одинаковое содержимое обрабатывается один раз: повторно загруженное
+    фото сразу получает готовые миниатюры.
+    """
+    if not available():
+        return False
+    cursor = conn.execute('''
+        UPDATE blobs SET thumb_status = 'pending' WHERE hash = ? AND thumb_status IS NULL
+    ''', (blob_hash,))
+    conn.commit()
+    if cursor.rowcount == 0:
+        return False
+    get_executor(app).submit(generate, app, blob_hash)
+    return True